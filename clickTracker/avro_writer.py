@@ -0,0 +1,269 @@
+'''An Avro datum writer that is compiled for a specific schema.
+
+avro.io.DatumWriter walks the schema reflectively for every datum and
+validates the whole datum before writing it, which makes it one of the
+most expensive parts of handling a tracker event. This writer walks
+the schema once, when it is created, and builds a tree of closures
+that write the binary encoding directly to an output buffer that is
+reused between calls.
+
+The output is byte for byte identical to the output of
+avro.io.DatumWriter for valid data.
+
+Author: Mark Desnoyer (desnoyer@neon-lab.com)
+Copyright 2016 Neon Labs
+'''
+import os.path
+import sys
+__base_path__ = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if sys.path[0] != __base_path__:
+    sys.path.insert(0, __base_path__)
+
+import avro.io
+import avro.schema
+from cStringIO import StringIO
+import logging
+import struct
+
+_log = logging.getLogger(__name__)
+
+_FLOAT_STRUCT = struct.Struct('<f')
+_DOUBLE_STRUCT = struct.Struct('<d')
+
+def encode_long(datum):
+    '''Returns the zig-zag varint encoding of an int or long.'''
+    datum = (datum << 1) ^ (datum >> 63)
+    chunks = []
+    while (datum & ~0x7F) != 0:
+        chunks.append(chr((datum & 0x7F) | 0x80))
+        datum >>= 7
+    chunks.append(chr(datum))
+    return ''.join(chunks)
+
+# Most of the ints we write (union branches, array lengths, short
+# strings) are small, so cache their encodings.
+_SMALL_LONGS = [encode_long(i) for i in range(128)]
+
+def _write_long(datum, write):
+    if 0 <= datum < 128:
+        write(_SMALL_LONGS[datum])
+    else:
+        write(encode_long(datum))
+
+def _write_null(datum, write):
+    pass
+
+def _write_boolean(datum, write):
+    write('\x01' if datum else '\x00')
+
+def _write_float(datum, write):
+    write(_FLOAT_STRUCT.pack(datum))
+
+def _write_double(datum, write):
+    write(_DOUBLE_STRUCT.pack(datum))
+
+def _write_bytes(datum, write):
+    _write_long(len(datum), write)
+    write(datum)
+
+def _write_string(datum, write):
+    datum = datum.encode('utf-8')
+    _write_long(len(datum), write)
+    write(datum)
+
+_PRIMITIVE_WRITERS = {
+    'null' : _write_null,
+    'boolean' : _write_boolean,
+    'int' : _write_long,
+    'long' : _write_long,
+    'float' : _write_float,
+    'double' : _write_double,
+    'bytes' : _write_bytes,
+    'string' : _write_string
+    }
+
+class CompiledDatumWriter(object):
+    '''Writes datums for a single schema using precompiled writers.
+
+    It can be used as a drop in replacement for avro.io.DatumWriter
+    through write(), but encode() is faster because it reuses its
+    output buffer.
+
+    Unions are resolved like avro.io.DatumWriter does, by picking the
+    last branch that validates, except for two common cases that are
+    resolved without validation:
+
+    - Unions of null and a single other type.
+    - Unions listed in discriminated_unions. This is a dictionary of
+      field name -> (discriminator field name, {discriminator value ->
+      branch name}). The union in that field is resolved by looking
+      up the value of the discriminator field in the same record. If
+      the value is not in the map, the union is resolved by validation.
+
+    This writer does not validate the datum up front. If the datum
+    cannot be encoded, an avro.io.AvroTypeException is raised, but a
+    datum of the wrong type that happens to be encodable (e.g. a
+    string in a boolean field) will be written.
+    '''
+    def __init__(self, writers_schema, discriminated_unions=None):
+        self.writers_schema = writers_schema
+        self._discriminated_unions = discriminated_unions or {}
+        self._named_writers = {}
+        self._writer = self._compile(writers_schema)
+        self._buf = StringIO()
+
+    def write(self, datum, encoder):
+        '''Writes the datum to an avro.io.BinaryEncoder.'''
+        try:
+            self._writer(datum, encoder.write)
+        except (AttributeError, KeyError, TypeError, ValueError,
+                struct.error):
+            raise avro.io.AvroTypeException(self.writers_schema, datum)
+
+    def encode(self, datum):
+        '''Returns the binary encoding of the datum as a string.'''
+        buf = self._buf
+        buf.seek(0)
+        buf.truncate()
+        try:
+            self._writer(datum, buf.write)
+        except (AttributeError, KeyError, TypeError, ValueError,
+                struct.error):
+            raise avro.io.AvroTypeException(self.writers_schema, datum)
+        return buf.getvalue()
+
+    def _compile(self, schema):
+        '''Returns a function f(datum, write) that writes the schema.'''
+        schema_type = schema.type
+        if schema_type in _PRIMITIVE_WRITERS:
+            return _PRIMITIVE_WRITERS[schema_type]
+        elif schema_type in ['record', 'error', 'request']:
+            return self._compile_record(schema)
+        elif schema_type == 'enum':
+            return self._compile_enum(schema)
+        elif schema_type == 'fixed':
+            return self._compile_fixed(schema)
+        elif schema_type == 'array':
+            return self._compile_array(schema)
+        elif schema_type == 'map':
+            return self._compile_map(schema)
+        elif schema_type in ['union', 'error_union']:
+            return self._compile_union(schema)
+        raise avro.schema.AvroException('Unknown type: %s' % schema_type)
+
+    def _compile_record(self, schema):
+        # Named types can be recursive, so register the writer before
+        # compiling the fields.
+        if schema.fullname in self._named_writers:
+            return self._named_writers[schema.fullname]
+        field_writers = []
+        def write_record(datum, write):
+            get = datum.get
+            for name, writer in field_writers:
+                if name is None:
+                    # Discriminated unions need the whole record
+                    writer(datum, write)
+                else:
+                    writer(get(name), write)
+        self._named_writers[schema.fullname] = write_record
+
+        for field in schema.fields:
+            if field.name in self._discriminated_unions:
+                discriminator, branch_map = \
+                  self._discriminated_unions[field.name]
+                field_writers.append(
+                    (None, self._compile_discriminated_union(
+                        field, discriminator, branch_map)))
+            else:
+                field_writers.append((field.name, self._compile(field.type)))
+        return write_record
+
+    def _compile_enum(self, schema):
+        encoded = dict((symbol, encode_long(i)) for i, symbol in
+                       enumerate(schema.symbols))
+        def write_enum(datum, write):
+            write(encoded[datum])
+        return write_enum
+
+    def _compile_fixed(self, schema):
+        size = schema.size
+        def write_fixed(datum, write):
+            if len(datum) != size:
+                raise ValueError('Fixed value of the wrong size')
+            write(datum)
+        return write_fixed
+
+    def _compile_array(self, schema):
+        item_writer = self._compile(schema.items)
+        def write_array(datum, write):
+            if len(datum) > 0:
+                _write_long(len(datum), write)
+                for item in datum:
+                    item_writer(item, write)
+            write('\x00')
+        return write_array
+
+    def _compile_map(self, schema):
+        value_writer = self._compile(schema.values)
+        def write_map(datum, write):
+            if len(datum) > 0:
+                _write_long(len(datum), write)
+                for key, value in datum.iteritems():
+                    _write_string(key, write)
+                    value_writer(value, write)
+            write('\x00')
+        return write_map
+
+    def _compile_union(self, schema):
+        branches = schema.schemas
+        writers = [self._compile(x) for x in branches]
+        prefixes = [encode_long(i) for i in range(len(branches))]
+
+        null_idx = [i for i, x in enumerate(branches) if x.type == 'null']
+        if len(branches) == 2 and len(null_idx) == 1:
+            null_prefix = prefixes[null_idx[0]]
+            other_idx = 1 - null_idx[0]
+            other_prefix = prefixes[other_idx]
+            other_writer = writers[other_idx]
+            def write_nullable(datum, write):
+                if datum is None:
+                    write(null_prefix)
+                else:
+                    write(other_prefix)
+                    other_writer(datum, write)
+            return write_nullable
+
+        branch_info = list(reversed(zip(branches, prefixes, writers)))
+        def write_union(datum, write):
+            for branch, prefix, writer in branch_info:
+                if avro.io.validate(branch, datum):
+                    write(prefix)
+                    writer(datum, write)
+                    return
+            raise avro.io.AvroTypeException(schema, datum)
+        return write_union
+
+    def _compile_discriminated_union(self, field, discriminator, branch_map):
+        '''Compiles a union that is resolved using a sibling field.
+
+        The returned function takes the whole record as the datum.
+        '''
+        name = field.name
+        generic_writer = self._compile(field.type)
+        branch_writers = {}
+        for i, branch in enumerate(field.type.schemas):
+            branch_name = getattr(branch, 'name', branch.type)
+            for key, value in branch_map.iteritems():
+                if value == branch_name:
+                    branch_writers[key] = (encode_long(i),
+                                           self._compile(branch))
+        def write_discriminated(record, write):
+            datum = record.get(name)
+            try:
+                prefix, writer = branch_writers[record.get(discriminator)]
+            except KeyError:
+                generic_writer(datum, write)
+                return
+            write(prefix)
+            writer(datum, write)
+        return write_discriminated
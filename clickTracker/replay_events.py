@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 '''A script that replays a thrift file and sends it to flume.
 
-**** WARNING **** This script loads all the events in each file to memory.
-if they are very big then you might run out of memory.
+The trackserver replays its backlog automatically (see
+trackserver.BacklogDrainer), so this is only needed for files that
+were moved off of a tracker host.
 '''
 import os.path
 import sys
@@ -45,29 +46,32 @@ def process_file(cur_file):
     try:
         _log.info('Processing file %s' % cur_file)
 
-        # TODO(mdesnoyer): Stream the events to flume so that this
-        # script doesn't run out of memory.
-        events = []
         with open(cur_file, 'rb') as in_file:
             in_stream = TTransport.TFileObjectTransport(in_file)
             protocol_reader = TCompactProtocol.TCompactProtocol(in_stream)
 
-            try:
-                while True:
-                    event = ThriftFlumeEvent()
-                    event.read(protocol_reader)
-                    if len(event.headers) == 0:
-                        break
-                    events.append(event)
-            except EOFError:
-                pass
+            # Stream the events to flume in batches so that we don't
+            # need the whole file in memory.
+            at_end = False
+            while not at_end:
+                events = []
+                try:
+                    while len(events) < options.max_batch_size:
+                        event = ThriftFlumeEvent()
+                        event.read(protocol_reader)
+                        if len(event.headers) == 0:
+                            at_end = True
+                            break
+                        events.append(event)
+                except EOFError:
+                    at_end = True
 
-        _log.info("Finished reading %s, sending to flume" % cur_file)
-        n = options.max_batch_size
-        for i in xrange(0, len(events), n):
-            status = yield tornado.gen.Task(flume.appendBatch, events[i:i+n])
-            if status != Status.OK:
-                raise Thrift.TException('Flume returned error: %s' % status)
+                if len(events) > 0:
+                    status = yield tornado.gen.Task(flume.appendBatch,
+                                                    events)
+                    if status != Status.OK:
+                        raise Thrift.TException(
+                            'Flume returned error: %s' % status)
 
         _log.info("Sucessfully replayed %s. Deleting the file" %
                   cur_file)
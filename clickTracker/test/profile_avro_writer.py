@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''Microbenchmark of the avro serialization of tracker events.
+
+Compares the generic avro.io.DatumWriter path against the
+CompiledDatumWriter used by the trackserver and reports the number
+of events per second that can be serialized on a single core.
+
+Copyright: 2016 Neon Labs
+Author: Mark Desnoyer (desnoyer@neon-lab.com)
+'''
+import os.path
+import sys
+__base_path__ = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                             '..'))
+if sys.path[0] != __base_path__:
+    sys.path.insert(0, __base_path__)
+
+import avro.io
+import avro.schema
+import clickTracker.trackserver
+from clickTracker.trackserver import BaseTrackerDataV2
+import logging
+from optparse import OptionParser
+import time
+import tornado.web
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+class FakeRequest(object):
+    '''Minimal stand in for a tornado request handler.'''
+    class _Request(object):
+        remote_ip = '12.43.151.12'
+        headers = {
+            'User-Agent' : ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) '
+                            'AppleWebKit/537.36 (KHTML, like Gecko) '
+                            'Chrome/34.0.1847.137 Safari/537.36'),
+            'Geoip_country_code3' : 'USA',
+            'Geoip_city' : 'San Francisco',
+            'Geoip_latitude' : '37.7794',
+            'Geoip_longitude' : '-122.4170'
+            }
+
+    def __init__(self, args):
+        self.args = args
+        self.request = FakeRequest._Request()
+
+    def get_argument(self, name, default=tornado.web.RequestHandler._ARG_DEFAULT):
+        try:
+            return self.args[name]
+        except KeyError:
+            if default is tornado.web.RequestHandler._ARG_DEFAULT:
+                raise tornado.web.MissingArgumentError(name)
+            return default
+
+    def get_cookie(self, name, default=None):
+        return 'cookie1'
+
+def build_events():
+    common = {'pageid' : 'pageid123', 'tai' : 'tai123',
+              'ttype' : 'brightcove', 'page' : 'http://go.com',
+              'ref' : 'http://ref.com', 'cts' : '23945827'}
+    args = [
+        {'a' : 'iv', 'tids' : 'acct1_vid1_tid1,acct1_vid2_tid2'},
+        {'a' : 'il', 'tids' : 'acct1_vid1_tid1 640 480'},
+        {'a' : 'ic', 'tid' : 'acct1_vid1_tid1', 'x' : '3', 'y' : '4'},
+        {'a' : 'vc', 'vid' : 'vid1', 'tid' : 'acct1_vid1_tid1'},
+        {'a' : 'vp', 'vid' : 'vid1', 'tid' : 'acct1_vid1_tid1',
+         'adelta' : '520', 'pcount' : '1'},
+        {'a' : 'ap', 'vid' : 'vid1', 'tid' : 'acct1_vid1_tid1',
+         'adelta' : '520', 'pcount' : '1'},
+        {'a' : 'vvp', 'vid' : 'vid1', 'pcount' : '1', 'prcnt' : '45'}]
+    return [BaseTrackerDataV2.generate(FakeRequest(dict(common, **x)))
+            for x in args]
+
+def time_writer(events, writer, schema_url, n_events):
+    start_time = time.time()
+    n_sent = 0
+    while n_sent < n_events:
+        for event in events:
+            event.to_flume_event(writer, schema_url)
+        n_sent += len(events)
+    return n_sent / (time.time() - start_time)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+
+    parser.add_option('--n_events', default=100000, type='int',
+                      help='Number of events to serialize with each writer')
+    parser.add_option('--schema', default=os.path.join(
+        __base_path__, 'schema', 'compiled', 'TrackerEvent.avsc'),
+                      help='Path to the TrackerEvent avsc file')
+
+    options, args = parser.parse_args()
+
+    with open(options.schema) as f:
+        schema = avro.schema.parse(f.read())
+    schema_url = 'http://bucket.s3.amazonaws.com/schema.avsc'
+    events = build_events()
+
+    generic_rate = time_writer(events, avro.io.DatumWriter(schema),
+                               schema_url, options.n_events)
+    compiled_rate = time_writer(events,
+                                BaseTrackerDataV2.get_avro_writer(schema),
+                                schema_url, options.n_events)
+
+    _log.info('avro.io.DatumWriter: %.0f events/s' % generic_rate)
+    _log.info('CompiledDatumWriter: %.0f events/s' % compiled_rate)
+    _log.info('Speedup: %.2fx' % (compiled_rate / generic_rate))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+'''
+Tests for the compiled avro writer.
+'''
+
+import os.path
+import sys
+__base_path__ = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                             '..'))
+if sys.path[0] != __base_path__:
+    sys.path.insert(0, __base_path__)
+
+import avro.io
+import avro.schema
+from clickTracker.avro_writer import CompiledDatumWriter
+import clickTracker.trackserver
+from cStringIO import StringIO
+import json
+import unittest
+import utils.neon
+from utils.options import options
+
+class TestCompiledDatumWriter(unittest.TestCase):
+    def _reference_encode(self, schema, datum):
+        buf = StringIO()
+        avro.io.DatumWriter(schema).write(datum, avro.io.BinaryEncoder(buf))
+        return buf.getvalue()
+
+    def _check_schema(self, schema_json, datums, **kwargs):
+        schema = avro.schema.parse(json.dumps(schema_json))
+        writer = CompiledDatumWriter(schema, **kwargs)
+        for datum in datums:
+            self.assertEqual(writer.encode(datum),
+                             self._reference_encode(schema, datum))
+
+            # Check the DatumWriter compatible interface
+            buf = StringIO()
+            writer.write(datum, avro.io.BinaryEncoder(buf))
+            self.assertEqual(buf.getvalue(),
+                             self._reference_encode(schema, datum))
+
+    def test_primitives(self):
+        self._check_schema('long', [0, 1, -1, 63, 64, -65, 127, 128,
+                                    1467000000000L, -(2**63), 2**63 - 1])
+        self._check_schema('int', [0, 5, -300, 2**31 - 1, -(2**31)])
+        self._check_schema('boolean', [True, False])
+        self._check_schema('float', [0.0, 1.5, -122.417, 3])
+        self._check_schema('double', [0.0, 37.7794, -1e300])
+        self._check_schema('string', ['', 'hello', u'caf\xe9', 'a' * 300])
+        self._check_schema('bytes', ['', '\x00\xff'])
+        self._check_schema('null', [None])
+
+    def test_complex_types(self):
+        self._check_schema({'type' : 'array', 'items' : 'string'},
+                           [[], ['a'], ['a', 'b', 'c']])
+        self._check_schema({'type' : 'map', 'values' : 'int'},
+                           [{}, {'a' : 1}])
+        self._check_schema({'type' : 'enum', 'name' : 'E',
+                            'symbols' : ['A', 'B', 'C']},
+                           ['A', 'C'])
+        self._check_schema({'type' : 'fixed', 'name' : 'F', 'size' : 3},
+                           ['abc'])
+        self._check_schema(['null', 'string'], [None, 'a'])
+        self._check_schema(['string', 'null'], [None, 'a'])
+        self._check_schema(['null', 'int', 'string'], [None, 3, 'a'])
+
+    def test_union_picks_last_valid_record(self):
+        schema_json = [
+            {'type' : 'record', 'name' : 'A',
+             'fields' : [{'name' : 'x', 'type' : 'string'}]},
+            {'type' : 'record', 'name' : 'B',
+             'fields' : [{'name' : 'x', 'type' : 'string'},
+                         {'name' : 'isB', 'type' : 'boolean'}]}]
+        self._check_schema(schema_json, [{'x' : 'a'},
+                                         {'x' : 'a', 'isB' : True}])
+
+    def test_discriminated_union(self):
+        schema_json = {
+            'type' : 'record', 'name' : 'Event',
+            'fields' : [
+                {'name' : 'kind', 'type' : 'string'},
+                {'name' : 'data', 'type' : [
+                    {'type' : 'record', 'name' : 'A',
+                     'fields' : [{'name' : 'x', 'type' : 'string'}]},
+                    {'type' : 'record', 'name' : 'B',
+                     'fields' : [{'name' : 'x', 'type' : 'string'},
+                                 {'name' : 'isB', 'type' : 'boolean'}]}]}]}
+        self._check_schema(
+            schema_json,
+            [{'kind' : 'b', 'data' : {'x' : 'a', 'isB' : True}},
+             {'kind' : 'a', 'data' : {'x' : 'a'}},
+             {'kind' : 'unknown', 'data' : {'x' : 'a', 'isB' : False}}],
+            discriminated_unions={'data' : ('kind', {'a' : 'A', 'b' : 'B'})})
+
+    def test_buffer_reused(self):
+        schema = avro.schema.parse('"string"')
+        writer = CompiledDatumWriter(schema)
+        first = writer.encode('a long string value')
+        second = writer.encode('short')
+        self.assertEqual(first, self._reference_encode(schema,
+                                                       'a long string value'))
+        self.assertEqual(second, self._reference_encode(schema, 'short'))
+
+    def test_invalid_datum(self):
+        schema = avro.schema.parse(json.dumps(
+            {'type' : 'record', 'name' : 'R',
+             'fields' : [{'name' : 'x', 'type' : 'int'},
+                         {'name' : 'e', 'type' : {
+                             'type' : 'enum', 'name' : 'E',
+                             'symbols' : ['A']}}]}))
+        writer = CompiledDatumWriter(schema)
+        with self.assertRaises(avro.io.AvroTypeException):
+            writer.encode({'x' : None, 'e' : 'A'})
+        with self.assertRaises(avro.io.AvroTypeException):
+            writer.encode({'x' : 3, 'e' : 'B'})
+        with self.assertRaises(avro.io.AvroTypeException):
+            writer.encode('not a record')
+
+    def test_tracker_event_schema(self):
+        with open(options.get(
+                'clickTracker.trackserver.message_schema')) as f:
+            schema = avro.schema.parse(f.read())
+        writer = clickTracker.trackserver.BaseTrackerDataV2.get_avro_writer(
+            schema)
+        base = {
+            'pageId' : 'pageid123',
+            'trackerAccountId' : 'tai123',
+            'trackerType' : 'BRIGHTCOVE',
+            'pageURL' : 'http://go.com',
+            'refURL' : None,
+            'serverTime' : 1467000000000L,
+            'clientTime' : 1467000000001L,
+            'clientIP' : '12.43.151.12',
+            'neonUserId' : '',
+            'userAgent' : u'Mozilla/5.0',
+            'agentInfo' : {'os' : {'name' : 'Linux', 'version' : None},
+                           'browser' : {'name' : 'Safari',
+                                        'version' : '4.0'}},
+            'ipGeoData' : {'country' : u'USA', 'city' : None,
+                           'region' : None, 'zip' : None,
+                           'lat' : 37.7794, 'lon' : -122.417},
+            'isp_host' : '127.0.0.1',
+            'isp_port' : 8089
+            }
+        events = [
+            ('IMAGES_VISIBLE', {'isImagesVisible' : True,
+                                'thumbnailIds' : ['acct1_vid1_tid1']}),
+            ('IMAGES_LOADED', {'isImagesLoaded' : True,
+                               'images' : [{'thumbnailId' : 'a_v_t',
+                                            'width' : 640,
+                                            'height' : 480}]}),
+            ('IMAGE_CLICK', {'isImageClick' : True,
+                             'thumbnailId' : 'acct1_vid1_tid1',
+                             'pageCoords' : {'x' : 3.0, 'y' : 4.0},
+                             'windowCoords' : {'x' : 5.0, 'y' : 6.0},
+                             'imageCoords' : {'x' : 1.0, 'y' : 2.0}}),
+            ('VIDEO_CLICK', {'isVideoClick' : True, 'videoId' : 'vid1',
+                             'playerId' : None, 'thumbnailId' : None}),
+            ('VIDEO_PLAY', {'isVideoPlay' : True, 'videoId' : 'vid1',
+                            'playerId' : 'p1', 'thumbnailId' : 'a_v_t',
+                            'didAdPlay' : False, 'autoplayDelta' : 520,
+                            'isAutoPlay' : None, 'playCount' : 1}),
+            ('AD_PLAY', {'isAdPlay' : True, 'videoId' : None,
+                         'playerId' : 'p1', 'thumbnailId' : None,
+                         'autoplayDelta' : None, 'isAutoPlay' : True,
+                         'playCount' : 2}),
+            ('VIDEO_VIEW_PERCENTAGE', {'isVideoViewPercentage' : True,
+                                       'videoId' : 'vid1',
+                                       'playCount' : 1,
+                                       'percent' : 45.0})]
+        for event_type, event_data in events:
+            datum = dict(base, eventType=event_type, eventData=event_data)
+            self.assertEqual(writer.encode(datum),
+                             self._reference_encode(schema, datum))
+
+if __name__ == '__main__':
+    utils.neon.InitNeon()
+    unittest.main()
@@ -35,12 +35,78 @@ from thrift.protocol import TCompactProtocol
 import time
 from tornado.httpclient import HTTPError, HTTPRequest, HTTPResponse
 import tornado.iostream
+import tornado.testing
 import urllib
 import urlparse
 import unittest
 import utils.neon
 from utils.options import options
 
+class TestAgentInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.parse_mock = MagicMock(
+            side_effect=clickTracker.trackserver.BaseTrackerDataV2.parse_agent_info)
+        self.cache = clickTracker.trackserver.AgentInfoCache(self.parse_mock)
+        self.chrome = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) '
+                       'AppleWebKit/537.36 (KHTML, like Gecko) '
+                       'Chrome/34.0.1847.137 Safari/537.36')
+        self.android = (
+            "Mozilla/5.0 (Linux; U; Android 2.3.5; en-in; "
+            "HTC_DesireS_S510e Build/GRJ90) AppleWebKit/533.1 (KHTML, like "
+            "Gecko) Version/4.0 Mobile Safari/533.1")
+
+    def _get_stat(self, name):
+        return clickTracker.trackserver.statemon.state.get(
+            'clickTracker.trackserver.%s' % name)
+
+    def test_memoize(self):
+        hits = self._get_stat('agent_cache_hits')
+        misses = self._get_stat('agent_cache_misses')
+
+        info = self.cache.get(self.chrome)
+        self.assertEqual(info['browser']['name'], 'Chrome')
+        self.assertEqual(self.cache.get(self.chrome), info)
+        self.assertIsNone(self.cache.get('garbage'))
+        self.assertIsNone(self.cache.get('garbage'))
+
+        self.assertEqual(self.parse_mock.call_count, 2)
+        self.assertEqual(self._get_stat('agent_cache_hits'), hits + 2)
+        self.assertEqual(self._get_stat('agent_cache_misses'), misses + 2)
+
+    def test_lru_eviction(self):
+        with options._set_bounded('clickTracker.trackserver.agent_cache_size',
+                                  2):
+            self.cache.get(self.chrome)
+            self.cache.get(self.android)
+            self.cache.get(self.chrome)
+            # Evicts the android agent because it was used least recently
+            self.cache.get('garbage')
+            self.assertEqual(len(self.cache), 2)
+            self.assertEqual(self.parse_mock.call_count, 3)
+
+            self.cache.get(self.chrome)
+            self.assertEqual(self.parse_mock.call_count, 3)
+            self.cache.get(self.android)
+            self.assertEqual(self.parse_mock.call_count, 4)
+
+    def test_seed(self):
+        misses = self._get_stat('agent_cache_misses')
+        self.cache.seed([self.chrome, self.android, self.chrome])
+        self.assertEqual(self.parse_mock.call_count, 2)
+        self.assertEqual(self._get_stat('agent_cache_misses'), misses)
+
+        self.cache.get(self.android)
+        self.assertEqual(self.parse_mock.call_count, 2)
+
+    def test_shared_by_events(self):
+        self.assertIs(clickTracker.trackserver.ImageClicked.agent_cache,
+                      clickTracker.trackserver.VideoPlay.agent_cache)
+        self.assertEqual(
+            clickTracker.trackserver.ImagesVisible.extract_agent_info(
+                self.android),
+            clickTracker.trackserver.BaseTrackerDataV2.parse_agent_info(
+                self.android))
+
 class TestFileBackupHandler(unittest.TestCase):
     def setUp(self):
         schema_path = options.get('clickTracker.trackserver.message_schema')
@@ -217,6 +283,271 @@ class TestFileBackupHandler(unittest.TestCase):
                         pass
         
 
+class TestBacklogDrainer(test_utils.neontest.AsyncTestCase):
+    def setUp(self):
+        super(TestBacklogDrainer, self).setUp()
+        self.filesystem = fake_filesystem.FakeFilesystem()
+        self.fake_os = fake_filesystem.FakeOsModule(self.filesystem)
+        self.fake_open = fake_filesystem.FakeFileOpen(self.filesystem)
+        clickTracker.trackserver.os = self.fake_os
+        clickTracker.trackserver.open = self.fake_open
+
+        self.thrift_patcher = patch(
+            'clickTracker.trackserver.ThriftSourceProtocol.Client')
+        self.thrift_mock = MagicMock()
+        self.thrift_patcher.start().return_value = self.thrift_mock
+        self.sent_events = []
+        def _append_batch(events, callback):
+            self.sent_events.extend(events)
+            self.io_loop.add_callback(callback, Status.OK)
+        self.thrift_mock.appendBatch.side_effect = _append_batch
+
+        self.transport_patcher = patch(
+            'clickTracker.trackserver.TTornado.TTornadoStreamTransport')
+        self.transport_mock = self.transport_patcher.start()
+        self.transport_mock().open.side_effect = \
+          lambda callback: self.io_loop.add_callback(callback)
+
+        self.log_dir = '/tmp/fake_log_dir'
+        self.option_contexts = [
+            options._set_bounded('clickTracker.trackserver.backup_disk',
+                                 self.log_dir),
+            options._set_bounded(
+                'clickTracker.trackserver.backlog_batch_size', 10),
+            options._set_bounded(
+                'clickTracker.trackserver.backlog_max_rate', 1e9)]
+        for context in self.option_contexts:
+            context.__enter__()
+
+        self.backup_q = Queue.Queue()
+        self.backup_handler = clickTracker.trackserver.FileBackupHandler(
+            self.backup_q)
+        self.flume_buffer = clickTracker.trackserver.FlumeBuffer(
+            6367, self.backup_q)
+        self.drainer = clickTracker.trackserver.BacklogDrainer(
+            self.flume_buffer, self.backup_handler, self.io_loop)
+
+    def tearDown(self):
+        for context in reversed(self.option_contexts):
+            context.__exit__(None, None, None)
+        self.thrift_patcher.stop()
+        self.transport_patcher.stop()
+        clickTracker.trackserver.os = os
+        clickTracker.trackserver.open = __builtin__.open
+        super(TestBacklogDrainer, self).tearDown()
+
+    def _write_backup_file(self, name, n_events):
+        path = os.path.join(self.log_dir, name)
+        if not self.fake_os.path.exists(os.path.dirname(path)):
+            self.fake_os.makedirs(os.path.dirname(path))
+        with self.fake_open(path, 'wb') as f:
+            protocol = TCompactProtocol.TCompactProtocol(
+                TTransport.TFileObjectTransport(f))
+            for i in range(n_events):
+                ThriftFlumeEvent(headers={'file' : name, 'i' : str(i)},
+                                 body='body%i' % i).write(protocol)
+        return path
+
+    def _sent_ids(self):
+        return [(x.headers['file'], int(x.headers['i']))
+                for x in self.sent_events]
+
+    @tornado.testing.gen_test
+    def test_replay_all_files(self):
+        path1 = self._write_backup_file('a_clicklog.log', 25)
+        path2 = self._write_backup_file('b_clicklog.log', 5)
+
+        yield self.drainer.drain()
+
+        self.assertItemsEqual(
+            self._sent_ids(),
+            [('a_clicklog.log', i) for i in range(25)] +
+            [('b_clicklog.log', i) for i in range(5)])
+        # Events are sent in bounded batches
+        self.assertEqual(self.thrift_mock.appendBatch.call_count, 4)
+        self.assertFalse(self.fake_os.path.exists(path1))
+        self.assertFalse(self.fake_os.path.exists(path2))
+        self.assertEqual(self.fake_os.listdir(self.log_dir), [])
+        self.assertEqual(
+            clickTracker.trackserver.statemon.state.get(
+                'clickTracker.trackserver.backlog_files'), 0)
+        self.assertEqual(
+            clickTracker.trackserver.statemon.state.get(
+                'clickTracker.trackserver.backlog_bytes'), 0)
+
+    @tornado.testing.gen_test
+    def test_skip_file_being_written(self):
+        self._write_backup_file('a_clicklog.log', 5)
+        cur_path = self._write_backup_file('b_clicklog.log', 5)
+        self.backup_handler.cur_filename = cur_path
+
+        yield self.drainer.drain()
+
+        self.assertItemsEqual(self._sent_ids(),
+                              [('a_clicklog.log', i) for i in range(5)])
+        self.assertEqual(self.fake_os.listdir(self.log_dir),
+                         ['b_clicklog.log'])
+        self.assertEqual(
+            clickTracker.trackserver.statemon.state.get(
+                'clickTracker.trackserver.backlog_files'), 1)
+        self.assertGreater(
+            clickTracker.trackserver.statemon.state.get(
+                'clickTracker.trackserver.backlog_bytes'), 0)
+
+    @tornado.testing.gen_test
+    def test_file_removed_while_listing(self):
+        self._write_backup_file('a_clicklog.log', 5)
+        gone_path = self._write_backup_file('b_clicklog.log', 5)
+
+        # Another worker drains the file after it has been listed
+        real_stat = self.fake_os.stat
+        def _stat(path, *args, **kwargs):
+            if path == gone_path:
+                raise OSError(2, 'No such file or directory', path)
+            return real_stat(path, *args, **kwargs)
+
+        with patch.object(self.fake_os, 'stat', side_effect=_stat):
+            yield self.drainer.drain()
+
+        self.assertItemsEqual(self._sent_ids(),
+                              [('a_clicklog.log', i) for i in range(5)])
+
+    @tornado.testing.gen_test
+    def test_resume_from_checkpoint(self):
+        path = self._write_backup_file('a_clicklog.log', 25)
+
+        # Flume dies on the second batch
+        calls = [0]
+        def _append_batch(events, callback):
+            calls[0] += 1
+            if calls[0] == 2:
+                self.io_loop.add_callback(callback, Status.ERROR)
+            else:
+                self.sent_events.extend(events)
+                self.io_loop.add_callback(callback, Status.OK)
+        self.thrift_mock.appendBatch.side_effect = _append_batch
+
+        yield self.drainer.drain()
+
+        self.assertEqual(self._sent_ids(),
+                         [('a_clicklog.log', i) for i in range(10)])
+        self.assertTrue(self.fake_os.path.exists(path))
+        self.assertTrue(self.fake_os.path.exists(path + '.ckpt'))
+        self.assertFalse(self.flume_buffer.is_healthy(60.0))
+
+        # Flume isn't healthy yet, so nothing should be sent
+        yield self.drainer.drain()
+        self.assertEqual(len(self.sent_events), 10)
+
+        # Now flume is back so the rest of the file is sent
+        self.flume_buffer.last_error_time = None
+        yield self.drainer.drain()
+        self.assertEqual(self._sent_ids(),
+                         [('a_clicklog.log', i) for i in range(25)])
+        self.assertEqual(self.fake_os.listdir(self.log_dir), [])
+
+    @tornado.testing.gen_test
+    def test_no_replay_after_live_flume_error(self):
+        self._write_backup_file('a_clicklog.log', 5)
+        self.flume_buffer._register_flume_error()
+
+        yield self.drainer.drain()
+
+        self.assertEqual(self.sent_events, [])
+        self.assertEqual(
+            clickTracker.trackserver.statemon.state.get(
+                'clickTracker.trackserver.backlog_files'), 1)
+
+    @tornado.testing.gen_test
+    def test_replay_orphaned_worker_dirs(self):
+        with options._set_bounded('clickTracker.trackserver.workers', 2):
+            self.backup_handler = clickTracker.trackserver.FileBackupHandler(
+                self.backup_q,
+                backup_dir=clickTracker.trackserver.worker_backup_dir(0))
+            self.drainer = clickTracker.trackserver.BacklogDrainer(
+                self.flume_buffer, self.backup_handler, self.io_loop)
+            self._write_backup_file('worker_0/a_clicklog.log', 2)
+            self._write_backup_file('worker_1/b_clicklog.log', 2)
+            self._write_backup_file('worker_5/c_clicklog.log', 2)
+            self._write_backup_file('d_clicklog.log', 2)
+
+            yield self.drainer.drain()
+
+            # worker_1 is owned by a running worker, so it is left alone
+            self.assertItemsEqual(
+                set([x[0] for x in self._sent_ids()]),
+                ['worker_0/a_clicklog.log', 'worker_5/c_clicklog.log',
+                 'd_clicklog.log'])
+            self.assertEqual(
+                self.fake_os.listdir(os.path.join(self.log_dir, 'worker_1')),
+                ['b_clicklog.log'])
+            self.assertEqual(
+                clickTracker.trackserver.statemon.state.get(
+                    'clickTracker.trackserver.backlog_files'), 1)
+
+            # A worker other than 0 only replays its own directory
+            self._write_backup_file('worker_5/e_clicklog.log', 2)
+            self.sent_events = []
+            drainer = clickTracker.trackserver.BacklogDrainer(
+                self.flume_buffer,
+                clickTracker.trackserver.FileBackupHandler(
+                    self.backup_q,
+                    backup_dir=clickTracker.trackserver.worker_backup_dir(1)),
+                self.io_loop,
+                drain_orphans=False)
+            yield drainer.drain()
+            self.assertItemsEqual(
+                set([x[0] for x in self._sent_ids()]),
+                ['worker_1/b_clicklog.log'])
+
+class TestWorkers(unittest.TestCase):
+    def test_sockets_share_port(self):
+        sock1 = clickTracker.trackserver.bind_reuseport_socket(0, 'localhost')
+        try:
+            port = sock1.getsockname()[1]
+            sock2 = clickTracker.trackserver.bind_reuseport_socket(
+                port, 'localhost')
+            sock2.close()
+        finally:
+            sock1.close()
+
+    def test_backup_handler_stop_writes_queue(self):
+        filesystem = fake_filesystem.FakeFilesystem()
+        fake_os = fake_filesystem.FakeOsModule(filesystem)
+        fake_open = fake_filesystem.FakeFileOpen(filesystem)
+        clickTracker.trackserver.os = fake_os
+        clickTracker.trackserver.open = fake_open
+        try:
+            data_q = Queue.Queue()
+            handler = clickTracker.trackserver.FileBackupHandler(
+                data_q, backup_dir='/tmp/backup/worker_3')
+            handler.start()
+            for i in range(5):
+                data_q.put(ThriftFlumeEvent(headers={'i' : str(i)},
+                                            body='body'))
+            handler.stop()
+
+            self.assertFalse(handler.is_alive())
+            self.assertIsNone(handler.cur_filename)
+            files = fake_os.listdir('/tmp/backup/worker_3')
+            self.assertEqual(len(files), 1)
+            with fake_open(os.path.join('/tmp/backup/worker_3',
+                                        files[0])) as f:
+                protocol = TCompactProtocol.TCompactProtocol(
+                    TTransport.TFileObjectTransport(f))
+                n_events = 0
+                try:
+                    while True:
+                        event = ThriftFlumeEvent()
+                        event.read(protocol)
+                        n_events += 1
+                except EOFError:
+                    pass
+            self.assertEqual(n_events, 5)
+        finally:
+            clickTracker.trackserver.os = os
+            clickTracker.trackserver.open = __builtin__.open
+
 class TestFullServer(test_utils.neontest.AsyncHTTPTestCase):
     '''A set of tests that fire up the whole server and throws http requests at it.'''
 
@@ -16,16 +16,20 @@ if sys.path[0] != __base_path__:
 
 import avro.io
 import avro.schema
+from clickTracker.avro_writer import CompiledDatumWriter
+from collections import OrderedDict
 from clickTracker.flume import ThriftSourceProtocol
 from clickTracker.flume.ttypes import *
 from clickTracker import TTornado
 import hashlib
 import httpagentparser
 import json
+import multiprocessing
 import os
 import Queue
 import re
 import shortuuid
+import signal
 import socket
 from cStringIO import StringIO
 import threading
@@ -55,6 +59,11 @@ _log = logging.getLogger(__name__)
 
 from utils.options import define, options
 define("port", default=9080, help="run on the given port", type=int)
+define("workers", default=1, type=int,
+       help=('Number of worker processes to run. If > 1, each worker listens '
+             'on the port using SO_REUSEPORT'))
+define("worker_shutdown_timeout", default=30.0, type=float,
+       help='Seconds to wait for a worker to drain before killing it')
 define("flume_port", default=6367, type=int,
        help='Port to talk to the flume agent running locally')
 define("backup_disk", default="/mnt/neon/backlog", type=str,
@@ -63,6 +72,16 @@ define("backup_max_events_per_file", default=100000, type=int,
        help='Maximum events to allow backups on per file')
 define("flume_flush_interval", default=100, type=int,
        help='Flush flume events after how many events?')
+define("backlog_drain_interval", default=30.0, type=float,
+       help='Seconds between checks for backup files to replay to flume')
+define("backlog_batch_size", default=500, type=int,
+       help='Maximum number of backed up events to send to flume at once')
+define("backlog_max_rate", default=1000.0, type=float,
+       help=('Maximum rate (events/s) to replay backed up events at so '
+             'that live traffic has priority'))
+define("backlog_quiet_period", default=60.0, type=float,
+       help=('Seconds without a flume error before backed up events are '
+             'replayed'))
 define("message_schema",
        default=os.path.abspath(
            os.path.join(os.path.dirname(__file__), '..', 'schema',
@@ -74,6 +93,11 @@ define("isp_host", default="127.0.0.1",
        help="Host where the image serving platform is.")
 define("isp_port", default=8089,
        help="Host where the image serving platform resides")
+define("agent_cache_size", default=10000, type=int,
+       help='Maximum number of parsed user agents to cache')
+define("known_agents_file", default=None, type=str,
+       help=('File with one user agent per line used to pre-seed the user '
+             'agent cache at startup'))
 define('loggly_base_url',
        default='https://logs-01.loggly.com/inputs/520b9697-b7f3-4970-a059-710c28a8188a',
        help='Base url for the loggly endpoint')
@@ -92,9 +116,101 @@ statemon.define('not_interesting_message', int)
 statemon.define('invalid_video_id', int)
 statemon.define('invalid_thumbnails', int)
 _invalid_thumbnails_ref = statemon.state.get_ref('invalid_thumbnails')
+statemon.define('agent_cache_hits', int)
+_agent_cache_hits_ref = statemon.state.get_ref('agent_cache_hits')
+statemon.define('agent_cache_misses', int)
+_agent_cache_misses_ref = statemon.state.get_ref('agent_cache_misses')
+statemon.define('backlog_files', int)
+statemon.define('backlog_bytes', int)
+statemon.define('backlog_events_replayed', int)
+statemon.define('backlog_replay_errors', int)
 
 class NotInterestingData(Exception): pass
 
+class AgentInfoCache(object):
+    '''A bounded LRU cache of parsed user agents.
+
+    There are far fewer distinct user agents than events, so this
+    avoids running the user agent parser on most requests. The cache
+    holds at most options.agent_cache_size entries.
+    '''
+    def __init__(self, parse_func):
+        '''Create the cache.
+
+        Inputs:
+        parse_func - Function that takes a user agent string and returns
+                     the info to cache for it.
+        '''
+        self.parse_func = parse_func
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, uagent):
+        '''Returns the parsed info for a user agent.'''
+        try:
+            retval = self._cache.pop(uagent)
+            statemon.state.increment(ref=_agent_cache_hits_ref, safe=False)
+        except KeyError:
+            statemon.state.increment(ref=_agent_cache_misses_ref,
+                                     safe=False)
+            retval = self.parse_func(uagent)
+            self._make_room()
+        self._cache[uagent] = retval
+        return retval
+
+    def seed(self, uagents):
+        '''Parses a list of user agents and adds them to the cache.'''
+        for uagent in uagents:
+            if uagent not in self._cache:
+                info = self.parse_func(uagent)
+                self._make_room()
+                self._cache[uagent] = info
+
+    def seed_from_file(self, path):
+        '''Seeds the cache from a file with one user agent per line.'''
+        with open(path) as f:
+            uagents = [unicode(x.strip(), 'utf-8') for x in f]
+        self.seed([x for x in uagents if x])
+        _log.info('Seeded the user agent cache with %i agents from %s' %
+                  (len(self), path))
+
+    def clear(self):
+        self._cache.clear()
+
+    def _make_room(self):
+        while len(self._cache) >= max(options.agent_cache_size, 1):
+            self._cache.popitem(last=False)
+
+# Suffixes of the files used to back up events on disk
+BACKUP_FILE_SUFFIX = '_clicklog.log'
+CHECKPOINT_SUFFIX = '.ckpt'
+
+# The socket module in python 2.7 doesn't expose SO_REUSEPORT
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       0x0200 if sys.platform == 'darwin' else 15)
+
+def worker_backup_dir(worker_id):
+    '''Returns the directory that a worker process backs up events to.'''
+    if worker_id is None:
+        return options.backup_disk
+    return os.path.join(options.backup_disk, 'worker_%i' % worker_id)
+
+def bind_reuseport_socket(port, address=''):
+    '''Returns a non-blocking listening socket with SO_REUSEPORT set.
+
+    Each worker process binds its own socket to the same port and the
+    kernel balances the incoming connections between them.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(0)
+    sock.bind((address, port))
+    sock.listen(128)
+    return sock
+
 #############################################
 #### DATA FORMAT ###
 #############################################
@@ -104,6 +220,17 @@ class BaseTrackerDataV2(object):
     Object that mirrors the the Avro TrackerEvent schema and is used to 
     write the Avro data
     '''
+    # A map from the eventType to the record in the eventData union
+    event_data_map = {
+        'IMAGES_VISIBLE' : 'ImagesVisible',
+        'IMAGES_LOADED' : 'ImagesLoaded',
+        'IMAGE_CLICK' : 'ImageClick',
+        'VIDEO_CLICK' : 'VideoClick',
+        'VIDEO_PLAY' : 'VideoPlay',
+        'AD_PLAY' : 'AdPlay',
+        'VIDEO_VIEW_PERCENTAGE' : 'VideoViewPercentage'
+        }
+
     # A map from schema entries to the http headers where the value is found
     header_map = {
         'uagent' : 'User-Agent',
@@ -343,6 +470,15 @@ class BaseTrackerDataV2(object):
 
     @staticmethod
     def extract_agent_info(uagent):
+        '''Returns the browser and os info for a user agent string.
+
+        The results are memoized in BaseTrackerDataV2.agent_cache.
+        '''
+        return BaseTrackerDataV2.agent_cache.get(uagent)
+
+    @staticmethod
+    def parse_agent_info(uagent):
+        '''Parses a user agent string into browser and os info.'''
         retval = {}
         try:
             raw_data = httpagentparser.detect(uagent)
@@ -362,18 +498,36 @@ class BaseTrackerDataV2(object):
             return None
         return retval
 
+    @staticmethod
+    def get_avro_writer(schema):
+        '''Returns a compiled writer for the TrackerEvent schema.'''
+        return CompiledDatumWriter(
+            schema,
+            discriminated_unions={
+                'eventData' : ('eventType',
+                               BaseTrackerDataV2.event_data_map)})
+
     def to_flume_event(self, writer, schema_url):
-        '''Coverts the data to a flume event.'''
-        encoded_str = StringIO()
-        encoder = avro.io.BinaryEncoder(encoded_str)
-        writer.write(self.__dict__, encoder)
+        '''Coverts the data to a flume event.
+
+        Inputs:
+        writer - A CompiledDatumWriter or an avro.io.DatumWriter
+        schema_url - URL of the avro schema
+        '''
+        if isinstance(writer, CompiledDatumWriter):
+            body = writer.encode(self.__dict__)
+        else:
+            encoded_str = StringIO()
+            encoder = avro.io.BinaryEncoder(encoded_str)
+            writer.write(self.__dict__, encoder)
+            body = encoded_str.getvalue()
         return ThriftFlumeEvent(headers = {
                 'timestamp' : str(self.serverTime),
                 'tai' : self.trackerAccountId,
                 'track_vers' : '2.3',
                 'event' : self.eventType,
                 'flume.avro.schema.url' : schema_url
-                }, body=encoded_str.getvalue())
+                }, body=body)
 
     @staticmethod
     @utils.sync.optional_sync
@@ -404,6 +558,10 @@ class BaseTrackerDataV2(object):
             _log.error(msg)
             raise tornado.web.HTTPError(400, reason=msg)
     
+# Shared by all the event types
+BaseTrackerDataV2.agent_cache = AgentInfoCache(
+    BaseTrackerDataV2.parse_agent_info)
+
 class ImagesVisible(BaseTrackerDataV2):
     '''An event specifying that the image became visible.'''
     def __init__(self, request, isp_host, isp_port):
@@ -658,6 +816,7 @@ class FlumeBuffer:
         self.backup_q = backup_q
         self.buffer = []
         self.flush_interval = options.flume_flush_interval
+        self.last_error_time = None
         
     @tornado.gen.coroutine
     def send(self, event):
@@ -675,6 +834,15 @@ class FlumeBuffer:
     def flush(self):
         yield self._send_buffer()
 
+    def is_healthy(self, quiet_period):
+        '''Returns True if there hasn't been a flume error recently.
+
+        Inputs:
+        quiet_period - Seconds that must have passed since the last error
+        '''
+        return (self.last_error_time is None or
+                (time.time() - self.last_error_time) > quiet_period)
+
     @tornado.gen.coroutine
     def _send_buffer(self):
         '''Sends all the events in the buffer to flume.'''
@@ -683,36 +851,43 @@ class FlumeBuffer:
         local_buf = self.buffer
         self.buffer = []
 
-        # Open the connection to flume
-        transport = TTornado.TTornadoStreamTransport('localhost', self.port)
-        pfactory = TCompactProtocol.TCompactProtocolFactory()
-        client = ThriftSourceProtocol.Client(transport, pfactory)
         try:
-            yield tornado.gen.Task(transport.open)
+            yield self.append_batch(local_buf)
         except TTransport.TTransportException as e:
             _log.error('Error opening connection to Flume: %s' % e)
             self._register_flume_error(local_buf)
-            return
-
-        # Send the data to flume
-        try:            
-            status = yield tornado.gen.Task(client.appendBatch, local_buf)
-            if status != Status.OK:
-                raise Thrift.TException('Flume returned error: %s' % status)
         except Thrift.TException as e:
             _log.error('Error writing to Flume: %s' % e)
             self._register_flume_error(local_buf)
-            
         except IOError as e:
             _log.error('Error writing to Flume stream: %s' % e)
             self._register_flume_error(local_buf)
 
+    @tornado.gen.coroutine
+    def append_batch(self, events):
+        '''Sends a batch of events to flume.
+
+        Raises a Thrift.TException or IOError if the events could not
+        be sent.
+        '''
+        # Open the connection to flume
+        transport = TTornado.TTornadoStreamTransport('localhost', self.port)
+        pfactory = TCompactProtocol.TCompactProtocolFactory()
+        client = ThriftSourceProtocol.Client(transport, pfactory)
+        yield tornado.gen.Task(transport.open)
+
+        # Send the data to flume
+        try:            
+            status = yield tornado.gen.Task(client.appendBatch, events)
+            if status != Status.OK:
+                raise Thrift.TException('Flume returned error: %s' % status)
         finally:
             # Make sure we close the connection to avoid open sockets
             transport.close()
 
     def _register_flume_error(self, event_buf=[]):
         statemon.state.increment('flume_errors')
+        self.last_error_time = time.time()
         for event in event_buf:
             self.backup_q.put(event)
 
@@ -869,20 +1044,25 @@ class ErrorMessageTracker(TrackerDataHandler):
 class FileBackupHandler(threading.Thread):
     '''Thread that uploads data to S3.'''
     
-    def __init__(self, dataQ, watcher=utils.ps.ActivityWatcher()):
+    def __init__(self, dataQ, watcher=utils.ps.ActivityWatcher(),
+                 backup_dir=None):
         super(FileBackupHandler, self).__init__()
         self.dataQ = dataQ
         self.daemon = True
         self.watcher = watcher
+        self.backup_dir = backup_dir or options.backup_disk
         self.backup_stream = None
         self.protocol_writer = None
         self.events_in_file = 0
+        # The file that is currently being written to
+        self.cur_filename = None
 
-        statemon.state.qsize = self.dataQ.qsize()
+        self._reported_qsize = 0
+        self._report_qsize()
 
         # Make sure the backup directory exists
-        if not os.path.exists(options.backup_disk):
-            os.makedirs(options.backup_disk)
+        if not os.path.exists(self.backup_dir):
+            os.makedirs(self.backup_dir)
 
     def __del__(self):
         if self.backup_stream is not None:
@@ -890,24 +1070,41 @@ class FileBackupHandler(threading.Thread):
 
     def _generate_log_filename(self):
         '''Create a new log filename.'''
-        return '%s_%s_clicklog.log' % (
+        return '%s_%s%s' % (
             time.strftime('%S%M%H%d%m%Y', time.gmtime()),
-            shortuuid.uuid())
+            shortuuid.uuid(),
+            BACKUP_FILE_SUFFIX)
+
+    def _report_qsize(self):
+        # Reported as a difference so that the total is correct when
+        # there are multiple worker processes.
+        qsize = self.dataQ.qsize()
+        statemon.state.increment('qsize', qsize - self._reported_qsize)
+        self._reported_qsize = qsize
 
     def _open_new_backup_file(self):
         '''Opens a new backup file and puts it on self.backup_stream.'''
-        if not os.path.exists(options.backup_disk):
-            os.makedirs(options.backup_disk)
-            
-        backup_file = \
-          open(os.path.join(options.backup_disk,
-                            self._generate_log_filename()),
-                            'wb')
+        if not os.path.exists(self.backup_dir):
+            os.makedirs(self.backup_dir)
+
+        # Mark the file as in use before it is created so that it
+        # is never replayed while we are writing to it.
+        self.cur_filename = os.path.join(self.backup_dir,
+                                         self._generate_log_filename())
+        backup_file = open(self.cur_filename, 'wb')
         self.backup_stream = TTransport.TFileObjectTransport(
             backup_file)
         self.protocol_writer = TCompactProtocol.TCompactProtocol(
             self.backup_stream)
 
+    def _close_backup_file(self):
+        '''Closes the current backup file so that it can be replayed.'''
+        self.backup_stream.close()
+        self.backup_stream = None
+        self.protocol_writer = None
+        self.events_in_file = 0
+        self.cur_filename = None
+
     def _prepare_backup_stream(self):
         '''Prepares the backup stream for writing to.
 
@@ -923,9 +1120,13 @@ class FileBackupHandler(threading.Thread):
 
         # Check to see if the file should be rolled over
         if self.events_in_file >= options.backup_max_events_per_file:
-            self.backup_stream.close()
+            self._close_backup_file()
             self._open_new_backup_file()
-            self.events_in_file = 0
+
+    def stop(self):
+        '''Writes all the queued events to disk and stops the thread.'''
+        self.dataQ.put(None)
+        self.join()
 
     def run(self):
         '''Main runner for the handler.'''
@@ -934,12 +1135,21 @@ class FileBackupHandler(threading.Thread):
                 try:
                     event = self.dataQ.get(True, 30)
                 except Queue.Empty:
+                    # Nothing is coming in, so close the file so
+                    # that the BacklogDrainer can replay it.
                     if self.backup_stream is not None:
-                        self.backup_stream.flush()
+                        self._close_backup_file()
                     continue
 
+                if event is None:
+                    # We were asked to stop
+                    if self.backup_stream is not None:
+                        self._close_backup_file()
+                    self.dataQ.task_done()
+                    return
+
                 with self.watcher.activate():
-                    statemon.state.qsize = self.dataQ.qsize()
+                    self._report_qsize()
                     self._prepare_backup_stream()
 
                     event.write(self.protocol_writer)
@@ -949,6 +1159,196 @@ class FileBackupHandler(threading.Thread):
 
             self.dataQ.task_done()
 
+class BacklogDrainer(object):
+    '''Replays the events backed up on disk to flume.
+
+    Runs periodically on the server's io_loop. Once flume has been
+    healthy for options.backlog_quiet_period, the files that the
+    FileBackupHandler is done with are streamed back to flume in
+    batches of options.backlog_batch_size, at no more than
+    options.backlog_max_rate events/s so that live traffic has
+    priority.
+
+    Progress through each file is checkpointed to a <file>.ckpt file,
+    so if flume goes down again, or the server restarts, we pick up
+    where we left off. Fully replayed files are deleted.
+
+    If drain_orphans is True, backup directories that no running
+    worker owns (e.g. left over from running with more workers) are
+    replayed as well.
+    '''
+    def __init__(self, flume_buffer, backup_handler, io_loop=None,
+                 drain_orphans=True):
+        self.flume_buffer = flume_buffer
+        self.backup_handler = backup_handler
+        self.drain_orphans = drain_orphans
+        self.timer = utils.sync.PeriodicCoroutineTimer(
+            self.drain,
+            options.backlog_drain_interval * 1000.,
+            io_loop)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    @tornado.gen.coroutine
+    def drain(self):
+        '''Replays as much of the backlog as possible.'''
+        self._update_backlog_stats()
+        if not self.flume_buffer.is_healthy(options.backlog_quiet_period):
+            return
+
+        # The file that is being written to cannot be replayed. It
+        # must be checked after listing the directory to avoid a race.
+        files = self._list_backup_files(self._get_drain_dirs())
+        cur_file = self.backup_handler.cur_filename
+        for path in files:
+            if path == cur_file:
+                continue
+            finished = yield self._replay_file(path)
+            self._update_backlog_stats()
+            if not finished:
+                return
+
+    def _get_all_dirs(self):
+        '''Returns all the directories that could hold backup files.'''
+        dirs = [options.backup_disk]
+        try:
+            dirs.extend([os.path.join(options.backup_disk, x) for x in
+                         sorted(os.listdir(options.backup_disk))])
+        except OSError as e:
+            _log.error('Could not list the backup directory %s: %s' %
+                       (options.backup_disk, e))
+        return [x for x in dirs if os.path.isdir(x)]
+
+    def _get_drain_dirs(self):
+        '''Returns the directories this drainer is responsible for.'''
+        own_dir = self.backup_handler.backup_dir
+        if not self.drain_orphans:
+            return [own_dir]
+        if options.workers > 1:
+            live_dirs = set([worker_backup_dir(i) for i in
+                             range(options.workers)])
+        else:
+            live_dirs = set()
+        return [own_dir] + [x for x in self._get_all_dirs()
+                            if x != own_dir and x not in live_dirs]
+
+    def _list_backup_files(self, dirs):
+        '''Returns the backup files in a list of directories, oldest first.'''
+        files = []
+        for directory in dirs:
+            try:
+                files.extend([os.path.join(directory, x) for x in
+                              os.listdir(directory)
+                              if x.endswith(BACKUP_FILE_SUFFIX)])
+            except OSError as e:
+                _log.error('Could not list the backup directory %s: %s' %
+                           (directory, e))
+        mtimes = []
+        for path in files:
+            try:
+                mtimes.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # The file was removed in the meantime
+                pass
+        return [path for mtime, path in sorted(mtimes)]
+
+    def _update_backlog_stats(self):
+        # The stats cover the whole backup disk so that they are
+        # consistent when there are multiple worker processes.
+        files = self._list_backup_files(self._get_all_dirs())
+        backlog_bytes = 0
+        for path in files:
+            try:
+                backlog_bytes += (os.stat(path).st_size -
+                                  self._read_checkpoint(path))
+            except OSError:
+                # The file was removed in the meantime
+                pass
+        statemon.state.backlog_files = len(files)
+        statemon.state.backlog_bytes = backlog_bytes
+
+    def _read_checkpoint(self, path):
+        '''Returns the offset in the file to start replaying from.'''
+        try:
+            with open(path + CHECKPOINT_SUFFIX) as f:
+                return int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, path, offset):
+        tmp_path = path + CHECKPOINT_SUFFIX + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+        os.rename(tmp_path, path + CHECKPOINT_SUFFIX)
+
+    def _read_events(self, stream, protocol, max_events):
+        '''Reads a batch of events from the backup file.
+
+        Returns (events, offset in the file after the last complete
+        event, True if the end of the file was reached)
+        '''
+        events = []
+        offset = stream.tell()
+        try:
+            while len(events) < max_events:
+                event = ThriftFlumeEvent()
+                event.read(protocol)
+                if not event.headers:
+                    return events, offset, True
+                events.append(event)
+                offset = stream.tell()
+        except EOFError:
+            # Either the end of the file or a truncated event
+            return events, offset, True
+        return events, offset, False
+
+    @tornado.gen.coroutine
+    def _replay_file(self, path):
+        '''Replays a single backup file to flume.
+
+        Returns True if the file was fully replayed and removed.
+        '''
+        _log.info('Replaying backed up events in %s' % path)
+        with open(path, 'rb') as stream:
+            stream.seek(self._read_checkpoint(path))
+            protocol = TCompactProtocol.TCompactProtocol(
+                TTransport.TFileObjectTransport(stream))
+            at_end = False
+            while not at_end:
+                events, offset, at_end = self._read_events(
+                    stream, protocol, options.backlog_batch_size)
+                if len(events) == 0:
+                    break
+
+                start_time = time.time()
+                try:
+                    yield self.flume_buffer.append_batch(events)
+                except (Thrift.TException, IOError) as e:
+                    _log.error('Error replaying backed up events to '
+                               'Flume: %s' % e)
+                    statemon.state.increment('backlog_replay_errors')
+                    self.flume_buffer.last_error_time = time.time()
+                    raise tornado.gen.Return(False)
+                self._write_checkpoint(path, offset)
+                statemon.state.increment('backlog_events_replayed',
+                                         len(events))
+
+                # Throttle so that we don't starve the live traffic
+                yield tornado.gen.sleep(max(
+                    0.0,
+                    len(events) / options.backlog_max_rate -
+                    (time.time() - start_time)))
+
+        _log.info('Finished replaying %s. Deleting the file' % path)
+        os.remove(path)
+        if os.path.exists(path + CHECKPOINT_SUFFIX):
+            os.remove(path + CHECKPOINT_SUFFIX)
+        raise tornado.gen.Return(True)
+
 class HealthCheckHandler(TrackerDataHandler):
     '''Handler for health check ''' 
 
@@ -995,18 +1395,23 @@ class Server(threading.Thread):
 
     Or just call run() directly to have it startup and block.
     '''
-    def __init__(self, watcher=utils.ps.ActivityWatcher()):
+    def __init__(self, watcher=utils.ps.ActivityWatcher(), worker_id=None):
         '''Create the server. 
 
         Inputs:
         
         watcher - Optional synchronization object that can be used to
         know when the server is active.
+        worker_id - Index of this worker if running multiple worker
+                    processes, or None if this is the only process.
         
         '''
         super(Server, self).__init__()
+        self.worker_id = worker_id
         self.backup_queue = Queue.Queue()
-        self.backup_handler = FileBackupHandler(self.backup_queue, watcher)
+        self.backup_handler = FileBackupHandler(
+            self.backup_queue, watcher,
+            backup_dir=worker_backup_dir(worker_id))
         self.io_loop = tornado.ioloop.IOLoop()
         self._is_running = threading.Event()
         self._watcher = watcher
@@ -1018,8 +1423,16 @@ class Server(threading.Thread):
         schema_hash = hashlib.md5(schema_str).hexdigest()
         schema_url = ('http://%s.s3.amazonaws.com/%s.avsc' % 
                       (options.schema_bucket, schema_hash))
-        avro_writer = avro.io.DatumWriter(schema)
+        avro_writer = BaseTrackerDataV2.get_avro_writer(schema)
         self.flume_buffer = FlumeBuffer(options.flume_port, self.backup_queue)
+        if options.known_agents_file:
+            BaseTrackerDataV2.agent_cache.seed_from_file(
+                options.known_agents_file)
+        self.backlog_drainer = BacklogDrainer(
+            self.flume_buffer,
+            self.backup_handler,
+            self.io_loop,
+            drain_orphans=(worker_id is None or worker_id == 0))
 
         # Make sure that the schema exists at a URL that can be reached
         response = utils.http.send_request(
@@ -1049,9 +1462,10 @@ class Server(threading.Thread):
             ])
 
     def run(self):
-        statemon.state.flume_errors = 0
-        statemon.state.messages_handled = 0
-        statemon.state.invalid_messages = 0
+        if self.worker_id is None:
+            # With multiple workers, the counters are shared, so they
+            # are reset by the parent process.
+            reset_counters()
         
         with self._watcher.activate():
             self.backup_handler.start()
@@ -1061,15 +1475,21 @@ class Server(threading.Thread):
                                                    io_loop=self.io_loop,
                                                    xheaders=True)
             utils.ps.register_tornado_shutdown(server)
-            server.listen(options.port)
-        
+            if self.worker_id is None:
+                server.listen(options.port)
+            else:
+                server.add_sockets([bind_reuseport_socket(options.port)])
+            self.backlog_drainer.start()
 
             self._is_running.set()
         self.io_loop.start()
         server.stop()
+        self.backlog_drainer.stop()
 
-        # Flush any extra events in the buffer
+        # Flush any extra events in the buffer and make sure that
+        # anything that couldn't go to flume is on disk.
         self.flume_buffer.flush()
+        self.backup_handler.stop()
 
     @tornado.gen.engine
     def wait_until_running(self):
@@ -1085,8 +1505,76 @@ class Server(threading.Thread):
         '''Stops the server'''
         self.io_loop.stop()
 
+class TrackerWorker(multiprocessing.Process):
+    '''A worker process that runs a Server on the shared port.
+
+    Each worker has its own FlumeBuffer and backup queue. The statemon
+    variables are in shared memory, so the totals are aggregated
+    across the workers.
+    '''
+    def __init__(self, worker_id):
+        super(TrackerWorker, self).__init__()
+        self.worker_id = worker_id
+
+    def run(self):
+        # Don't use the parent's signal handlers. The Server registers
+        # its own to shutdown gracefully.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        server = Server(worker_id=self.worker_id)
+        server.run()
+
+def reset_counters():
+    statemon.state.flume_errors = 0
+    statemon.state.messages_handled = 0
+    statemon.state.invalid_messages = 0
+
+def run_workers(n_workers):
+    '''Runs n_workers worker processes until SIGTERM or SIGINT.
+
+    Workers that die are restarted. On shutdown, each worker is asked
+    to drain gracefully and is killed if it takes longer than
+    options.worker_shutdown_timeout.
+    '''
+    reset_counters()
+
+    shutting_down = threading.Event()
+    def _handle_signal(sig, frame):
+        _log.info('Received signal %s. Shutting down the workers' % sig)
+        shutting_down.set()
+    signal.signal(signal.SIGTERM, _handle_signal)
+    signal.signal(signal.SIGINT, _handle_signal)
+
+    workers = {}
+    while not shutting_down.is_set():
+        for worker_id in range(n_workers):
+            worker = workers.get(worker_id)
+            if worker is not None and worker.is_alive():
+                continue
+            if worker is not None:
+                _log.error('Worker %i exited with code %s. Restarting it' %
+                           (worker_id, worker.exitcode))
+            worker = TrackerWorker(worker_id)
+            worker.start()
+            workers[worker_id] = worker
+        shutting_down.wait(1.0)
+
+    # Ask the workers to drain and wait for them
+    for worker in workers.itervalues():
+        if worker.is_alive():
+            os.kill(worker.pid, signal.SIGTERM)
+    for worker in workers.itervalues():
+        worker.join(options.worker_shutdown_timeout)
+        if worker.is_alive():
+            _log.error('Worker %i did not shutdown. Killing it' %
+                       worker.worker_id)
+            utils.ps.send_signal_and_wait(signal.SIGKILL, [worker.pid])
+
 def main(watcher=utils.ps.ActivityWatcher()):
     '''Main function that runs the server.'''
+    if options.workers > 1:
+        run_workers(options.workers)
+        return
     with watcher.activate():
         server = Server(watcher)
     server.run()
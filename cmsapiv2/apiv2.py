@@ -9,6 +9,7 @@ if sys.path[0] != __base_path__:
 import ast
 import boto
 from cmsdb import neondata
+from collections import OrderedDict
 import concurrent.futures
 from datetime import datetime, timedelta
 import dateutil.parser
@@ -16,9 +17,11 @@ from functools import wraps
 import json
 import jwt
 import logging
+import operator
 import re
 import signal
 import sre_constants
+import time
 import stripe
 import tornado.httpserver
 import tornado.ioloop
@@ -26,6 +29,7 @@ import tornado.web
 import tornado.escape
 import tornado.gen
 import tornado.httpclient
+import tornado.locks
 import traceback
 from urlparse import urlparse
 
@@ -102,6 +106,307 @@ define("mandrill_base_url",
 define("stripe_api_key",
     default=None,
     help='The API key we use to talk to stripe.')
+define("account_limit_sync_interval",
+    default=0.0,
+    help=("If > 0, account limits are counted in memory and synced to "
+          "the database in batches this often in seconds. If 0, the "
+          "database is read and written on every limited request."),
+    type=float)
+
+define("auth_cache_ttl",
+    default=0.0,
+    help=("Seconds to cache decoded access tokens, accounts and users used "
+          "to authorize requests. 0 disables the cache."),
+    type=float)
+define("auth_cache_size",
+    default=10000,
+    help="Maximum number of entries in the authorization cache",
+    type=int)
+
+statemon.define('account_limit_syncs', int)
+statemon.define('account_limit_sync_errors', int)
+statemon.define('auth_cache_hits', int)
+_auth_cache_hits_ref = statemon.state.get_ref('auth_cache_hits')
+statemon.define('auth_cache_misses', int)
+_auth_cache_misses_ref = statemon.state.get_ref('auth_cache_misses')
+statemon.define('auth_cache_hit_ratio', float)
+
+# Maps the operators allowed in get_limits() to functions
+LIMIT_OPERATORS = {
+    '<' : operator.lt,
+    '>' : operator.gt,
+    '<=' : operator.le,
+    '>=' : operator.ge,
+    '=' : operator.eq,
+    '==' : operator.eq
+}
+
+class Limit(object):
+    '''A limit definition from get_limits() that is ready to be checked.'''
+    def __init__(self, limit):
+        self.left_arg = limit['left_arg']
+        self.right_arg = limit['right_arg']
+        self.op = LIMIT_OPERATORS[limit['operator']]
+        timer_info = limit.get('timer_info') or {}
+        self.refresh_time_key = timer_info.get('refresh_time')
+        self.add_to_refresh_time_key = timer_info.get('add_to_refresh_time')
+        self.timer_resets = timer_info.get('timer_resets') or []
+
+    def is_ok(self, data):
+        '''Returns True if the limit is not exceeded for the data dict.'''
+        return self.op(data[self.left_arg], data[self.right_arg])
+
+    def timer_expired(self, data):
+        if self.refresh_time_key is None:
+            return False
+        return (dateutil.parser.parse(data[self.refresh_time_key]) <=
+                datetime.utcnow())
+
+    def get_timer_resets(self, data):
+        '''Returns a dictionary of field -> value to reset the timer.'''
+        rv = dict(self.timer_resets)
+        if self.refresh_time_key is not None:
+            rv[self.refresh_time_key] = (datetime.utcnow() + timedelta(
+                seconds=data[self.add_to_refresh_time_key])).strftime(
+                    "%Y-%m-%d %H:%M:%S.%f")
+        return rv
+
+class AccountLimitCounter(object):
+    '''Keeps the account limit counters for this process in memory.
+
+    The AccountLimits are read from the database the first time they are
+    needed. Increments and timer resets are applied locally and written
+    to the database for all the accounts in one modify_many every
+    account_limit_sync_interval seconds. After a sync, the local copy
+    is replaced by the database copy so that the requests made to other
+    processes are counted. Changes that are being written are still
+    counted until the write returns.
+    '''
+    def __init__(self):
+        # account_id -> AccountLimits as last seen in the database
+        self._limits = {}
+        # account_id -> {field -> value} to set in the database
+        self._resets = {}
+        # account_id -> {field -> amount} to add in the database
+        self._deltas = {}
+        # (resets, deltas) that are being written to the database
+        self._in_flight = None
+        self._flush_lock = tornado.locks.Lock()
+        self._flush_timer = None
+
+    @tornado.gen.coroutine
+    def get(self, account_id):
+        '''Returns (AccountLimits, data dict) with the local changes
+        applied or (None, None) if the account has no limits.'''
+        limits = self._limits.get(account_id)
+        if limits is None:
+            limits = yield neondata.AccountLimits.get(account_id,
+                                                      async=True,
+                                                      log_missing=False)
+            if limits is None:
+                raise tornado.gen.Return((None, None))
+            self._limits[account_id] = limits
+            self._schedule_flush()
+
+        data = dict(limits.to_dict()['_data'])
+        changes = [(self._resets, self._deltas)]
+        if self._in_flight is not None:
+            changes.insert(0, self._in_flight)
+        for resets, deltas in changes:
+            data.update(resets.get(account_id, {}))
+            for field, amount in deltas.get(account_id, {}).iteritems():
+                data[field] += amount
+        raise tornado.gen.Return((limits, data))
+
+    def reset(self, account_id, values):
+        '''Sets fields for an account, like when a timer expires.'''
+        self._resets.setdefault(account_id, {}).update(values)
+        deltas = self._deltas.get(account_id, {})
+        for field in values:
+            deltas.pop(field, None)
+        self._schedule_flush()
+
+    def add(self, account_id, changes):
+        '''Adds to the counters for an account.
+
+        changes - List of (field, amount)
+        '''
+        deltas = self._deltas.setdefault(account_id, {})
+        for field, amount in changes:
+            deltas[field] = deltas.get(field, 0) + amount
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_timer is None:
+            self._flush_timer = tornado.ioloop.IOLoop.current().call_later(
+                options.account_limit_sync_interval, self._timed_flush)
+
+    @tornado.gen.coroutine
+    def _timed_flush(self):
+        self._flush_timer = None
+        yield self.flush()
+
+    @tornado.gen.coroutine
+    def flush(self):
+        '''Writes the local changes to the database.'''
+        with (yield self._flush_lock.acquire()):
+            yield self._flush()
+
+    @tornado.gen.coroutine
+    def _flush(self):
+        resets, self._resets = self._resets, {}
+        deltas, self._deltas = self._deltas, {}
+        # Forget the accounts that didn't change so that they are read
+        # from the database again the next time they are needed.
+        self._limits = dict([(k, v) for k, v in self._limits.iteritems()
+                             if k in resets or k in deltas])
+        keys = list(set(resets.keys()) | set(deltas.keys()))
+        if len(keys) == 0:
+            return
+
+        def _modify_limits(limits_dict):
+            for key, al in limits_dict.iteritems():
+                if al is None:
+                    continue
+                for field, value in resets.get(key, {}).iteritems():
+                    al.__dict__[field] = value
+                for field, amount in deltas.get(key, {}).iteritems():
+                    al.__dict__[field] += amount
+
+        self._in_flight = (resets, deltas)
+        try:
+            updated = yield neondata.AccountLimits.modify_many(
+                keys, _modify_limits, async=True)
+            statemon.state.increment('account_limit_syncs')
+        except Exception as e:
+            _log.error('Error syncing account limits: %s' % e)
+            statemon.state.increment('account_limit_sync_errors')
+            # Put the changes back so they are written next time. Fields
+            # that were reset since then don't need the old counts.
+            for key, values in deltas.iteritems():
+                new_resets = self._resets.get(key, {})
+                self.add(key, [(field, amount) for field, amount in
+                               values.iteritems()
+                               if field not in new_resets])
+            for key, values in resets.iteritems():
+                merged = values.copy()
+                merged.update(self._resets.get(key, {}))
+                self._resets[key] = merged
+            self._schedule_flush()
+            return
+        finally:
+            self._in_flight = None
+
+        for key, al in updated.iteritems():
+            if al is None:
+                self._limits.pop(key, None)
+            else:
+                self._limits[key] = al
+        if len(self._resets) > 0 or len(self._deltas) > 0:
+            self._schedule_flush()
+
+account_limit_counter = AccountLimitCounter()
+
+class AuthCache(object):
+    '''Short lived cache of what is needed to authorize a request.
+
+    Holds decoded access tokens, NeonUserAccount objects and User
+    objects for up to auth_cache_ttl seconds, evicting the least
+    recently used entries once there are auth_cache_size of them.
+    Entries are dropped when the object changes in the database (see
+    subscribe_to_changes) so the TTL only bounds how stale an entry can
+    be if a notification is missed.
+    '''
+    def __init__(self):
+        # (type, key) -> (expiry time, value)
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._lookups = 0
+
+    def decode_token(self, access_token):
+        '''Returns the payload of a valid access token.
+
+        Raises the jwt exceptions if the token isn't valid.
+        '''
+        payload = self._get(('token', access_token))
+        if payload is None:
+            payload = JWTHelper.decode_token(access_token)
+            self._set(('token', access_token), payload,
+                      payload.get('exp'))
+        return payload
+
+    @tornado.gen.coroutine
+    def get_account(self, account_id):
+        account = self._get(('account', account_id))
+        if account is None:
+            account = yield neondata.NeonUserAccount.get(account_id,
+                                                         async=True)
+            if account is not None:
+                self._set(('account', account_id), account)
+        raise tornado.gen.Return(account)
+
+    @tornado.gen.coroutine
+    def get_user(self, username):
+        user = self._get(('user', username))
+        if user is None:
+            user = yield neondata.User.get(username, async=True)
+            if user is not None:
+                self._set(('user', username), user)
+        raise tornado.gen.Return(user)
+
+    def invalidate_account(self, account_id):
+        self._entries.pop(('account', account_id), None)
+
+    def invalidate_user(self, username):
+        self._entries.pop(('user', username), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    @tornado.gen.coroutine
+    def subscribe_to_changes(self):
+        '''Drops accounts and users from the cache when they change.'''
+        # On a delete, there is no object, so the key is the full
+        # database key instead of the id.
+        yield neondata.NeonUserAccount.subscribe_to_changes(
+            lambda key, obj, op: self.invalidate_account(
+                neondata.NeonUserAccount.key2id(key)),
+            async=True)
+        yield neondata.User.subscribe_to_changes(
+            lambda key, obj, op: self.invalidate_user(
+                neondata.User.key2id(key)),
+            async=True)
+
+    def _get(self, key):
+        if options.auth_cache_ttl <= 0:
+            return None
+        self._lookups += 1
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0] > time.time():
+            # Move the entry to the most recently used end
+            self._entries[key] = entry
+            self._hits += 1
+            statemon.state.increment(ref=_auth_cache_hits_ref, safe=False)
+            value = entry[1]
+        else:
+            statemon.state.increment(ref=_auth_cache_misses_ref, safe=False)
+            value = None
+        statemon.state.auth_cache_hit_ratio = (float(self._hits) /
+                                               self._lookups)
+        return value
+
+    def _set(self, key, value, expiry=None):
+        if options.auth_cache_ttl <= 0:
+            return
+        ttl_expiry = time.time() + options.auth_cache_ttl
+        if expiry is None or expiry > ttl_expiry:
+            expiry = ttl_expiry
+        self._entries.pop(key, None)
+        self._entries[key] = (expiry, value)
+        while len(self._entries) > options.auth_cache_size:
+            self._entries.popitem(last=False)
+
+auth_cache = AuthCache()
 
 class TokenTypes(object):
     ACCESS_TOKEN = 0
@@ -127,6 +432,9 @@ class APIV2Sender(object):
         self.finish()
 
 class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
+    # (handler class, limits function name) -> {http verb : [Limit]}
+    _compiled_limits = {}
+
     def initialize(self, **kwargs):
         # stripe stuff
         stripe.api_key = options.stripe_api_key
@@ -213,9 +521,7 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
     def set_account(self):
         self.set_account_id()
         if self.account_id:
-            account = yield neondata.NeonUserAccount.get(
-                          self.account_id,
-                          async=True)
+            account = yield auth_cache.get_account(self.account_id)
             self.account = account
 
     @tornado.gen.coroutine
@@ -246,11 +552,11 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
             raise NotAuthorizedError('account does not exist')
 
         try:
-            payload = JWTHelper.decode_token(access_token)
+            payload = auth_cache.decode_token(access_token)
             username = payload.get('username')
 
             if username:
-                user = yield neondata.User.get(username, async=True)
+                user = yield auth_cache.get_user(username)
                 if user:
                     self.user = user
 
@@ -365,6 +671,7 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
                 acct.neon_api_key,
                 _modify_account,
                 async=True)
+            auth_cache.invalidate_account(acct.neon_api_key)
 
         if acct_subscription_status in [ neondata.SubscriptionState.ACTIVE,
                neondata.SubscriptionState.IN_TRIAL ]:
@@ -372,6 +679,38 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
 
         raise TooManyRequestsError('Your subscription is not valid')
 
+    def get_compiled_limits(self, get_limits_func):
+        '''Returns {http verb : [Limit]} for a limits function like
+           get_limits or get_limits_after_prepare, or None if it does
+           not define any limits.
+
+           The Limit objects are built the first time the function is
+           used by each handler class and reused after that, so the
+           fields that are checked must not change between requests.
+           values_to_increase and values_to_decrease are not part of a
+           Limit and are still read on every request.
+        '''
+        key = (self.__class__, get_limits_func.__name__)
+        try:
+            return APIV2Handler._compiled_limits[key]
+        except KeyError:
+            pass
+
+        limits_dict = get_limits_func()
+        compiled = None
+        if limits_dict is not None:
+            compiled = {}
+            for verb, limit_defs in limits_dict.iteritems():
+                compiled[verb] = []
+                for limit_def in limit_defs:
+                    try:
+                        compiled[verb].append(Limit(limit_def))
+                    except KeyError as e:
+                        _log.warning('Limit issue %s was encountered when '
+                                     'building limits - skipping' % e)
+        APIV2Handler._compiled_limits[key] = compiled
+        return compiled
+
     @tornado.gen.coroutine
     def check_account_limits(self, limit_list):
         ''' responsible for checking account limits
@@ -379,6 +718,9 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
             this is called in prepare, and that pulls this info
              from the get_limits functions in the children
 
+            limit_list is a list of Limit objects, see
+             get_compiled_limits
+
             it checks the defined limits to see if any of them
                are exceeded. it will also reset the timer if
                that is necessary.
@@ -387,11 +729,16 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
         if self.account is None:
             raise tornado.gen.Return(True)
 
-        # grab the account_limit object for the requests
-        acct_limits = yield neondata.AccountLimits.get(
-                          self.account_id,
-                          async=True,
-                          log_missing=False)
+        if options.account_limit_sync_interval > 0:
+            acct_limits, al_data_dict = yield account_limit_counter.get(
+                self.account_id)
+        else:
+            acct_limits = yield neondata.AccountLimits.get(
+                              self.account_id,
+                              async=True,
+                              log_missing=False)
+            al_data_dict = (acct_limits.to_dict()['_data'] if
+                            acct_limits is not None else None)
 
         # limits are not set up for this account, let it
         # slide for now
@@ -399,60 +746,42 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
             raise tornado.gen.Return(True)
 
         self.account_limits = acct_limits
-        al_data_dict = acct_limits.to_dict()['_data']
         for limit in limit_list:
             try:
-                left_arg = al_data_dict[limit['left_arg']]
-                right_arg = al_data_dict[limit['right_arg']]
-                operator = limit['operator']
+                if limit.is_ok(al_data_dict):
+                    continue
+
+                # lets check the timer if there is one
+                if limit.timer_expired(al_data_dict):
+                    resets = limit.get_timer_resets(al_data_dict)
+                    if options.account_limit_sync_interval > 0:
+                        account_limit_counter.reset(self.account_id,
+                                                     resets)
+                    else:
+                        self.account_limits = yield \
+                            self._reset_rate_limit(self.account_id, resets)
+                    al_data_dict.update(resets)
+                    continue
 
-                eval_string = '%s %s %s' % (left_arg, operator, right_arg)
-                if eval(eval_string):
-                    return
-                else:
-                    # lets check the timer if there is one
-                    timer_dict = self._get_timer_dict(limit, al_data_dict)
-                    if timer_dict:
-                        refresh_time = timer_dict['refresh_time']
-                        # check to see if we should refresh
-                        if dateutil.parser.parse(refresh_time) <= \
-                                datetime.utcnow():
-                            self.account_limits = yield \
-                                self._reset_rate_limit(
-                                      self.account_id,
-                                      timer_dict['timer_resets'],
-                                      limit['timer_info']['refresh_time'],
-                                      timer_dict['add_to_refresh_time'])
-                            return
-
-                    msg = 'The max amount of requests have been reached for \
-                           this endpoint. For more rate limit information \
-                           please see the account/limits endpoint.'
-
-                    raise TooManyRequestsError(msg)
+                msg = 'The max amount of requests have been reached for \
+                       this endpoint. For more rate limit information \
+                       please see the account/limits endpoint.'
+
+                raise TooManyRequestsError(msg)
             except KeyError as e:
                 _log.warning('Limit issue %s was encountered\
                               when checking limits - passing' % (e))
                 pass
-            raise tornado.gen.Return(True)
+        raise tornado.gen.Return(True)
 
     @staticmethod
     @tornado.gen.coroutine
-    def _reset_rate_limit(account_id,
-                          timer_resets,
-                          key_to_add_time_to=None,
-                          amount_of_time_to_add=0.0):
-        ''' reset everything in the timer_resets for this
-            rate limit '''
+    def _reset_rate_limit(account_id, values):
+        ''' reset everything in values, a dict of field -> value,
+            for this rate limit '''
         def _modify_me(x):
-            for tr in timer_resets:
-                x.__dict__[tr[0]] = tr[1]
-            if key_to_add_time_to:
-                new_date = (datetime.utcnow() +
-                            timedelta(seconds=amount_of_time_to_add)).strftime(
-                                "%Y-%m-%d %H:%M:%S.%f")
-
-                x.__dict__[key_to_add_time_to] = new_date
+            for field, value in values.iteritems():
+                x.__dict__[field] = value
 
         limit = yield neondata.AccountLimits.modify(
             account_id,
@@ -461,27 +790,6 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
 
         raise tornado.gen.Return(limit)
 
-    @staticmethod
-    def _get_timer_dict(limit_info, acct_limit):
-        ''' helper to get values from acct_limit based on the
-            key values in limit_info '''
-
-        rv = {}
-        try:
-            timer_info = limit_info['timer_info']
-            refresh_time_key = timer_info['refresh_time']
-            add_to_refresh_time_key = timer_info['add_to_refresh_time']
-            timer_resets = timer_info['timer_resets']
-
-            rv['refresh_time'] = acct_limit[refresh_time_key]
-            rv['add_to_refresh_time'] = acct_limit[add_to_refresh_time_key]
-            rv['timer_resets'] = timer_resets
-
-        except KeyError:
-            pass
-
-        return rv
-
     def get_access_levels(self):
         '''
             to be specified in each of the handlers
@@ -575,7 +883,7 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
         except KeyError:
             raise NotImplementedError('access levels are not defined')
 
-        limits_dict = self.get_limits()
+        limits_dict = self.get_compiled_limits(self.get_limits)
         if limits_dict is not None:
             try:
                 yield self.check_account_limits(
@@ -614,24 +922,27 @@ class APIV2Handler(tornado.web.RequestHandler, APIV2Sender):
             if defined_limits_dict is None: 
                 return  
 
-        def _modify_limits(al): 
-            try: 
-                defined_limit_list = defined_limits_dict[self.request.method]
-                
-                for dl in defined_limit_list:
-                    values_to_increase = dl['values_to_increase']
-                    values_to_decrease = dl['values_to_decrease']
-                    for v in values_to_increase:
-                        al.__dict__[v[0]] += v[1]
-                    for v in values_to_decrease:
-                        al.__dict__[v[0]] -= v[1]
-            except KeyError: 
-                pass
- 
+        changes = []
+        try:
+            for dl in defined_limits_dict[self.request.method]:
+                changes.extend(dl['values_to_increase'] or [])
+                changes.extend([(field, -amount) for field, amount in
+                                dl['values_to_decrease'] or []])
+        except KeyError:
+            pass
+
+        if options.account_limit_sync_interval > 0:
+            account_limit_counter.add(self.account_limits.key, changes)
+            return
+
+        def _modify_limits(al):
+            for field, amount in changes:
+                al.__dict__[field] += amount
+
         self.account_limits = yield neondata.AccountLimits.modify(
-            self.account_limits.key, 
-            _modify_limits, 
-            async=True) 
+            self.account_limits.key,
+            _modify_limits,
+            async=True)
 
     def write_error(self, status_code, **kwargs):
         def get_exc_message(exception):
@@ -26,6 +26,7 @@ import fractions
 import logging
 import model
 import utils.autoscale
+import utils.ps
 import video_processor.video_processing_queue
 _log = logging.getLogger(__name__)
 
@@ -2357,7 +2358,8 @@ class VideoHandler(ShareableContentHandler):
         else:
             try:
                 yield self.check_account_limits(
-                    self.get_limits_after_prepare()[HTTPVerbs.POST])
+                    self.get_compiled_limits(
+                        self.get_limits_after_prepare)[HTTPVerbs.POST])
             except KeyError:
                 pass
 
@@ -4221,12 +4223,19 @@ application = tornado.web.Application([
 
 def main():
     global server
-    signal.signal(signal.SIGTERM, lambda sig, y: sys.exit(-sig))
+
+    if options.auth_cache_ttl > 0:
+        tornado.ioloop.IOLoop.current().run_sync(
+            auth_cache.subscribe_to_changes)
 
     server = tornado.httpserver.HTTPServer(application)
     server.listen(options.port)
+    utils.ps.register_tornado_shutdown(server)
     tornado.ioloop.IOLoop.current().start()
 
+    # Write the account limits counted since the last sync
+    tornado.ioloop.IOLoop.current().run_sync(account_limit_counter.flush)
+
 if __name__ == "__main__":
     utils.neon.InitNeon()
     main()
@@ -267,6 +267,208 @@ class TestAPIV2(test_utils.neontest.AsyncHTTPTestCase):
         handler.write_error(500, exc_info=exc_info)
         handler.error.assert_called_with('filename ignored', code=401)
 
+class TestAuthCache(test_utils.neontest.AsyncTestCase):
+    def setUp(self):
+        super(TestAuthCache, self).setUp()
+        self.cache = AuthCache()
+        self.user_get_mocker = patch('cmsapiv2.apiv2.neondata.User.get')
+        self.user_get_mock = self._future_wrap_mock(
+            self.user_get_mocker.start(), require_async_kw=True)
+        self.user_get_mock.side_effect = lambda username: \
+            neondata.User(username)
+
+    def tearDown(self):
+        self.user_get_mocker.stop()
+        super(TestAuthCache, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_disabled(self):
+        with options._set_bounded('cmsapiv2.apiv2.auth_cache_ttl', 0):
+            yield self.cache.get_user('a@a.com')
+            yield self.cache.get_user('a@a.com')
+        self.assertEquals(self.user_get_mock.call_count, 2)
+
+    @tornado.testing.gen_test
+    def test_cached_until_invalidated(self):
+        with options._set_bounded('cmsapiv2.apiv2.auth_cache_ttl', 60):
+            user1 = yield self.cache.get_user('a@a.com')
+            user2 = yield self.cache.get_user('a@a.com')
+            self.assertIs(user1, user2)
+            self.assertEquals(self.user_get_mock.call_count, 1)
+
+            self.cache.invalidate_user('a@a.com')
+            user3 = yield self.cache.get_user('a@a.com')
+            self.assertIsNot(user1, user3)
+            self.assertEquals(self.user_get_mock.call_count, 2)
+
+    @tornado.testing.gen_test
+    def test_size_bound(self):
+        with options._set_bounded('cmsapiv2.apiv2.auth_cache_ttl', 60):
+            with options._set_bounded('cmsapiv2.apiv2.auth_cache_size', 2):
+                yield self.cache.get_user('a@a.com')
+                yield self.cache.get_user('b@a.com')
+                yield self.cache.get_user('c@a.com')
+                yield self.cache.get_user('a@a.com')
+        self.assertEquals(self.user_get_mock.call_count, 4)
+
+    @tornado.testing.gen_test
+    def test_deleted_objects_invalidated(self):
+        callbacks = {}
+        def _subscribe(cls):
+            def _save_callback(func):
+                callbacks[cls] = func
+            return _save_callback
+        with patch('cmsapiv2.apiv2.neondata.NeonUserAccount.'
+                   'subscribe_to_changes') as account_sub_mock, \
+             patch('cmsapiv2.apiv2.neondata.User.subscribe_to_changes') \
+             as user_sub_mock:
+            self._future_wrap_mock(account_sub_mock).side_effect = \
+              _subscribe('account')
+            self._future_wrap_mock(user_sub_mock).side_effect = \
+              _subscribe('user')
+            yield self.cache.subscribe_to_changes()
+
+        with options._set_bounded('cmsapiv2.apiv2.auth_cache_ttl', 60):
+            self.cache._set(('account', 'acct1'), MagicMock())
+            yield self.cache.get_user('a@a.com')
+
+            # On a delete, the callback gets the full key
+            callbacks['account']('neonuseraccount_acct1', None, 'DELETE')
+            callbacks['user']('users_a@a.com', None, 'DELETE')
+
+            self.assertIsNone(self.cache._get(('account', 'acct1')))
+            self.assertIsNone(self.cache._get(('user', 'a@a.com')))
+
+    def test_expired_token_not_served(self):
+        token = JWTHelper.generate_token({'username' : 'a@a.com'})
+        with options._set_bounded('cmsapiv2.apiv2.auth_cache_ttl', 60):
+            self.assertEquals(self.cache.decode_token(token)['username'],
+                              'a@a.com')
+            with patch('cmsapiv2.apiv2.time.time') as time_mock:
+                time_mock.return_value = (
+                    self.cache.decode_token(token)['exp'] + 1)
+                self.assertIsNone(self.cache._get(('token', token)))
+
+class TestAccountLimitCounter(test_utils.neontest.AsyncTestCase):
+    def setUp(self):
+        super(TestAccountLimitCounter, self).setUp()
+        self.get_mocker = patch('cmsapiv2.apiv2.neondata.AccountLimits.get')
+        self.get_mock = self._future_wrap_mock(self.get_mocker.start(),
+                                               require_async_kw=True)
+        self.get_mock.side_effect = lambda key, log_missing: \
+          neondata.AccountLimits(key, video_posts=3)
+        self.modify_mocker = patch(
+            'cmsapiv2.apiv2.neondata.AccountLimits.modify_many')
+        self.modify_mock = self.modify_mocker.start()
+        # Only flush when the test says so
+        self.interval_context = options._set_bounded(
+            'cmsapiv2.apiv2.account_limit_sync_interval', 3600)
+        self.interval_context.__enter__()
+        self.counter = AccountLimitCounter()
+
+    def tearDown(self):
+        if self.counter._flush_timer is not None:
+            self.io_loop.remove_timeout(self.counter._flush_timer)
+        self.interval_context.__exit__(None, None, None)
+        self.modify_mocker.stop()
+        self.get_mocker.stop()
+        super(TestAccountLimitCounter, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_in_flight_changes_counted(self):
+        write_future = tornado.concurrent.Future()
+        self.modify_mock.side_effect = \
+          lambda keys, func, async: write_future
+
+        yield self.counter.get('acct1')
+        self.counter.add('acct1', [('video_posts', 2)])
+        flush_future = self.counter.flush()
+        yield tornado.gen.moment
+
+        # The write hasn't returned, so the counts are still local
+        self.counter.add('acct1', [('video_posts', 1)])
+        _, data = yield self.counter.get('acct1')
+        self.assertEquals(data['video_posts'], 6)
+
+        write_future.set_result(
+            {'acct1' : neondata.AccountLimits('acct1', video_posts=5)})
+        yield flush_future
+        _, data = yield self.counter.get('acct1')
+        self.assertEquals(data['video_posts'], 6)
+
+    @tornado.testing.gen_test
+    def test_failed_write_is_retried(self):
+        self.modify_mock.side_effect = Exception('db down')
+
+        yield self.counter.get('acct1')
+        self.counter.add('acct1', [('video_posts', 2)])
+        with self.assertLogExists(logging.ERROR, 'Error syncing'):
+            yield self.counter.flush()
+
+        _, data = yield self.counter.get('acct1')
+        self.assertEquals(data['video_posts'], 5)
+
+class TestCompiledLimits(test_utils.neontest.TestCase):
+    def setUp(self):
+        super(TestCompiledLimits, self).setUp()
+        self.cache_patcher = patch.dict(APIV2Handler._compiled_limits,
+                                        clear=True)
+        self.cache_patcher.start()
+
+    def tearDown(self):
+        self.cache_patcher.stop()
+        super(TestCompiledLimits, self).tearDown()
+
+    def _handler(self, handler_class):
+        # The limits only depend on the class, so no request is needed
+        return handler_class.__new__(handler_class)
+
+    def test_built_once_per_class(self):
+        handler = self._handler(controllers.EmailHandler)
+        calls = []
+        def get_limits():
+            calls.append(1)
+            return handler.get_limits()
+
+        limits = handler.get_compiled_limits(get_limits)
+        other = self._handler(controllers.EmailHandler)
+        self.assertIs(other.get_compiled_limits(get_limits), limits)
+        self.assertIs(other.get_compiled_limits(other.get_limits), limits)
+        self.assertEquals(len(calls), 1)
+
+        limit = limits[HTTPVerbs.POST][0]
+        self.assertIsInstance(limit, Limit)
+        self.assertTrue(limit.is_ok({'email_posts' : 1,
+                                     'max_email_posts' : 2}))
+        self.assertFalse(limit.is_ok({'email_posts' : 2,
+                                      'max_email_posts' : 2}))
+
+    def test_separate_functions_and_classes(self):
+        video = self._handler(controllers.VideoHandler)
+        email = self._handler(controllers.EmailHandler)
+
+        self.assertIsNone(video.get_compiled_limits(video.get_limits))
+        after_prepare = video.get_compiled_limits(
+            video.get_limits_after_prepare)
+        self.assertEquals(after_prepare[HTTPVerbs.POST][0].left_arg,
+                          'video_posts')
+        self.assertEquals(
+            email.get_compiled_limits(email.get_limits)[
+                HTTPVerbs.POST][0].left_arg,
+            'email_posts')
+
+    def test_bad_limit_skipped(self):
+        handler = self._handler(controllers.EmailHandler)
+        def get_limits():
+            return {HTTPVerbs.POST : [
+                {'left_arg' : 'email_posts',
+                 'right_arg' : 'max_email_posts',
+                 'operator' : '!!'}]}
+
+        with self.assertLogExists(logging.WARNING, 'Limit issue'):
+            limits = handler.get_compiled_limits(get_limits)
+        self.assertEquals(limits, {HTTPVerbs.POST : []})
+
 class TestAuthorizedControllerBase(TestControllersBase):
     def setUp(self):
         self.verify_account_mocker = patch(
@@ -2642,7 +2844,36 @@ class TestVideoHandler(TestControllersBase):
             neondata.InternalVideoID.generate(self.account_id_api_key,
                                               '1234ascs')))
         self.assertEquals(self.job_write_mock.call_count, 0)
-        
+
+    @tornado.testing.gen_test
+    def test_account_limit_counter_batches_writes(self):
+        limit = neondata.AccountLimits(self.account_id_api_key,
+            video_posts=3)
+        yield limit.save(async=True)
+        counter = AccountLimitCounter()
+
+        with options._set_bounded(
+                'cmsapiv2.apiv2.account_limit_sync_interval', 3600):
+            _, data = yield counter.get(self.account_id_api_key)
+            self.assertEquals(data['video_posts'], 3)
+
+            counter.add(self.account_id_api_key, [('video_posts', 1)])
+            counter.add(self.account_id_api_key, [('video_posts', 2)])
+            _, data = yield counter.get(self.account_id_api_key)
+            self.assertEquals(data['video_posts'], 6)
+            limit = yield neondata.AccountLimits.get(self.account_id_api_key,
+                                                     async=True)
+            self.assertEquals(limit.video_posts, 3)
+
+            counter.reset(self.account_id_api_key, {'video_posts' : 0})
+            counter.add(self.account_id_api_key, [('video_posts', 1)])
+            yield counter.flush()
+            tornado.ioloop.IOLoop.current().remove_timeout(
+                counter._flush_timer)
+
+        limit = yield neondata.AccountLimits.get(self.account_id_api_key,
+                                                 async=True)
+        self.assertEquals(limit.video_posts, 1)
 
     @tornado.testing.gen_test(timeout=600)
     def test_post_video_reprocess_doesnt_hit_limit(self):
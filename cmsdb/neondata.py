@@ -103,6 +103,13 @@ define("hash_type", default="dhash", type=str,
        help="Type of perceptual hash function to use. ahash, phash or dhash")
 define("hash_size", default=64, type=int,
        help="Size of the perceptual hash in bits")
+define("thumb_dedup_radius", default=0, type=int,
+       help=("If > 0, a new thumbnail whose perceptual hash is less than "
+             "this hamming distance from an existing thumbnail in the same "
+             "account reuses the hosted images of the existing one. "
+             "0 disables the check."))
+define("thumb_dedup_max_accounts", default=100, type=int,
+       help="Maximum number of accounts to keep phash indices in memory for")
 
 # Other parameters
 define('send_callbacks', default=1, help='If 1, callbacks are sent')
@@ -122,7 +129,8 @@ statemon.define('postgres_unknown_errors', int)
 statemon.define('postgres_connection_failed', int) 
 statemon.define('postgres_listeners', int) 
 statemon.define('postgres_successful_pubsub_callbacks', int) 
-statemon.define('postgres_pools', int) 
+statemon.define('postgres_pools', int)
+statemon.define('duplicate_thumbs_found', int) 
 statemon.define('postgres_pool_full', int)
 
 class ThumbDownloadError(IOError): pass
@@ -6197,6 +6205,17 @@ class ThumbnailMetadata(StoredObject):
         except Exception as e:
             _log.warn('Error generating dominant color key:%s %s', self.key, e)
 
+        if video_info is None:
+            video_info = yield VideoMetadata.get(self.video_id, async=True)
+
+        # If we already host a near duplicate of this image, point at
+        # its images instead of uploading new ones.
+        if options.thumb_dedup_radius > 0:
+            reused = yield self._reuse_duplicate_images(video_info,
+                                                        async=True)
+            if reused:
+                return
+
         # Host the primary copy of the image
         primary_hoster = cmsdb.cdnhosting.CDNHosting.create(
             PrimaryNeonHostingMetadata())
@@ -6214,8 +6233,6 @@ class ThumbnailMetadata(StoredObject):
             self.urls.insert(0, s3_url)
 
         # Host the image on the CDN
-        if video_info is None:
-            video_info = yield VideoMetadata.get(self.video_id, async=True)
         if cdn_metadata is None:
             cdn_metadata = yield CDNHostingMetadata.get_by_video(video_info)
 
@@ -6224,6 +6241,69 @@ class ThumbnailMetadata(StoredObject):
                         do_source_crop=self.do_source_crop,
                         do_smart_crop=self.do_smart_crop) for x in hosters]
 
+        if options.thumb_dedup_radius > 0:
+            ThumbnailPhashIndex.add(self)
+
+    @utils.sync.optional_sync
+    @tornado.gen.coroutine
+    def _reuse_duplicate_images(self, video_info):
+        '''Reuses the hosted images of a near duplicate thumbnail.
+
+        Looks for a thumbnail in the same account whose phash is within
+        options.thumb_dedup_radius of this one. If there is one, and
+        its video is in the same integration, so its images are on the
+        same CDNs, its primary url, serving urls and scores are copied
+        to this object.
+
+        Inputs:
+        video_info - VideoMetadata of the video this thumbnail is for
+
+        Returns True if the images were reused.
+        '''
+        if video_info is None:
+            # We don't know which CDNs the image should be on
+            raise tornado.gen.Return(False)
+
+        dup_id = yield ThumbnailPhashIndex.find_duplicate(
+            self.get_account_id(), self.phash, options.thumb_dedup_radius)
+        if dup_id is None:
+            raise tornado.gen.Return(False)
+
+        dup, dup_urls = yield [
+            ThumbnailMetadata.get(dup_id, async=True),
+            ThumbnailServingURLs.get(dup_id, async=True)]
+        if (dup is None or len(dup.urls) == 0 or not dup_urls or
+            getattr(dup, 'do_source_crop', False) != self.do_source_crop or
+            getattr(dup, 'do_smart_crop', False) != self.do_smart_crop):
+            # The duplicate's images can't stand in for this one
+            raise tornado.gen.Return(False)
+
+        if dup.video_id != video_info.key:
+            dup_video = yield VideoMetadata.get(dup.video_id, async=True)
+            if (dup_video is None or
+                dup_video.integration_id != video_info.integration_id):
+                # The duplicate's images may be on other CDNs
+                raise tornado.gen.Return(False)
+
+        _log.info('Thumbnail %s is a duplicate of %s. Reusing its images' %
+                  (self.key, dup_id))
+        statemon.state.increment('duplicate_thumbs_found')
+
+        self.urls.insert(0, dup.urls[0])
+        if self.model_version is None and self.features is None:
+            self.model_score = dup.model_score
+            self.model_version = dup.model_version
+            self.features = dup.features
+
+        if dup_id != self.key:
+            # The urls in the duplicate might be generated from its
+            # thumbnail id, so store the full urls.
+            url_obj = ThumbnailServingURLs(
+                self.key, size_map=dict((size, url) for size, url in dup_urls))
+            yield url_obj.save(async=True)
+            ThumbnailPhashIndex.add(self)
+        raise tornado.gen.Return(True)
+
     @staticmethod
     def generate_dominant_color(image):
         '''Extract a dominant color of the image
@@ -6370,6 +6450,105 @@ class ThumbnailMetadata(StoredObject):
             return None
 
 
+class ThumbnailPhashIndex(object):
+    '''In memory index of the perceptual hashes of each account's thumbnails.
+
+    Used to find near duplicate thumbnails when they are added. The index
+    for an account is loaded from the database the first time it is
+    needed and then updated as thumbnails are added by this process.
+    Thumbnails added by other processes are not seen until the account
+    is evicted and reloaded.
+    '''
+    # account_id -> PackedHashIndex of phash -> thumbnail id
+    _indices = OrderedDict()
+    # account_id -> Future for an index being loaded
+    _loading = {}
+
+    @classmethod
+    @tornado.gen.coroutine
+    def get_index(cls, account_id):
+        '''Returns the PackedHashIndex for an account, loading if needed.'''
+        try:
+            index = cls._indices.pop(account_id)
+            cls._indices[account_id] = index
+            raise tornado.gen.Return(index)
+        except KeyError:
+            pass
+
+        if account_id not in cls._loading:
+            cls._loading[account_id] = cls._load_index(account_id)
+        try:
+            index = yield cls._loading[account_id]
+        finally:
+            cls._loading.pop(account_id, None)
+        raise tornado.gen.Return(index)
+
+    @classmethod
+    @tornado.gen.coroutine
+    def _load_hashes(cls, account_id):
+        '''Returns a list of (thumbnail id, phash) for an account.
+
+        Only those two fields are read, and the keys are matched by an
+        anchored prefix instead of anywhere in the key.
+        '''
+        # Escape the LIKE wildcards, which include the _ separator
+        prefix = re.sub(r'([\\%_])', r'\\\1', '%s_' % account_id)
+        query = ("SELECT _data->>'key' AS key, _data->>'phash' AS phash"
+                 " FROM " + ThumbnailMetadata._baseclass_name().lower() +
+                 " WHERE _data->>'key' LIKE %s"
+                 " AND _data->>'phash' IS NOT NULL")
+        db = PostgresDB()
+        conn = yield db.get_connection()
+        try:
+            cursor = yield conn.execute(query, [prefix + '%'])
+            rv = [(x['key'], long(x['phash'])) for x in cursor]
+        finally:
+            db.return_connection(conn)
+        raise tornado.gen.Return(rv)
+
+    @classmethod
+    @tornado.gen.coroutine
+    def _load_index(cls, account_id):
+        hashes = yield cls._load_hashes(account_id)
+        index = cv.imhash_index.PackedHashIndex(
+            hash_type=options.hash_type,
+            hash_size=options.hash_size,
+            initial_capacity=len(hashes) + 1)
+        index.add_hashes([x[1] for x in hashes], [x[0] for x in hashes])
+
+        cls._indices[account_id] = index
+        while len(cls._indices) > options.thumb_dedup_max_accounts:
+            cls._indices.popitem(last=False)
+        raise tornado.gen.Return(index)
+
+    @classmethod
+    @tornado.gen.coroutine
+    def find_duplicate(cls, account_id, phash, radius):
+        '''Returns the id of the closest thumbnail < radius away or None.'''
+        if phash is None:
+            raise tornado.gen.Return(None)
+        index = yield cls.get_index(account_id)
+        matches = index.radius_search(phash, radius, return_keys=True)
+        if len(matches) == 0:
+            raise tornado.gen.Return(None)
+        raise tornado.gen.Return(matches[0][0])
+
+    @classmethod
+    def add(cls, thumb):
+        '''Adds a thumbnail to its account's index if it is loaded.'''
+        if thumb.phash is None:
+            return
+        index = cls._indices.get(thumb.get_account_id())
+        if index is not None:
+            index.add_hash(thumb.phash, thumb.key)
+
+    @classmethod
+    def clear(cls):
+        '''Throws away all the indices.'''
+        cls._indices.clear()
+        cls._loading.clear()
+
+
 class ThumbnailStatus(DefaultedStoredObject):
     '''Holds the current status of the thumbnail in the wild.'''
 
@@ -71,6 +71,7 @@ from cmsdb.neondata import (
     TagThumbnail,
     ThumbnailID,
     ThumbnailMetadata,
+    ThumbnailPhashIndex,
     ThumbnailServingURLs,
     ThumbnailStatus,
     ThumbnailType,
@@ -1514,6 +1515,93 @@ class TestAddingImageData(NeonDbTestCase):
         self.assertTrue(
             TagThumbnail.has(tag_id='tag_id', thumbnail_id=thumb_info.get_id()))
 
+    @tornado.testing.gen_test
+    def test_add_duplicate_thumbnail_reuses_images(self):
+        self.s3conn.create_bucket('customer-bucket')
+        self.s3conn.create_bucket('host-thumbnails')
+        cdn_metadata = S3CDNHostingMetadata(bucket_name='customer-bucket',
+                                            do_salt=False)
+        ThumbnailPhashIndex.clear()
+
+        with options._set_bounded('cmsdb.neondata.thumb_dedup_radius', 5):
+            video1 = VideoMetadata('acct1_vid1')
+            thumb1 = ThumbnailMetadata(None,
+                                       ttype=ThumbnailType.CUSTOMUPLOAD,
+                                       rank=-1, model_score=0.6,
+                                       model_version='mv1')
+            yield video1.add_thumbnail(thumb1, self.image, [cdn_metadata],
+                                       save_objects=True, async=True)
+
+            # The same image on another video in the account
+            video2 = VideoMetadata('acct1_vid2')
+            thumb2 = ThumbnailMetadata(None,
+                                       ttype=ThumbnailType.CUSTOMUPLOAD,
+                                       rank=-1)
+            with patch('cmsdb.cdnhosting.CDNHosting.create') as create_mock:
+                yield video2.add_thumbnail(thumb2, self.image, [cdn_metadata],
+                                           save_objects=True, async=True)
+                self.assertEqual(create_mock.call_count, 0)
+
+            # A different image is uploaded
+            thumb3 = ThumbnailMetadata(None,
+                                       ttype=ThumbnailType.CUSTOMUPLOAD,
+                                       rank=-1)
+            yield video2.add_thumbnail(
+                thumb3, PILImageUtils.create_random_image(360, 480),
+                [cdn_metadata], save_objects=True, async=True)
+
+        ThumbnailPhashIndex.clear()
+
+        self.assertNotEqual(thumb1.key, thumb2.key)
+        self.assertEqual(thumb2.urls[0], thumb1.urls[0])
+        self.assertEqual(thumb2.model_score, 0.6)
+        self.assertEqual(thumb2.model_version, 'mv1')
+        self.assertEqual(VideoMetadata.get('acct1_vid2').thumbnail_ids,
+                         [thumb2.key, thumb3.key])
+        self.assertEqual(
+            ThumbnailServingURLs.get(thumb2.key).get_serving_url(480, 360),
+            ThumbnailServingURLs.get(thumb1.key).get_serving_url(480, 360))
+        self.assertNotEqual(thumb3.urls[0], thumb1.urls[0])
+
+    @tornado.testing.gen_test
+    def test_duplicate_in_other_integration_is_uploaded(self):
+        self.s3conn.create_bucket('customer-bucket')
+        self.s3conn.create_bucket('host-thumbnails')
+        cdn_metadata = S3CDNHostingMetadata(bucket_name='customer-bucket',
+                                            do_salt=False)
+        ThumbnailPhashIndex.clear()
+
+        with options._set_bounded('cmsdb.neondata.thumb_dedup_radius', 5):
+            video1 = VideoMetadata('acct1_vid1', i_id='int1')
+            thumb1 = ThumbnailMetadata(None,
+                                       ttype=ThumbnailType.CUSTOMUPLOAD,
+                                       rank=-1)
+            yield video1.add_thumbnail(thumb1, self.image, [cdn_metadata],
+                                       save_objects=True, async=True)
+
+            # The same image in another integration, which could be
+            # hosted on different CDNs.
+            video2 = VideoMetadata('acct1_vid2', i_id='int2')
+            thumb2 = ThumbnailMetadata(None,
+                                       ttype=ThumbnailType.CUSTOMUPLOAD,
+                                       rank=-1)
+            yield video2.add_thumbnail(thumb2, self.image, [cdn_metadata],
+                                       save_objects=True, async=True)
+
+            # An account whose id starts with the first one's
+            video3 = VideoMetadata('acct10_vid1', i_id='int1')
+            thumb3 = ThumbnailMetadata(None,
+                                       ttype=ThumbnailType.CUSTOMUPLOAD,
+                                       rank=-1)
+            yield video3.add_thumbnail(thumb3, self.image, [cdn_metadata],
+                                       save_objects=True, async=True)
+
+        ThumbnailPhashIndex.clear()
+
+        self.assertNotEqual(thumb2.urls[0], thumb1.urls[0])
+        self.assertNotEqual(thumb3.urls[0], thumb1.urls[0])
+        self.assertNotEqual(thumb3.urls[0], thumb2.urls[0])
+
     @tornado.testing.gen_test
     def test_add_thumbnail_to_video_and_save_with_cloudinary_hosting(self):
         '''
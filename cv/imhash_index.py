@@ -200,3 +200,191 @@ class ImHashIndex:
 
     
         
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+def popcount64(arr):
+    '''Returns the number of bits set in each element of a uint64 array.'''
+    x = np.asarray(arr, dtype=np.uint64)
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return ((x * _H01) >> np.uint64(56)).astype(np.int64)
+
+class PackedHashIndex(object):
+    '''An exact index of image hashes stored as packed uint64 words.
+
+    Unlike ImHashIndex, this does not need flann. Each hash is stored as
+    a row of uint64 words and a radius search computes the Hamming
+    distance to every entry with a vectorized popcount, which is fast
+    enough for hundreds of thousands of hashes. The storage grows by
+    doubling, so adding many hashes one at a time is amortized O(1).
+
+    An optional key (e.g. a thumbnail id) can be stored with each hash.
+    '''
+    def __init__(self, hash_type='dhash', hash_size=64, initial_capacity=64,
+                 max_query_block=1 << 22):
+        '''
+        Inputs:
+        hash_type - Hash algorithm to use. One of 'ahash', 'dhash', 'phash'
+        hash_size - Size of the hash value in bits
+        initial_capacity - Number of hashes to allocate space for at first
+        max_query_block - Maximum number of distances to compute at once
+                          for a batch of queries
+        '''
+        self.hash_type = hash_type
+        self.hash_size = 64 if hash_type == 'phash' else hash_size
+        self.n_words = (self.hash_size + 63) // 64
+        self.max_query_block = max_query_block
+        self._hash_mask = (1L << self.hash_size) - 1
+
+        self._words = np.zeros((max(initial_capacity, 1), self.n_words),
+                               np.uint64)
+        self._keys = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def hash_pil_image(self, image):
+        '''Returns the hash integer of a PIL image.'''
+        return hash_pil_image(image, self.hash_type, self.hash_size)
+
+    def add_pil_image(self, image, key=None):
+        '''Add a PIL image to the index.'''
+        self.add_hash(self.hash_pil_image(image), key)
+
+    def add_hash(self, hashval, key=None):
+        '''Add an image hash integer to the index.'''
+        self._reserve(self._count + 1)
+        self._words[self._count] = self.int_to_words(hashval)
+        self._keys.append(key)
+        self._count += 1
+
+    def add_hashes(self, hashvals, keys=None):
+        '''Add a sequence of image hash integers to the index.
+
+        Inputs:
+        hashvals - list or generator of hash integers
+        keys - optional list of keys, one for each hash
+        '''
+        words = self.ints_to_words(hashvals)
+        if keys is None:
+            keys = [None] * words.shape[0]
+        else:
+            keys = list(keys)
+            if len(keys) != words.shape[0]:
+                raise ValueError('There must be one key per hash')
+        self._reserve(self._count + words.shape[0])
+        self._words[self._count:(self._count + words.shape[0])] = words
+        self._keys.extend(keys)
+        self._count += words.shape[0]
+
+    def clear(self):
+        '''Remove everything from the index.'''
+        self._keys = []
+        self._count = 0
+
+    def radius_search(self, hashval, radius=5, return_keys=False):
+        '''Return all the (hash, dist) < radius from the hashval.
+
+        If return_keys is True, returns (key, hash, dist) for every
+        matching entry instead, so duplicate hashes can be told apart.
+        The results are sorted by distance.
+        '''
+        return self.batch_radius_search([hashval], radius, return_keys)[0]
+
+    def pil_image_radius_search(self, image, radius=5, return_keys=False):
+        '''Returns all the (hash, dist) < radius from the PIL image.'''
+        return self.radius_search(self.hash_pil_image(image), radius,
+                                  return_keys)
+
+    def batch_radius_search(self, hashvals, radius=5, return_keys=False):
+        '''Does a radius_search for each hash in hashvals.
+
+        Returns a list with the radius_search results for each hash.
+        '''
+        queries = self.ints_to_words(hashvals)
+        results = []
+        if self._count == 0:
+            return [[] for i in range(queries.shape[0])]
+
+        entries = self._words[:self._count]
+        block = max(1, self.max_query_block // (self._count * self.n_words))
+        for start in range(0, queries.shape[0], block):
+            dists = self.hamming_distances(queries[start:(start+block)],
+                                           entries)
+            for row in dists:
+                idx = np.nonzero(row < radius)[0]
+                idx = idx[np.argsort(row[idx], kind='mergesort')]
+                if return_keys:
+                    results.append([
+                        (self._keys[i], self.words_to_int(entries[i]),
+                         row[i]) for i in idx])
+                else:
+                    found = {}
+                    for i in idx:
+                        found.setdefault(self.words_to_int(entries[i]),
+                                         row[i])
+                    results.append(sorted(found.iteritems(),
+                                          key=lambda x: x[1]))
+        return results
+
+    @classmethod
+    def hamming_distances(cls, queries, entries):
+        '''Returns the matrix of hamming distances between two sets of rows.
+
+        Inputs:
+        queries - m x n_words uint64 array
+        entries - n x n_words uint64 array
+
+        Returns:
+        m x n int array
+        '''
+        xored = np.bitwise_xor(queries[:, np.newaxis, :],
+                               entries[np.newaxis, :, :])
+        return np.sum(popcount64(xored), axis=2)
+
+    def int_to_words(self, val):
+        '''Converts a hash integer to a row of uint64 words.
+
+        The most significant word is first. Only the lowest hash_size
+        bits are used.
+        '''
+        val = long(val) & self._hash_mask
+        return np.array(
+            [(val >> (64 * i)) & 0xffffffffffffffffL
+             for i in range(self.n_words - 1, -1, -1)],
+            np.uint64)
+
+    def ints_to_words(self, vals):
+        '''Converts a sequence of hash integers to a matrix of uint64 words.'''
+        if self.n_words == 1:
+            return np.array([long(x) & self._hash_mask for x in vals],
+                            np.uint64).reshape(-1, 1)
+        rows = [self.int_to_words(x) for x in vals]
+        if len(rows) == 0:
+            return np.zeros((0, self.n_words), np.uint64)
+        return np.vstack(rows)
+
+    @classmethod
+    def words_to_int(cls, words):
+        '''Converts a row of uint64 words to a hash integer.'''
+        val = 0L
+        for word in words:
+            val = (val << 64) | long(word)
+        return val
+
+    def _reserve(self, n):
+        '''Makes sure there is space for n hashes.'''
+        capacity = self._words.shape[0]
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        new_words = np.zeros((capacity, self.n_words), np.uint64)
+        new_words[:self._count] = self._words[:self._count]
+        self._words = new_words
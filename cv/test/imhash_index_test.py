@@ -13,10 +13,11 @@ if sys.path[0] != __base_path__:
     sys.path.insert(0, __base_path__)
 
 import glob
-from cv.imhash_index import ImHashIndex
+from cv.imhash_index import ImHashIndex, PackedHashIndex
 import math
 import numpy as np
 import PIL.Image
+import random
 from StringIO import StringIO
 import unittest
 import utils.neon
@@ -127,6 +128,67 @@ class TestImHashIndex(unittest.TestCase):
         
 
 
+class TestPackedHashIndex(unittest.TestCase):
+    def setUp(self):
+        random.seed(1654)
+        self.index = PackedHashIndex(initial_capacity=4)
+
+    def _hamming(self, a, b):
+        return bin(a ^ b).count('1')
+
+    def test_find_same_images(self):
+        hashes = {}
+        for image_fn in glob.glob('%s/images/*.jpg' %
+                                  os.path.dirname(__file__)):
+            full_hash = self.index.hash_pil_image(PIL.Image.open(image_fn))
+            hashes[image_fn] = full_hash
+            self.index.add_hash(full_hash, key=image_fn)
+
+        for image_fn, full_hash in hashes.iteritems():
+            results = self.index.pil_image_radius_search(
+                PIL.Image.open(image_fn), radius=1, return_keys=True)
+            self.assertEqual(results, [(image_fn, full_hash, 0)])
+
+    def test_matches_brute_force(self):
+        hashes = [random.getrandbits(64) for i in range(500)]
+        self.index.add_hashes(hashes[:250])
+        for hashval in hashes[250:]:
+            self.index.add_hash(hashval)
+        self.assertEqual(len(self.index), 500)
+
+        queries = [hashes[i] ^ (1 << i % 64) ^ (1 << 63) for i in range(20)]
+        results = self.index.batch_radius_search(queries, radius=5)
+        for query, result in zip(queries, results):
+            expected = sorted([(x, self._hamming(x, query)) for x in hashes
+                               if self._hamming(x, query) < 5],
+                              key=lambda x: x[1])
+            self.assertEqual(result, expected)
+            self.assertEqual(self.index.radius_search(query, radius=5),
+                             expected)
+
+    def test_duplicate_hashes(self):
+        self.index.add_hashes([0x1234, 0x1234, 0x1235], keys=['a', 'b', 'c'])
+        self.assertEqual(self.index.radius_search(0x1234),
+                         [(0x1234, 0), (0x1235, 1)])
+        self.assertEqual(self.index.radius_search(0x1234, return_keys=True),
+                         [('a', 0x1234, 0), ('b', 0x1234, 0),
+                          ('c', 0x1235, 1)])
+
+    def test_empty_index(self):
+        self.assertEqual(self.index.radius_search(0x1234), [])
+        self.assertEqual(self.index.batch_radius_search([0x1, 0x2]),
+                         [[], []])
+
+    def test_long_hashes(self):
+        index = PackedHashIndex(hash_size=128)
+        hashes = [random.getrandbits(128) for i in range(50)]
+        index.add_hashes(hashes)
+        self.assertEqual(index.radius_search(hashes[3] ^ (1 << 100), 2),
+                         [(hashes[3], 1)])
+        self.assertEqual(index.words_to_int(index.int_to_words(hashes[5])),
+                         hashes[5])
+
+
 if __name__ == '__main__':
     utils.neon.InitNeonTest()
     unittest.main()
@@ -13,7 +13,6 @@ if sys.path[0] != __base_path__:
 import atexit
 from cmsdb import neondata
 import datetime
-import functools
 import logging
 import integrations.brightcove
 import integrations.cnn
@@ -26,6 +25,7 @@ import re
 import time
 import tornado.ioloop
 import tornado.gen
+import tornado.locks
 import urlparse
 import utils.neon
 from utils.options import define, options
@@ -34,6 +34,15 @@ from utils import statemon
 import utils.sync
 
 define("poll_period", default=300.0, help="Period (s) to poll service", type=float)
+define("min_poll_period", default=60.0, type=float,
+       help="Shortest period (s) to poll an integration that is finding videos")
+define("max_poll_period", default=1800.0, type=float,
+       help="Longest period (s) to poll an integration that is idle")
+define("idle_backoff", default=1.5, type=float,
+       help=("Factor to increase an integration's poll period by each time "
+             "it doesn't find a new video"))
+define("max_concurrent_integrations", default=10, type=int,
+       help="Maximum number of integrations to process at once")
 define("service_name", default=None, help="Which service to start", type=str)
 
 statemon.define('unexpected_exception', int)
@@ -42,6 +51,9 @@ statemon.define('platform_missing', int)
 statemon.define('n_integrations', int)
 statemon.define('integrations_finished', int)
 statemon.define('slow_update', int)
+statemon.define('integrations_running', int)
+statemon.define('integrations_overdue', int)
+statemon.define('max_integration_lag', float)
 
 _log = logging.getLogger(__name__)
 
@@ -77,7 +89,10 @@ def get_integration_class():
 
 @tornado.gen.coroutine
 def process_one_account(api_key, integration_id, slow_limit=600.0):
-    '''Processes one account.'''
+    '''Processes one account.
+
+    Returns the number of new videos that were submitted.
+    '''
     _log.debug('Processing %s platform for account %s, integration %s'
                % (options.service_name, api_key, integration_id))
     start_time = datetime.datetime.now()
@@ -89,7 +104,7 @@ def process_one_account(api_key, integration_id, slow_limit=600.0):
         _log.error('Could not find platform %s for account %s' %
                    (integration_id, api_key))
         statemon.state.increment('platform_missing')
-        return
+        raise tornado.gen.Return(0)
 
     integration_class = get_integration_class()
     account_id = platform.account_id
@@ -103,11 +118,14 @@ def process_one_account(api_key, integration_id, slow_limit=600.0):
         pass 
 
     integration = integration_class(account_id, platform)
+    n_new_videos = 0
     try:
         yield integration.process_publisher_stream()
+        n_new_videos = integration.n_new_videos
     except integrations.exceptions.IntegrationError as e:
-        # Exceptions are logged in the integration object already
-        pass
+        # Exceptions are logged in the integration object already. Videos
+        # submitted before the error still count.
+        n_new_videos = integration.n_new_videos
     except Exception as e:
         _log.exception(
             'Unexpected exception when processing publisher stream %s'
@@ -122,21 +140,129 @@ def process_one_account(api_key, integration_id, slow_limit=600.0):
         log_func = _log.warn
     log_func('Finished processing account %s, integration %s. Time was %f' %
              (api_key, platform.integration_id, runtime))
+    raise tornado.gen.Return(n_new_videos)
+
+
+class IntegrationSchedule(object):
+    '''When to process an integration next.
+
+    The poll period shrinks when new videos are found and grows by
+    idle_backoff every time none are, within [min_poll_period,
+    max_poll_period].
+    '''
+    def __init__(self, api_key, integration_id):
+        self.key = (api_key, integration_id)
+        self.period = options.poll_period
+        self.next_run = time.time()
+        self.running = False
+        self._stopped = False
+
+        self._lag_name = 'integration_lag.%s' % integration_id
+        statemon.define(self._lag_name, float)
+
+    def stop(self):
+        self._stopped = True
+
+    def is_running(self):
+        '''Returns True if the integration is still being scheduled.'''
+        return not self._stopped
+
+    def lag(self, now):
+        '''Returns how many seconds the integration is overdue.'''
+        return max(0.0, now - self.next_run)
 
+    def set_lag(self, lag):
+        setattr(statemon.state, self._lag_name, lag)
+
+    def finished(self, n_new_videos):
+        '''Schedules the next run after processing found n_new_videos.'''
+        if n_new_videos > 0:
+            self.period /= (1.0 + n_new_videos)
+        else:
+            self.period *= options.idle_backoff
+        self.period = min(max(self.period, options.min_poll_period),
+                          options.max_poll_period)
+        self.next_run = time.time() + self.period
 
 class Manager(object):
+    '''Processes all the integrations using a pool of workers.
+
+    Integrations are processed when their IntegrationSchedule says
+    they are due, the most overdue ones first, with at most
+    max_concurrent_integrations running at once.
+    '''
     def __init__(self):
-        self._timers = {} # (api_key, integration_id) -> periodic callback timer
+        self._timers = {} # (api_key, integration_id) -> IntegrationSchedule
+        self._n_running = 0
+        self._stopped = True
+        self._wake = tornado.locks.Condition()
         self.integration_checker = utils.sync.PeriodicCoroutineTimer(
             self.check_integration_list,
             options.poll_period * 1000.)
 
     def start(self):
         self.integration_checker.start()
+        if self._stopped:
+            self._stopped = False
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self._run_scheduler)
 
     def stop(self):
         self.integration_checker.stop()
-                
+        self._stopped = True
+        for schedule in self._timers.values():
+            schedule.stop()
+        self._wake.notify_all()
+
+    @tornado.gen.coroutine
+    def _run_scheduler(self):
+        while not self._stopped:
+            now = time.time()
+            schedules = [x for x in self._timers.values() if not x.running]
+            due = sorted([x for x in schedules if x.next_run <= now],
+                         key=lambda x: x.next_run)
+            for schedule in due:
+                if self._n_running >= options.max_concurrent_integrations:
+                    break
+                self._start_processing(schedule, now)
+            self._update_lag_metrics(now)
+
+            # Sleep until the next integration is due or a worker frees up
+            waiting = [x.next_run for x in schedules if x.next_run > now]
+            sleep_time = min(waiting) - now if waiting else options.poll_period
+            yield self._wake.wait(
+                timeout=datetime.timedelta(seconds=min(max(sleep_time, 0.01),
+                                                       options.poll_period)))
+
+    def _start_processing(self, schedule, now):
+        schedule.running = True
+        schedule.set_lag(schedule.lag(now))
+        self._n_running += 1
+        statemon.state.integrations_running = self._n_running
+        tornado.ioloop.IOLoop.current().spawn_callback(self._process,
+                                                       schedule)
+
+    @tornado.gen.coroutine
+    def _process(self, schedule):
+        n_new_videos = 0
+        try:
+            n_new_videos = yield process_one_account(*schedule.key)
+        except Exception as e:
+            _log.exception('Unexpected exception processing integration %s: '
+                           '%s' % (schedule.key, e))
+            statemon.state.increment('unexpected_exception')
+        finally:
+            schedule.finished(n_new_videos)
+            schedule.running = False
+            self._n_running -= 1
+            statemon.state.integrations_running = self._n_running
+            self._wake.notify_all()
+
+    def _update_lag_metrics(self, now):
+        lags = [x.lag(now) for x in self._timers.values() if not x.running]
+        statemon.state.integrations_overdue = len([x for x in lags if x > 0])
+        statemon.state.max_integration_lag = max(lags) if lags else 0.0
+
     @tornado.gen.coroutine
     def check_integration_list(self):
         '''Polls the database for the active integrations.'''
@@ -155,25 +281,24 @@ class Manager(object):
         
         cur_keys = set(cur_keys) 
  
-        # Schedule callbacks for new integration objects
+        # Schedule new integration objects
         new_keys = cur_keys - orig_keys
         for key in new_keys:
             _log.info('Turning on integration (%s,%s)' % key)
-            timer = utils.sync.PeriodicCoroutineTimer(
-                functools.partial(process_one_account, *key),
-                options.poll_period * 1000.)
-            timer.start()
-            self._timers[key] = timer
+            self._timers[key] = IntegrationSchedule(*key)
 
-        # Remove callbacks for integration objects we are no long watching
+        # Stop scheduling integration objects we are no long watching
         dropped_keys = orig_keys - cur_keys
         for key in dropped_keys:
             _log.info('Turning off integration (%s,%s)' % key)
-            timer = self._timers[key]
-            timer.stop()
+            schedule = self._timers[key]
+            schedule.stop()
+            schedule.set_lag(0.0)
             del self._timers[key]
 
         statemon.state.n_integrations = len(self._timers)
+        if len(new_keys) > 0:
+            self._wake.notify_all()
 
 def main():    
     ioloop = tornado.ioloop.IOLoop.current()
@@ -37,6 +37,11 @@ define('max_submit_retries', default=3,
 define('max_vids_for_new_account', default=100,
        help='Maximum videos to process for a new account')
 
+define('submit_page_size', default=20, type=int,
+       help='Number of videos to pull from the OVP before submitting them')
+define('max_concurrent_submissions', default=5, type=int,
+       help='Maximum number of videos to submit at once for an integration')
+
 define('cmsapi_host', default='services.neon-lab.com',
        help='Host where the cmsapi is')
 define('cmsapi_port', default=80, type=int, help='Port where the cmsapi is')
@@ -64,6 +69,8 @@ class OVPIntegration(object):
         self.wants_async_iter = False
         # must be set to your video iterator for submit_ovp_videos
         self.video_iter = None
+        # Number of new videos submitted by this object
+        self.n_new_videos = 0
  
     @tornado.gen.coroutine
     def submit_ovp_videos(self,
@@ -72,6 +79,12 @@ class OVPIntegration(object):
                           grab_new_thumb=True):
         '''Submits many videos utilizing child class functions
 
+        Videos are pulled from iter_func a page at a time and the
+        videos in a page are submitted concurrently. The results are
+        then handled in the order the videos came from iter_func, so
+        last_processed_date never moves past a video that needs to be
+        retried.
+
         Parameters:
         videos - json object of many videos
 
@@ -86,79 +99,88 @@ class OVPIntegration(object):
             raise NotImplementedError('video_iter must be set in child class')
 
         while True:
-            try:
-                if (self.platform.last_process_date is None and
-                    added_jobs >= options.max_vids_for_new_account):
-                    # New account, so only process the most recent videos
+            page_size = options.submit_page_size
+            if self.platform.last_process_date is None:
+                # New account, so only process the most recent videos
+                page_size = min(page_size,
+                                options.max_vids_for_new_account - added_jobs)
+                if page_size <= 0:
                     break
-                video = None
-                video = yield iter_func()
-                if isinstance(video, StopIteration):
-                    break
-                try: 
-                    job_id = yield self.submit_one_video_object(
-                        video, 
-                        grab_new_thumb=grab_new_thumb)
 
-                except TypeError as e: 
-                    _log.warning('Can not process video : %s due to : %s' % 
-                        (video, e))
-                    continue 
- 
-                if job_id: 
-                    video_dict[self.get_video_id(video)] = job_id 
-                    added_jobs += 1 
-            except (KeyError, OVPCustomRefIDError, OVPRefIDError):
-                # pass here, we do not have enough to submit 
-                pass
-            except RateLimitError:
-                # just break here, we don't want to update last_processed 
-                break  
-            except OVPNoValidURL: 
-                _log.error('Unable to find a valid url for video_id : %s' % \
-                    self.get_video_id(video))
-                pass
-            except OVPError as e:
-                if continue_on_error:
-                    video_dict[self.get_video_id(video)] = e
-                    continue
-                raise
-            except Exception as e:
-                # we got an unknown error from somewhere, it could be video,
-                #  server, or api related -- we will retry it on the next goaround
-                #  if we have not reached the max retries for this video, otherwise
-                #  we pass and move on
-                if continue_on_error:
-                    video_dict[self.get_video_id(video)] = e
+            results, at_end = yield self._submit_video_page(
+                iter_func,
+                page_size,
+                continue_on_error=continue_on_error,
+                grab_new_thumb=grab_new_thumb)
+
+            rate_limited = False
+            for video, job_id, err in results:
+                if isinstance(err, TypeError) and video is not None:
+                    _log.warning('Can not process video : %s due to : %s' %
+                        (video, err))
                     continue
+                try:
+                    if err is not None:
+                        raise err
+
+                    if job_id:
+                        video_dict[self.get_video_id(video)] = job_id
+                        added_jobs += 1
+                except (KeyError, OVPCustomRefIDError, OVPRefIDError):
+                    # pass here, we do not have enough to submit 
+                    pass
+                except RateLimitError:
+                    # just break here, we don't want to update last_processed 
+                    rate_limited = True
+                    break
+                except OVPNoValidURL: 
+                    _log.error('Unable to find a valid url for video_id : %s' % \
+                        self.get_video_id(video))
+                    pass
+                except OVPError as e:
+                    if continue_on_error:
+                        video_dict[self.get_video_id(video)] = e
+                        continue
+                    raise
+                except Exception as e:
+                    # we got an unknown error from somewhere, it could be video,
+                    #  server, or api related -- we will retry it on the next goaround
+                    #  if we have not reached the max retries for this video, otherwise
+                    #  we pass and move on
+                    if continue_on_error:
+                        video_dict[self.get_video_id(video)] = e
+                        continue
 
-                def _increase_retries(x):
-                    x.video_submit_retries += 1
+                    def _increase_retries(x):
+                        x.video_submit_retries += 1
 
-                if self.platform.video_submit_retries < options.max_submit_retries:
-                    # update last_process_date, so we start on this video next time
-                    yield self.update_last_processed_date(last_processed_date,
-                                                          reset_retries=False)
+                    if self.platform.video_submit_retries < options.max_submit_retries:
+                        # update last_process_date, so we start on this video next time
+                        yield self.update_last_processed_date(last_processed_date,
+                                                              reset_retries=False)
 
-                    self.platform = yield self.platform.modify(
-                        self.platform.integration_id,
-                        _increase_retries, 
-                        async=True)
+                        self.platform = yield self.platform.modify(
+                            self.platform.integration_id,
+                            _increase_retries, 
+                            async=True)
 
-                    _log.info('Added or found %d jobs for account:'
-                              '%s integration: %s before failure.' %
-                              (added_jobs, self.neon_api_key,
-                                  self.platform.integration_id))
-                    return 
-                else:
-                    _log.error('Unknown error, reached max retries on '
-                               'video submit for account %s: item %s: %s' %
-                               (self.account_id, video if video else None, e))
-                    self._log_statemon_submit_video_error()
-                    pass
+                        _log.info('Added or found %d jobs for account:'
+                                  '%s integration: %s before failure.' %
+                                  (added_jobs, self.neon_api_key,
+                                      self.platform.integration_id))
+                        return 
+                    else:
+                        _log.error('Unknown error, reached max retries on '
+                                   'video submit for account %s: item %s: %s' %
+                                   (self.account_id, video if video else None, e))
+                        self._log_statemon_submit_video_error()
+                        pass
 
-            last_processed_date = max(last_processed_date,
-                                      self.get_video_last_modified_date(video))
+                last_processed_date = max(last_processed_date,
+                                          self.get_video_last_modified_date(video))
+
+            if rate_limited or at_end:
+                break
 
         yield self.update_last_processed_date(last_processed_date)
         _log.info('Added or found %d jobs for account: %s integration: %s' %
@@ -166,15 +188,123 @@ class OVPIntegration(object):
 
         raise tornado.gen.Return(video_dict)
 
+    @tornado.gen.coroutine
+    def _submit_video_page(self, iter_func, page_size,
+                           continue_on_error=False,
+                           grab_new_thumb=True):
+        '''Pulls up to page_size videos from iter_func and submits them.
+
+        At most options.max_concurrent_submissions videos are
+        submitted at once. Once a submission fails in a way that stops
+        submit_ovp_videos, no more videos in the page are started.
+
+        Returns:
+        ([(video, job_id, exception)], at_end) where the list is in
+        iter_func order and at_end is True if iter_func ran out of
+        videos. If iter_func raised, the last entry is
+        (None, None, exception).
+        '''
+        videos = []
+        fetch_error = None
+        at_end = False
+        while len(videos) < page_size:
+            try:
+                video = yield iter_func()
+            except Exception as e:
+                fetch_error = e
+                break
+            if isinstance(video, StopIteration):
+                at_end = True
+                break
+            videos.append(video)
+
+        existing_videos = yield self._get_existing_videos(videos)
+
+        results = [None] * len(videos)
+        todo = iter(range(len(videos)))
+        stop = [False]
+
+        @tornado.gen.coroutine
+        def _submit_worker():
+            for i in todo:
+                try:
+                    job_id = yield self.submit_one_video_object(
+                        videos[i],
+                        grab_new_thumb=grab_new_thumb,
+                        existing_videos=existing_videos)
+                    results[i] = (videos[i], job_id, None)
+                except Exception as e:
+                    results[i] = (videos[i], None, e)
+                    if self._stops_submission(e, continue_on_error):
+                        stop[0] = True
+                if stop[0]:
+                    return
+
+        n_workers = min(options.max_concurrent_submissions, len(videos))
+        yield [_submit_worker() for x in range(n_workers)]
+
+        # Videos after the one that stopped the submission never started
+        results = [x for x in results if x is not None]
+        if fetch_error is not None:
+            results.append((None, None, fetch_error))
+        raise tornado.gen.Return((results, at_end))
+
+    def _stops_submission(self, err, continue_on_error):
+        '''Returns True if submit_ovp_videos will stop on this error.'''
+        if isinstance(err, RateLimitError):
+            return True
+        if isinstance(err, (KeyError, TypeError, OVPCustomRefIDError,
+                            OVPRefIDError, OVPNoValidURL)):
+            return False
+        if continue_on_error:
+            return False
+        if isinstance(err, OVPError):
+            return True
+        return (self.platform.video_submit_retries <
+                options.max_submit_retries)
+
+    @tornado.gen.coroutine
+    def _get_existing_videos(self, videos):
+        '''Looks up the VideoMetadata for a list of ovp videos in one call.
+
+        Returns:
+        dictionary of internal video id -> VideoMetadata or None
+        '''
+        keys = set()
+        for video in videos:
+            try:
+                video_id = InputSanitizer.sanitize_string(
+                    self.get_video_id(video))
+            except Exception:
+                # The error will come up when the video is submitted
+                continue
+            keys.add(neondata.InternalVideoID.generate(self.neon_api_key,
+                                                       video_id))
+        keys = list(keys)
+        if len(keys) == 0:
+            raise tornado.gen.Return({})
+
+        try:
+            existing = yield neondata.VideoMetadata.get_many(
+                keys, log_missing=False, async=True)
+        except Exception as e:
+            # Fall back to looking up each video when it is submitted
+            _log.warn('Error looking up existing videos for account %s: %s' %
+                      (self.account_id, e))
+            raise tornado.gen.Return({})
+        raise tornado.gen.Return(dict(zip(keys, existing)))
+
     @tornado.gen.coroutine
     def submit_one_video_object(self,
                                 video,
-                                grab_new_thumb=True):
+                                grab_new_thumb=True,
+                                existing_videos=None):
 
 
         try:
             job_id = yield self._submit_one_video_object_impl(
-                    video, grab_new_thumb=grab_new_thumb)
+                    video, grab_new_thumb=grab_new_thumb,
+                    existing_videos=existing_videos)
         except (CMSAPIError, 
                 OVPError,
                 TypeError,
@@ -190,7 +320,14 @@ class OVPIntegration(object):
     @tornado.gen.coroutine
     def _submit_one_video_object_impl(self,
                                       video,
-                                      grab_new_thumb=True):
+                                      grab_new_thumb=True,
+                                      existing_videos=None):
+        '''Submits a single video.
+
+        existing_videos is an optional dictionary of internal video id
+        -> VideoMetadata (or None) that was already looked up, so that
+        we do not need to go to the database for this video.
+        '''
         rv = None
 
         video_id = InputSanitizer.sanitize_string(self.get_video_id(video))
@@ -222,9 +359,14 @@ class OVPIntegration(object):
             except AttributeError as e:
                 # already a string, leave it alone
                 pass 
-        existing_video = yield neondata.VideoMetadata.get(
-            neondata.InternalVideoID.generate(self.neon_api_key, video_id), 
-            async=True)
+        internal_video_id = neondata.InternalVideoID.generate(
+            self.neon_api_key, video_id)
+        if existing_videos is not None and \
+          internal_video_id in existing_videos:
+            existing_video = existing_videos[internal_video_id]
+        else:
+            existing_video = yield neondata.VideoMetadata.get(
+                internal_video_id, async=True)
 
         if not self.does_video_exist(existing_video, video_id):
             try:       
@@ -340,6 +482,7 @@ class OVPIntegration(object):
         _log.info('New video was submitted for account %s video id %s'
                   % (self.neon_api_key, video_id))
         statemon.state.increment('new_job_submitted')
+        self.n_new_videos += 1
         raise tornado.gen.Return(json.loads(res.body))
 
     @tornado.gen.coroutine
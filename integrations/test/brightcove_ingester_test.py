@@ -9,10 +9,12 @@ if sys.path[0] != __base_path__:
 import api.brightcove_api
 from cmsdb import neondata
 import integrations.brightcove
+import integrations.ingester
 import logging
 from mock import patch, MagicMock
 import test_utils.neontest
 import test_utils.postgresql
+import time
 import tornado.gen
 import tornado.httpclient
 import tornado.testing
@@ -32,6 +34,7 @@ class SmokeTesting(test_utils.neontest.AsyncTestCase):
         self.int_mock = self.int_mocker.start()
         self.process_mock = self._future_wrap_mock(
             self.int_mock().process_publisher_stream)
+        self.int_mock().n_new_videos = 0
 
         # Build a platform
         user_id = '234234234dasfds'
@@ -205,6 +208,78 @@ class SmokeTesting(test_utils.neontest.AsyncTestCase):
 
         self.assertEquals(self.process_mock.call_count, 2)
 
+    @tornado.testing.gen_test
+    def test_known_error_counts_submitted_videos(self):
+        self.int_mock().n_new_videos = 2
+        self.process_mock.side_effect = [integrations.ovp.OVPError('Oops')]
+
+        n_new_videos = yield integrations.ingester.process_one_account(
+            self.user.neon_api_key, self.integration.integration_id)
+
+        self.assertEquals(n_new_videos, 2)
+
+class TestScheduling(test_utils.neontest.AsyncTestCase):
+    def setUp(self):
+        super(TestScheduling, self).setUp()
+        self.process_patcher = patch(
+            'integrations.ingester.process_one_account')
+        self.process_mock = self._future_wrap_mock(
+            self.process_patcher.start())
+        self.process_mock.side_effect = \
+          lambda api_key, i_id: 3 if i_id == 'busy' else 0
+
+        # The schedules are set by the test, not from the database
+        self.list_patcher = patch(
+            'integrations.ingester.Manager.check_integration_list')
+        self._future_wrap_mock(self.list_patcher.start())
+
+        self.manager = integrations.ingester.Manager()
+
+    def tearDown(self):
+        self.manager.stop()
+        self.list_patcher.stop()
+        self.process_patcher.stop()
+        super(TestScheduling, self).tearDown()
+
+    def test_poll_period_adapts(self):
+        with options._set_bounded('integrations.ingester.poll_period', 100):
+            with options._set_bounded(
+                    'integrations.ingester.max_poll_period', 200):
+                schedule = integrations.ingester.IntegrationSchedule(
+                    'acct1', 'i1')
+                schedule.finished(0)
+                self.assertAlmostEqual(schedule.period, 150)
+                schedule.finished(0)
+                schedule.finished(0)
+                self.assertAlmostEqual(schedule.period, 200)
+                schedule.finished(3)
+                self.assertAlmostEqual(schedule.period, 60)
+                self.assertGreater(schedule.next_run, time.time() + 59)
+
+    @tornado.testing.gen_test
+    def test_most_overdue_first(self):
+        now = time.time()
+        for i_id, next_run in [('late', now - 100), ('later', now - 200),
+                               ('busy', now - 50), ('future', now + 100)]:
+            schedule = integrations.ingester.IntegrationSchedule('acct1',
+                                                                 i_id)
+            schedule.next_run = next_run
+            self.manager._timers[('acct1', i_id)] = schedule
+
+        with options._set_bounded(
+                'integrations.ingester.max_concurrent_integrations', 1):
+            self.manager.start()
+            yield self.assertWaitForEquals(
+                lambda: self.process_mock.call_count, 3, async=True)
+
+        self.assertEquals([x[0][1] for x in
+                           self.process_mock.call_args_list],
+                          ['later', 'late', 'busy'])
+        busy = self.manager._timers[('acct1', 'busy')]
+        late = self.manager._timers[('acct1', 'late')]
+        self.assertLess(busy.period, late.period)
+        self.assertFalse(busy.running)
+
 if __name__ == '__main__':
     utils.neon.InitNeon()
     unittest.main()
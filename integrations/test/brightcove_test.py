@@ -1263,6 +1263,49 @@ class TestSubmitNewVideos(test_utils.neontest.AsyncTestCase):
             self.assertEquals(bp.last_process_date, 1410012300)
             self.assertEquals(bp.video_submit_retries, 1)
         
+    @tornado.testing.gen_test
+    def test_bc_submit_video_failure_mid_page(self): 
+        def _set_last_processed(x): 
+            x.last_process_date = 1410012300
+            x.video_submit_retries = 0
+        self.platform = neondata.BrightcoveIntegration.modify(
+            self.platform.integration_id, 
+            _set_last_processed, 
+            create_missing=True)
+        self.integration.platform.video_submit_retries = 0
+
+        def _submit_video(video_id, **kwargs):
+            if video_id == 'v2':
+                raise Exception('blah')
+            return {'job_id' : 'job_%s' % video_id}
+        with patch('integrations.ovp.OVPIntegration.submit_video') as submit_video_mocker:
+            submit_video_mock = self._future_wrap_mock(submit_video_mocker)
+            submit_video_mock.side_effect = _submit_video
+
+            videos = []
+            for i in range(1, 4):
+                videos.append({ 'id' : 'v%d' % i,
+                      'length' : 100,
+                      'FLVURL' : 'http://video%d.mp4' % i,
+                      'lastModifiedDate' : 1420080400000 + i * 1000,
+                      'name' : 'Some Video',
+                      'videoStillURL' : 'http://bc.com/vid_still.jpg?x=5',
+                      'videoStill' : {
+                          'id' : 'still_id',
+                          'referenceId' : 'my_still_ref',
+                          'remoteUrl' : None
+                          },
+                    })
+            self.mock_find_videos.side_effect = [videos, []]
+            yield self.integration.submit_new_videos()
+
+            # The videos are submitted concurrently, but we can only
+            # advance up to the video that failed
+            self.assertEquals(submit_video_mock.call_count, 3)
+            bp = neondata.BrightcoveIntegration.get(self.platform.integration_id) 
+            self.assertEquals(bp.last_process_date, 1420080401.000)
+            self.assertEquals(bp.video_submit_retries, 1)
+
     @tornado.testing.gen_test
     def test_bc_account_with_custom_last_mod_date_updated(self):
         def _create_platform(x): 
@@ -30,6 +30,19 @@ from utils.options import options, define
 from utils import pycvutils
 
 define('workers', default=2, help='Number of worker threads')
+define('score_batch_size', default=8, type=int,
+       help='Maximum number of frames a worker scores in one batch')
+define('score_batch_linger', default=0.05, type=float,
+       help=('Seconds a worker waits for more frames to fill a batch '
+             'after it has one'))
+define('reservoir_frames_per_scene', default=8, type=int,
+       help=('Number of frames per scene to keep from the scene detection '
+             'pass so that they can be scored without decoding the video '
+             'again. 0 disables the reservoir'))
+define('max_reservoir_frames', default=100, type=int,
+       help=('Maximum number of frames to keep in the reservoir in total. '
+             'The frames are kept at 360p, so each one uses about 0.7MB '
+             '(70MB at the default)'))
 
 _log = logging.getLogger(__name__)
 
@@ -109,7 +122,16 @@ class ClipFinder(object):
              frame_step=2,
              startend_buffer = self.startend_clip
              )
-        mov_features = mov_feature_generator.generate(mov)
+        reservoir = None
+        frame_callback = None
+        if options.reservoir_frames_per_scene > 0:
+            reservoir = FrameReservoir(options.reservoir_frames_per_scene,
+                                       options.max_reservoir_frames)
+            frame_callback = lambda frameno, image, feats: reservoir.add(
+                frameno, image,
+                feats.get(model.features.SceneCutGenerator))
+        mov_features = mov_feature_generator.generate(
+            mov, frame_callback=frame_callback)
 
         # Get the list of scenes
         scene_list = [k for k,v in mov_features[
@@ -128,7 +150,8 @@ class ClipFinder(object):
                   (time_spent, analysis_budget,
                    time_spent/analysis_budget*100.0))
         analysis_budget -= time_spent
-        self._score_scenes(mov, scene_list, score_obj, analysis_budget)
+        self._score_scenes(mov, scene_list, score_obj, analysis_budget,
+                           reservoir)
 
         clips = self._build_clips(
             score_obj,
@@ -139,9 +162,13 @@ class ClipFinder(object):
 
         return clips
 
-    def _score_scenes(self, mov, scene_list, score_obj, analysis_budget):
+    def _score_scenes(self, mov, scene_list, score_obj, analysis_budget,
+                      reservoir=None):
         '''Get all the scenes scored.
 
+        If a FrameReservoir is given, its frames are scored first and
+        then more frames are seeked from the video if there is time.
+
         Results stored in score_obj
         '''
         frame_q = Queue.Queue(maxsize=100)
@@ -149,7 +176,7 @@ class ClipFinder(object):
 
         threads = [
             Thread(target=self._frame_extractor,
-                   args=(mov, scene_list, frame_q, halter))]
+                   args=(mov, scene_list, frame_q, halter, reservoir))]
         for i in range(options.workers):
             threads.append(Thread(target=self._worker,
                                   args=(score_obj, frame_q, halter)))
@@ -306,15 +333,19 @@ class ClipFinder(object):
                 continue
         return sorted(rv, key=lambda x: x.score, reverse=True)
 
-    def _frame_yielder(self, scene_list):
+    def _frame_yielder(self, scene_list, skip_frames=None):
         '''Yields frame numbers to sample. 
 
         For efficiency, tries to sample in passes of the video.
+
+        skip_frames - Optional set of frame numbers not to yield
         '''
+        skip_frames = skip_frames or set()
         # Build up a list of scenes. Each scene is a randomized
         # list of frame numbers to pull from
-        scenes2frames = [range(x,y) for x, y in zip(scene_list[:-1],
-                                                    scene_list[1:])]
+        scenes2frames = [[f for f in xrange(x, y) if f not in skip_frames]
+                         for x, y in zip(scene_list[:-1], scene_list[1:])]
+        scenes2frames = [sc for sc in scenes2frames if len(sc) > 0]
         for sc in scenes2frames:
             random.shuffle(sc)
 
@@ -338,13 +369,45 @@ class ClipFinder(object):
                 yield queue.pop()
         
 
-    def _frame_extractor(self, video, scene_list, queue, halt_event):
+    def _enqueue_frame(self, queue, frameno, image, halt_event):
+        '''Puts a frame in the queue, waiting for space.
+
+        Returns False if we are halting.
+        '''
+        while True:
+            if halt_event.is_set():
+                return False
+            try:
+                queue.put((frameno, image), True, 2.0)
+                return True
+            except Queue.Full:
+                pass
+
+    def _frame_extractor(self, video, scene_list, queue, halt_event,
+                         reservoir=None):
         """ populates a queue with frames. Each element of the queue is a
-        tuple of the form (frameno, image)"""
+        tuple of the form (frameno, image)
+
+        Frames in the reservoir are enqueued first, so that they do not
+        need to be decoded again.
+        """
         cur_frame = None
         first_move = True
         enqueue_count = 0
-        for frameno in self._frame_yielder(scene_list):
+        skip_frames = set()
+        if reservoir is not None:
+            for frameno, image in reservoir.get_frames():
+                if not self._enqueue_frame(queue, frameno, image,
+                                           halt_event):
+                    _log.debug('Halt is set. Extractor terminating')
+                    return
+                skip_frames.add(frameno)
+                enqueue_count += 1
+            _log.debug('Enqueued %i frames from the reservoir' %
+                       enqueue_count)
+            reservoir.clear()
+            
+        for frameno in self._frame_yielder(scene_list, skip_frames):
             # Get the frame
             seek_success, cur_frame = pycvutils.seek_video(
                 video, frameno, do_log=first_move, cur_frame=cur_frame)
@@ -359,41 +422,65 @@ class ClipFinder(object):
                 break
 
             # Add the frame to the queue
-            while True:
-                if halt_event.is_set():
-                    _log.debug('Halt is set. Extractor terminating')
-                    return
-                try:
-                    queue.put((frameno, image), True, 2.0)
-                    enqueue_count += 1
-                    if enqueue_count % 100 == 0:
-                        _log.debug('Enqueued %i frames' % enqueue_count)
-                    break
-                except Queue.Full:
-                    pass
+            if not self._enqueue_frame(queue, frameno, image, halt_event):
+                _log.debug('Halt is set. Extractor terminating')
+                return
+            enqueue_count += 1
+            if enqueue_count % 100 == 0:
+                _log.debug('Enqueued %i frames' % enqueue_count)
         _log.debug('Out of frames after %i. Halting' % enqueue_count)
         halt_event.set()
 
+    def _get_frame_batch(self, queue, halt_event):
+        '''Gets a batch of up to options.score_batch_size frames to score.
+
+        Waits for the first frame and then for up to
+        options.score_batch_linger seconds for more frames.
+
+        Returns list of (frameno, image) or None if we are halting
+        '''
+        batch = []
+        while len(batch) == 0:
+            if halt_event.is_set():
+                return None
+            try:
+                batch.append(queue.get(True, 1.0))
+            except Queue.Empty:
+                pass
+
+        deadline = time.time() + options.score_batch_linger
+        while len(batch) < options.score_batch_size:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    batch.append(queue.get(True, remaining))
+                else:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
     def _worker(self, score_obj, queue, halt_event):
         while not halt_event.is_set():
             try:
-                while True:
-                    if halt_event.is_set():
-                        _log.debug('Halting. Worker terminating')
-                        return
-                    try:
-                        frameno, image = queue.get(True, 1.0)
-                        break
-                    except Queue.Empty:
-                        pass
-
-                score, features, version = self.predictor.predict(image)
-                score_obj.update('valence', frameno, score)
-                if self.custom_predictor is not None and features is not None:
-                    score_obj.update('custom', frameno,
-                                     self.custom_predictor.predict(features))
+                batch = self._get_frame_batch(queue, halt_event)
+                if batch is None:
+                    _log.debug('Halting. Worker terminating')
+                    return
 
-                if score_obj.n_scored['valence'] % 100 == 0:
+                results = self.predictor.predict_many(
+                    [image for frameno, image in batch])
+                n_scored = score_obj.n_scored['valence']
+                for (frameno, image), (score, features, version) in \
+                  zip(batch, results):
+                    score_obj.update('valence', frameno, score)
+                    if (self.custom_predictor is not None and
+                        features is not None):
+                        score_obj.update(
+                            'custom', frameno,
+                            self.custom_predictor.predict(features))
+
+                if (n_scored / 100) != (score_obj.n_scored['valence'] / 100):
                     _log.debug('%i images scored so far' %
                               score_obj.n_scored['valence'])
             except model.errors.PredictionError as e:
@@ -402,6 +489,66 @@ class ClipFinder(object):
                 halt_event.set()
 
 
+class FrameReservoir(object):
+    '''Keeps a bounded random sample of frames from each scene.
+
+    Frames are added in order during a sequential pass of the video
+    and each scene keeps a uniform sample of its frames using
+    reservoir sampling. If the total number of frames is over
+    max_frames, a frame is dropped from the scene with the most
+    frames.
+    '''
+    def __init__(self, frames_per_scene, max_frames):
+        self.frames_per_scene = frames_per_scene
+        self.max_frames = max_frames
+        self.clear()
+
+    def clear(self):
+        # List of [n_frames_seen, [(frameno, image)]] for each scene
+        self._scenes = []
+        self._n_frames = 0
+
+    def __len__(self):
+        return self._n_frames
+
+    def add(self, frameno, image, new_scene=False):
+        '''Offers a frame to the reservoir.
+
+        frameno - Frame number in the video
+        image - The image. It is stored so it should not be modified
+        new_scene - True if this frame starts a new scene
+        '''
+        if new_scene or len(self._scenes) == 0:
+            self._scenes.append([0, []])
+        scene = self._scenes[-1]
+        scene[0] += 1
+        frames = scene[1]
+        if len(frames) < self.frames_per_scene:
+            frames.append((frameno, image))
+            self._n_frames += 1
+        else:
+            idx = random.randrange(scene[0])
+            if idx < len(frames):
+                frames[idx] = (frameno, image)
+
+        if self._n_frames > self.max_frames:
+            biggest = max(self._scenes, key=lambda x: len(x[1]))[1]
+            biggest.pop(random.randrange(len(biggest)))
+            self._n_frames -= 1
+
+    def get_frames(self):
+        '''Returns a list of (frameno, image).
+
+        The frames are ordered by taking one frame from each scene in
+        turn so that all the scenes get scored early.
+        '''
+        rv = []
+        scene_frames = [x[1] for x in self._scenes]
+        for i in range(max([len(x) for x in scene_frames] or [0])):
+            rv.extend([x[i] for x in scene_frames if len(x) > i])
+        return rv
+
+
 class RegionScore(object):
     """
     Defines a class that performs scoring of arbitrary regions
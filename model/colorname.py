@@ -8,10 +8,27 @@ __base_path__ = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if sys.path[0] != __base_path__:
     sys.path.insert(0, __base_path__)
 
-w2c_data = np.load(os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                                'data/w2c.dat')))
-w2c_data = w2c_data[0:, 3:]
-w2c_max = np.argmax(w2c_data, axis=1)
+_W2C_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                         'data/w2c.dat'))
+_w2c_lut = None
+
+def get_w2c_lut():
+    '''Returns the quantized RGB -> colorname lookup table.
+
+    The table is indexed by [B >> 3, G >> 3, R >> 3] and is loaded from
+    w2c.dat the first time it is needed. It is read only, so after a
+    fork, the worker processes share the parent's copy.
+    '''
+    global _w2c_lut
+    if _w2c_lut is None:
+        w2c_data = np.load(_W2C_PATH)
+        w2c_data = w2c_data[0:, 3:]
+        # Row i of w2c is the color with R + 32 * G + 32 * 32 * B == i
+        lut = np.argmax(w2c_data, axis=1).astype(np.uint8).reshape(
+            (32, 32, 32))
+        lut.flags.writeable = False
+        _w2c_lut = lut
+    return _w2c_lut
 
 import cv2
 
@@ -32,6 +49,28 @@ def JSD(P, Q):
     _M = 0.5 * (_P + _Q)
     return 0.5 * (entropy(_P, _M) + entropy(_Q, _M))
 
+def batch_JSD(Ps, Q):
+    '''Jensen-Shannon divergence between each row of Ps and Q.
+
+    Equivalent to [JSD(P, Q) for P in Ps], but done in one pass.
+    '''
+    epsilon = 2e-10
+    Ps = np.atleast_2d(np.asarray(Ps, dtype=float))
+    Q = np.asarray(Q, dtype=float)
+    if Ps.shape[0] == 0:
+        return np.zeros(0)
+    # Like JSD, only use the bins where either histogram has mass
+    mask = (Ps + Q) > 0
+    new_P = np.where(mask, Ps + epsilon, 0.0)
+    new_Q = np.where(mask, Q + epsilon, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _P = new_P / np.sum(new_P, axis=1, keepdims=True)
+        _Q = new_Q / np.sum(new_Q, axis=1, keepdims=True)
+        _M = 0.5 * (_P + _Q)
+        kl_P = np.where(mask, _P * np.log(_P / _M), 0.0)
+        kl_Q = np.where(mask, _Q * np.log(_Q / _M), 0.0)
+    return 0.5 * (np.sum(kl_P, axis=1) + np.sum(kl_Q, axis=1))
+
 class ColorName(object):
     '''For a given image, returns the colorname histogram.'''    
 
@@ -40,17 +79,24 @@ class ColorName(object):
         self._hist = self.get_colorname_histogram()
 
     def _image_to_colorname(self):
-        BB = self.image[0:, 0:, 0].astype(int) / 8
-        GG = self.image[0:, 0:, 1].astype(int) / 8
-        RR = self.image[0:, 0:, 2].astype(int) / 8
-        index_im = RR + 32 * GG + 32 * 32 * BB 
-        colorname_image = np.array(w2c_max[index_im])
-        # colorname_image = w2c_max[index_im]
-        return colorname_image
+        quantized = self.image.astype(np.uint8, copy=False) >> 3
+        return get_w2c_lut()[quantized[:, :, 0],
+                             quantized[:, :, 1],
+                             quantized[:, :, 2]]
 
     def get_colorname_histogram(self):
         colorname_image = self._image_to_colorname()
-        hist_result = np.histogram(colorname_image, bins=11)[0]
+        counts = np.bincount(colorname_image.ravel(), minlength=11)
+        # The histogram bins span the range of colornames in the
+        # image, like np.histogram(colorname_image, bins=11) does, but
+        # we only need to bin the 11 counts instead of every pixel.
+        present = np.flatnonzero(counts)
+        if len(present) == 0:
+            # Empty image
+            return np.histogram(colorname_image, bins=11)[0].astype(float)
+        hist_result = np.histogram(np.arange(len(counts)), bins=11,
+                                   range=(present[0], present[-1]),
+                                   weights=counts)[0]
         normalized_hist = hist_result.astype(float)/sum(hist_result)
         return normalized_hist
 
@@ -76,6 +76,8 @@ class MovieMultipleFeatureGenerator(object):
         self.max_height = max_height
         self.crop_frac = crop_frac
         self.startend_buffer = startend_buffer
+        # DecodeStats for the last call to generate()
+        self.decode_stats = None
 
     def __str__(self):
         return utils.obj.full_object_str(self)
@@ -87,11 +89,16 @@ class MovieMultipleFeatureGenerator(object):
     def reset(self):
         self._reset_generators()
 
-    def generate(self, mov):
+    def generate(self, mov, frame_callback=None):
         '''Generate features for all the frames in the movie.
 
         Inputs:
         mov - OpenCv Video capture object
+        frame_callback - Optional function called for every frame as
+                         frame_callback(frameno, prepped_image,
+                                        {<generator class> : <features>})
+                         so that the caller can use the decoded frames
+                         without decoding the video again.
 
         Outputs:
         Nested dictionary of 
@@ -107,6 +114,8 @@ class MovieMultipleFeatureGenerator(object):
         read_sucess = True
         first_move = True
         cur_frame = None
+        self.decode_stats = pycvutils.DecodeStats()
+        prep = self._get_prep()
 
         while (seek_sucess and read_sucess and 
                next_frame < (num_frames - frame_buf)):
@@ -115,7 +124,8 @@ class MovieMultipleFeatureGenerator(object):
                     mov,
                     next_frame,
                     do_log=first_move,
-                    cur_frame=cur_frame)
+                    cur_frame=cur_frame,
+                    stats=self.decode_stats)
                 if not seek_sucess:
                     if cur_frame is None:
                         raise model.errors.VideoReadError(
@@ -124,16 +134,20 @@ class MovieMultipleFeatureGenerator(object):
                 first_move = False
                 
                 # Read the frame
-                read_sucess, image = mov.read()
+                read_sucess, image = pycvutils.read_frame(mov,
+                                                          self.decode_stats)
                 if not read_sucess:
                     break
                 frameno = cur_frame
 
-                prep = self._get_prep()
                 prepped_image = prep(image)
+                frame_feats = {}
                 for gen in self.feature_generators:
                     feats = gen.generate(prepped_image)
                     rval[gen.__class__][int(frameno)] = feats
+                    frame_feats[gen.__class__] = feats
+                if frame_callback is not None:
+                    frame_callback(int(frameno), prepped_image, frame_feats)
 
                 if (frameno % (self.frame_step * 1000)) == 0:
                     _log.debug('Extracted features from %i frames' %
@@ -148,12 +162,14 @@ class MovieMultipleFeatureGenerator(object):
                                "from a video")
                 break
 
+        _log.debug('Decoding for feature generation: %s' % self.decode_stats)
         return rval
 
     def _get_prep(self):
         return pycvutils.ImagePrep(
             max_height=self.max_height,
-            crop_frac=self.crop_frac)
+            crop_frac=self.crop_frac,
+            fuse_steps=True)
         
 
 class RegionFeatureGenerator(FeatureGenerator):
@@ -174,7 +174,7 @@ import cv2
 import model
 import model.errors
 import numpy as np
-from model.colorname import ColorName
+from model.colorname import ColorName, batch_JSD
 from utils import statemon
 from utils import pycvutils
 from utils.options import define, options
@@ -294,6 +294,25 @@ class Statistics(object):
         if init is not None:
             self.push(init)
 
+    def push_many(self, x):
+        """
+        pushes an array of values, in order, as if push was called on
+        each one.
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        if len(x) == 0:
+            return
+        self._update_var = True
+        self._update_mean = True
+        self._update_median = True
+        n_free = min(self._max_size - self._count, len(x))
+        self._vals[self._count:(self._count + n_free)] = x[:n_free]
+        self._count += n_free
+        if n_free < len(x):
+            # randomly replace one for each of the rest
+            idx = np.random.choice(self._max_size, len(x) - n_free)
+            self._vals[idx] = x[n_free:]
+
     def push(self, x):
         """
         pushes a value onto x
@@ -369,11 +388,12 @@ class ColorStatistics(object):
         Parameters:
             max_size = the maximum number of color histograms to store.
         """
-        self._ColObjs = []
         self._max_size = max_size
         self._count = 0
         self._dists = Statistics()
         self._prep = pycvutils.ImagePrep(max_side=480)
+        # Preallocated store of the color histograms, one per row
+        self._hists = np.zeros((max_size, 11))
 
     def push(self, img):
         """
@@ -381,14 +401,13 @@ class ColorStatistics(object):
         object, this does *not* support pushing multiple items simultaneously.
         """
         cn = ColorName(self._prep(img))
-        for pcn in self._ColObjs:
-            self._dists.push(pcn.dist(cn))
+        self._dists.push_many(batch_JSD(self._hists[:self._count], cn._hist))
         if self._count == self._max_size:
             # randomly replace one
             idx = np.random.choice(self._max_size)
-            self._ColObjs[idx] = cn
+            self._hists[idx] = cn._hist
         else:
-            self._ColObjs.append(cn)
+            self._hists[self._count] = cn._hist
             self._count += 1
 
     @property
@@ -930,14 +949,34 @@ class ResultsList(object):
                 self.n_thumbs = n_thumbs
             self.results = [_Result() for x in range(self.n_thumbs)]
             self.min = self.results[0].score
+            # Pairwise distances between the results, the colorname
+            # histograms they are computed from and the distance from
+            # each result to its closest neighbour.
             self.dists = np.zeros((self.n_thumbs, self.n_thumbs))
+            self._hists = np.zeros((self.n_thumbs, 11))
+            self._defined = np.zeros(self.n_thumbs, dtype=bool)
+            self.min_dists = np.zeros(self.n_thumbs)
             self.failed_scoring = 0
 
-    def _update_dists(self, entry_idx):
-        for idx in range(len(self.results)):
-            dst = self.results[idx].dist(self.results[entry_idx])
-            self.dists[idx, entry_idx] = dst
-            self.dists[entry_idx, idx] = dst
+    def _update_dists(self, entry_idx, new_dists=None):
+        '''
+        Updates the row and column of the distance matrix for the result
+        at entry_idx. new_dists are the distances from that result to the
+        results before it was inserted, if they are already known.
+        '''
+        res = self.results[entry_idx]
+        self._defined[entry_idx] = res._defined
+        if res._defined:
+            self._hists[entry_idx] = res._color_name._hist
+        if new_dists is None:
+            new_dists = self._compute_new_dist(res)
+        else:
+            new_dists = np.array(new_dists, dtype=float)
+        # the same object is infinitely different from itself
+        new_dists[entry_idx] = np.inf if res._defined else 0
+        self.dists[entry_idx, :] = new_dists
+        self.dists[:, entry_idx] = new_dists
+        self.min_dists = np.min(self.dists, 1)
 
     def accept_replace(self, frameno, score, image=None, feat_score=None,
                        meta=None, feat_score_func=None, model_vers=None,
@@ -974,28 +1013,36 @@ class ResultsList(object):
         Returns the distance of the new result object to all result objects
         currently in the list of result objects.
         '''
-        dists = []
-        for rres in self.results:
-            dists.append(res.dist(rres))
-        return np.array(dists)
-
-    def _push_over_lowest(self, res):
+        dists = np.empty(len(self.results))
+        if not res._defined:
+            dists.fill(np.inf)
+            dists[~self._defined] = 0
+            return dists
+        dists.fill(np.inf)
+        if np.any(self._defined):
+            dists[self._defined] = batch_JSD(self._hists[self._defined],
+                                             res._color_name._hist)
+        return dists
+
+    def _push_over_lowest(self, res, new_dists=None):
         '''
         Replaces the current lowest-scoring result with whatever res is. Note:
         this does not check that res's score > the min score. It's assumed
         that this is done in accept_replace.
         '''
         sco_by_idx = np.argsort([x.comb_score for x in self.results])
-        return self._replace(sco_by_idx[0], res)
+        return self._replace(sco_by_idx[0], res, new_dists)
 
-    def _replace(self, idx, res):
+    def _replace(self, idx, res, new_dists=None):
         '''
         The thumbnail at index idx is replaced by the thumbnail res.
+        new_dists are the distances from res to the current results, if
+        they are already known.
         '''
         old = self.results[idx]
         self.results[idx] = res
         _log.debug('%s is replacing %s' % (res, old))
-        self._update_dists(idx)
+        self._update_dists(idx, new_dists)
         self._update_min()
         self._write_testing_frame(res, 'accept', idx)
         return True
@@ -1028,10 +1075,6 @@ class ResultsList(object):
         'closest' thumbnail is less than self.min_acceptable are automatically
         rejected.
         '''
-        repl_idx = [x for x in range(len(self.results)) if
-                    self.results[x] < res]
-        # get dists as they are now
-        mdists = np.min(self.dists[repl_idx], 1)
         # get the distances of the candidate to the current results
         dists = self._compute_new_dist(res)
         arg_srt_idx = np.argsort(dists)
@@ -1041,7 +1084,7 @@ class ResultsList(object):
             _log.debug(('%s thumbnail is sufficiently different from the '
                         'other thumbnails given the variety seen in the '
                         'video to be accepted') % (res))
-            return self._push_over_lowest(res)
+            return self._push_over_lowest(res, dists)
 
         if dists[arg_srt_idx[0]] < self.min_acceptable:
             # it's too close to the other thumbnails.
@@ -1053,7 +1096,7 @@ class ResultsList(object):
                 if (self.results[arg_srt_idx[0]].comb_score <
                         res.comb_score):
                     # replace the closest one.
-                    return self._replace(arg_srt_idx[0], res)
+                    return self._replace(arg_srt_idx[0], res, dists)
                 else:
                     _log.debug('Most similar thumb is better than candidate')
                     self._write_testing_frame(res, ('too_similar_to_all_but_'
@@ -1072,10 +1115,18 @@ class ResultsList(object):
         # if there are any undefined thumbnails, replace them.
         undef_thumbs = filter(lambda x: x.score == -np.inf, self.results)
         if len(undef_thumbs):
-            return self._push_over_lowest(res)
+            return self._push_over_lowest(res, dists)
         # otherwise, iterate over the lowest scoring ones and replace the
         # lowest one that is 'less different' than you are from the
-        # remaining thumbnails
+        # remaining thumbnails. The candidate's minimum distance if idx
+        # is replaced is the distance to its closest thumbnail, unless
+        # that's idx, in which case it's the second closest.
+        c_min_dists = np.where(np.arange(len(dists)) == arg_srt_idx[0],
+                               dists[arg_srt_idx[1]],
+                               dists[arg_srt_idx[0]])
+        # if the resulting minimum distance is >= the results minimum
+        # distance, you may replace it.
+        replaceable = c_min_dists >= self.min_dists
         sco_by_idx = np.argsort([x.comb_score for x in self.results])
         for idx in sco_by_idx:
             if self.results[idx].comb_score > res.comb_score:
@@ -1083,17 +1134,10 @@ class ResultsList(object):
                 _log.debug('There are no low-scoring less-varied thumbnails for %s' % (res))
                 self._write_testing_frame(res, 'none_replaceable')
                 return False
-            # see if you can replace it
-            if idx == arg_srt_idx[0]:
-                c_min_dist = dists[arg_srt_idx[1]]
-            else:
-                c_min_dist = dists[arg_srt_idx[0]]
-            # if the resulting minimum distance is >= the results minimum
-            # distance, you may replace it.
-            if c_min_dist >= np.min(self.dists[idx]):
+            if replaceable[idx]:
                 break
         # replace the idx
-        return self._replace(idx, res)
+        return self._replace(idx, res, dists)
 
     def _update_min(self):
         '''
@@ -15,6 +15,7 @@ import traceback
 import numpy as np
 from bisect import *
 import threading
+import heapq
 from Queue import PriorityQueue, Empty
 from itertools import cycle
 
@@ -213,3 +214,199 @@ class MCMH(object):
 
 
 
+
+
+class ArrayMCMH(object):
+    '''
+    An array backed version of MCMH.
+
+    It implements the same interface and sampling rules as MCMH, but
+    keeps its state in numpy arrays instead of dictionaries and sorted
+    lists, so samples can be proposed and scores accepted in
+    batches. See get_samples() and update_many().
+    '''
+    def __init__(self, elements, search_interval, clip=None):
+        '''
+        elements: the number of elements to search over.
+        search_interval: The number of frames between search frames plus the
+                         start frame.
+        clip: how much of the bookends of the region to ignore, as a fraction.
+        '''
+        self.search_interval = search_interval
+        self.clip = clip
+        self.elements = elements
+        self._lock = threading.Lock()
+        self._setup()
+
+    def _setup(self):
+        '''
+        Allocates all the required memory and things.
+        '''
+        N = self.elements
+        c = self.clip or 0.
+
+        start = int(c * N)
+        stop = int(N - (c * N))
+        # frame number of each search frame
+        self._framenos = np.arange(start, stop, self.search_interval).astype(int)
+        n_sf = len(self._framenos)
+
+        self._tot = 0.  # sum of scores
+        self.n_samples = 0.
+        self._n = 0.  # total scored
+
+        self._scores = np.zeros(n_sf)
+        self._scored = np.zeros(n_sf, dtype=bool)
+        # search frames that have not been handed out as samples
+        self._available = np.ones(n_sf, dtype=bool)
+        self._srt_scores = np.zeros(0)  # scores, sorted by the score
+        self._search_heap = []  # (-estimated score, search frame)
+        self._up_next = []  # samples that complete a search interval
+        self.max_samps = n_sf
+
+    @property
+    def _mean(self):
+        return self._tot / max(self._n, 1.)
+
+    def update(self, frameno, score):
+        self.update_many([frameno], [score])
+
+    def update_many(self, framenos, scores):
+        '''
+        Updates the knowledge of the algorithm with a batch of scores.
+
+        framenos: list of frame numbers
+        scores: list of scores for those frames
+        '''
+        with self._lock:
+            self._update_many(framenos, scores)
+
+    def _update_many(self, framenos, scores):
+        framenos = np.asarray(framenos, dtype=int)
+        scores = np.asarray(scores, dtype=float)
+        sfs = np.searchsorted(self._framenos, framenos)
+        sfs[sfs >= len(self._framenos)] = 0
+        valid = self._framenos[sfs] == framenos
+        if not np.all(valid):
+            _log.warn('Invalid search frame.')
+        valid &= ~self._scored[sfs]
+        # Only keep the first score for a frame in this batch
+        _, first_idx = np.unique(sfs, return_index=True)
+        first = np.zeros(len(sfs), dtype=bool)
+        first[first_idx] = True
+        valid &= first
+        sfs = sfs[valid]
+        scores = scores[valid]
+        if len(sfs) == 0:
+            return
+
+        newly_scored = np.zeros(len(self._scored), dtype=bool)
+        newly_scored[sfs] = True
+        self._scores[sfs] = scores
+        self._scored[sfs] = True
+
+        # Intervals with both ends scored for the first time can be
+        # searched.
+        searchable = np.nonzero(
+            self._scored[:-1] & self._scored[1:] &
+            (newly_scored[:-1] | newly_scored[1:]))[0]
+        ests = (self._scores[searchable] + self._scores[searchable + 1]) * 0.5
+        for est, sf in zip(ests, searchable):
+            heapq.heappush(self._search_heap, (-est, int(sf)))
+
+        scores = np.sort(scores)
+        self._srt_scores = np.insert(
+            self._srt_scores, np.searchsorted(self._srt_scores, scores),
+            scores)
+        self._tot += np.sum(scores)
+        self._n += len(scores)
+        self.n_samples += len(scores)
+        _log.debug('Sampling %.1f%% complete',
+                   self.n_samples * 100. / self.max_samps)
+
+    def get_search(self):
+        '''
+        Returns an interval to search.
+        '''
+        with self._lock:
+            if len(self._search_heap) == 0:
+                return
+            est, sf = heapq.heappop(self._search_heap)
+            return (self._framenos[sf], self._scores[sf],
+                    self._framenos[sf + 1], self._scores[sf + 1])
+
+    def get_sample(self):
+        '''
+        Returns a frame to search.
+        '''
+        samples = self.get_samples(1)
+        if len(samples) == 0:
+            _log.debug('Sampling complete.')
+            return None
+        return samples[0]
+
+    def get_samples(self, n):
+        '''
+        Returns up to n frame numbers to sample.
+
+        Fewer are returned only if there is nothing left to sample.
+        '''
+        with self._lock:
+            sfs = self._up_next[:n]
+            del self._up_next[:n]
+            while len(sfs) < n:
+                accepted = self._propose(n - len(sfs))
+                if accepted is None:
+                    break
+                for sf in accepted:
+                    if len(sfs) >= n:
+                        # Save the rest for the next call
+                        self._up_next.append(sf)
+                    else:
+                        sfs.append(sf)
+            return [self._framenos[sf] for sf in sfs]
+
+    def _propose(self, n):
+        '''
+        Proposes a batch of search frames and accepts them with a
+        probability of the rank of their interpolated score. Each
+        accepted frame is followed by the next search frame, if it is
+        available, to complete a search interval.
+
+        Returns a list of accepted search frames, possibly empty, or
+        None if there is nothing left to sample.
+        '''
+        avail = np.nonzero(self._available)[0]
+        if len(avail) == 0:
+            return None
+        cands = avail[np.random.randint(len(avail), size=max(2 * n, 16))]
+        ranks = ((1. + np.searchsorted(self._srt_scores,
+                                       self._interp_scores(cands))) /
+                 (1. + len(self._srt_scores)))
+        cands = cands[np.random.rand(len(cands)) < ranks]
+
+        accepted = []
+        for sf in cands:
+            if len(accepted) >= n:
+                break
+            if not self._available[sf]:
+                continue
+            self._available[sf] = False
+            accepted.append(int(sf))
+            if sf + 1 < len(self._available) and self._available[sf + 1]:
+                self._available[sf + 1] = False
+                accepted.append(int(sf + 1))
+        return accepted
+
+    def _interp_scores(self, sfs):
+        '''
+        Returns the interpolated scores for an array of search frames.
+
+        Past the first and last scored frames, the scores are
+        interpolated towards the mean score.
+        '''
+        scored_idx = np.nonzero(self._scored)[0]
+        mean = self._mean
+        xp = np.concatenate(([-1], scored_idx, [len(self._scored)]))
+        fp = np.concatenate(([mean], self._scores[scored_idx], [mean]))
+        return np.interp(sfs, xp, fp)
@@ -42,6 +42,7 @@ statemon.define('good_deepnet_connection', int)
 statemon.define('prediction_error', int)
 statemon.define('unknown_demographic', int)
 statemon.define('unknown_model', int)
+statemon.define_histogram('prediction_latency')
 # MEAN_CHANNEL_VALS are the mean pixel value, per channel, of all of our
 # training images. This will remain constant: it's a mean over millions of
 # images so is unlikely to change significantly. We won't be recomputing it.
@@ -319,8 +320,11 @@ class Predictor(object):
         while cur_try < ntries:
             cur_try += 1
             try:
+                start_time = time.time()
                 score, vec, vers = yield self._predict(image,
                                                        *args, **kwargs)
+                statemon.state.record('prediction_latency',
+                                      time.time() - start_time)
                 raise tornado.gen.Return((score, vec, vers))
             except tornado.gen.Return:
                 raise
@@ -338,6 +342,30 @@ class Predictor(object):
             raise e
         raise model.errors.PredictionError(str(e))
 
+    @utils.sync.optional_sync
+    @tornado.gen.coroutine
+    def predict_many(self, images, *args, **kwargs):
+        '''Predicts the valence scores of a batch of images.
+
+        The images are scored concurrently, so the batch costs about one
+        round trip to the model instead of one per image. Takes the
+        same arguments as predict().
+
+        Inputs:
+        images - list of numpy arrays of the images
+
+        Returns: list of (predicted valence score, feature vector,
+                 model_version) in the same order as images
+
+        Raises: PredictionError if any of the images could not be scored
+        '''
+        if len(images) == 0:
+            raise tornado.gen.Return([])
+        kwargs['async'] = True
+        results = yield [self.predict(image, *args, **kwargs)
+                         for image in images]
+        raise tornado.gen.Return(results)
+
     @tornado.gen.coroutine
     def _predict(self, image, *args, **kwargs):
         '''Predicts the valence score of an image synchronously.
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+import os.path
+import sys
+__base_path__ = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             '..', '..'))
+if sys.path[0] != __base_path__:
+    sys.path.insert(0, __base_path__)
+
+from mock import patch, MagicMock
+from model.clip_finder import ClipFinder, FrameReservoir
+import model.features
+import numpy as np
+import Queue
+import random
+import threading
+import unittest
+
+class TestFrameReservoir(unittest.TestCase):
+    def setUp(self):
+        random.seed(1984)
+
+    def _add_scene(self, reservoir, framenos):
+        for i, frameno in enumerate(framenos):
+            reservoir.add(frameno, 'image%i' % frameno, new_scene=(i == 0))
+
+    def _framenos(self, reservoir):
+        return [x[0] for x in reservoir.get_frames()]
+
+    def test_bounded_per_scene(self):
+        reservoir = FrameReservoir(3, 100)
+        self._add_scene(reservoir, range(0, 10))
+        first_scene = self._framenos(reservoir)
+        self.assertEqual(len(first_scene), 3)
+        self.assertTrue(all(x in range(0, 10) for x in first_scene))
+
+        self._add_scene(reservoir, range(10, 12))
+
+        self.assertEqual(len(reservoir), 5)
+        framenos = self._framenos(reservoir)
+        self.assertItemsEqual(framenos, first_scene + [10, 11])
+        self.assertEqual(reservoir.get_frames()[1], (10, 'image10'))
+
+    def test_frames_without_scene_start(self):
+        reservoir = FrameReservoir(3, 100)
+        for frameno in range(5):
+            reservoir.add(frameno, 'image', new_scene=False)
+
+        self.assertEqual(len(reservoir), 3)
+
+    def test_max_frames_drops_from_biggest_scene(self):
+        reservoir = FrameReservoir(5, 6)
+        self._add_scene(reservoir, range(0, 5))
+        self._add_scene(reservoir, range(10, 12))
+
+        self.assertEqual(len(reservoir), 6)
+        framenos = self._framenos(reservoir)
+        self.assertEqual(len([x for x in framenos if x < 10]), 4)
+        self.assertItemsEqual([x for x in framenos if x >= 10], [10, 11])
+
+        self._add_scene(reservoir, [20])
+
+        self.assertEqual(len(reservoir), 6)
+        framenos = self._framenos(reservoir)
+        self.assertEqual(len([x for x in framenos if x < 10]), 3)
+        self.assertItemsEqual([x for x in framenos if x >= 10],
+                              [10, 11, 20])
+
+    def test_round_robin_order(self):
+        reservoir = FrameReservoir(3, 100)
+        self._add_scene(reservoir, [0, 1, 2])
+        self._add_scene(reservoir, [10])
+        self._add_scene(reservoir, [20, 21])
+
+        self.assertEqual(self._framenos(reservoir),
+                         [0, 10, 20, 1, 21, 2])
+
+    def test_clear(self):
+        reservoir = FrameReservoir(3, 100)
+        self._add_scene(reservoir, [0, 1, 2])
+        reservoir.clear()
+
+        self.assertEqual(len(reservoir), 0)
+        self.assertEqual(reservoir.get_frames(), [])
+
+class TestFrameExtraction(unittest.TestCase):
+    def setUp(self):
+        random.seed(1984)
+        self.clip_finder = ClipFinder(MagicMock(), MagicMock(), MagicMock())
+        self.scene_list = [0, 20, 40, 45]
+
+    def test_yielder_skips_frames(self):
+        skip_frames = set([0, 5, 19, 20, 40, 41, 42, 43, 44])
+
+        framenos = list(self.clip_finder._frame_yielder(self.scene_list,
+                                                        skip_frames))
+
+        self.assertItemsEqual(framenos,
+                              [x for x in range(45) if x not in skip_frames])
+
+    def test_yielder_without_skip_frames(self):
+        framenos = list(self.clip_finder._frame_yielder(self.scene_list))
+
+        self.assertItemsEqual(framenos, range(45))
+
+    @patch('model.clip_finder.pycvutils.seek_video')
+    def test_extractor_does_not_decode_reservoir_frames(self, seek_mock):
+        seek_mock.side_effect = lambda video, frameno, **kw: (True, frameno)
+        video = MagicMock()
+        video.read.return_value = (True, 'decoded')
+        reservoir = FrameReservoir(2, 100)
+        for frameno in range(45):
+            reservoir.add(frameno, 'reservoir',
+                          new_scene=(frameno in self.scene_list))
+        reservoir_frames = self._framenos(reservoir)
+        queue = Queue.Queue()
+        halt_event = threading.Event()
+
+        self.clip_finder._frame_extractor(video, self.scene_list, queue,
+                                          halt_event, reservoir)
+
+        frames = []
+        while not queue.empty():
+            frames.append(queue.get_nowait())
+        self.assertEqual([x[0] for x in frames[:len(reservoir_frames)]],
+                         reservoir_frames)
+        self.assertTrue(all(x[1] == 'reservoir'
+                            for x in frames[:len(reservoir_frames)]))
+        self.assertTrue(all(x[1] == 'decoded'
+                            for x in frames[len(reservoir_frames):]))
+        self.assertItemsEqual([x[0] for x in frames], range(45))
+        seeked = [x[0][1] for x in seek_mock.call_args_list]
+        self.assertFalse(set(seeked) & set(reservoir_frames))
+        self.assertEqual(len(reservoir), 0)
+        self.assertTrue(halt_event.is_set())
+
+    def _framenos(self, reservoir):
+        return [x[0] for x in reservoir.get_frames()]
+
+class MeanGenerator(object):
+    def reset(self):
+        pass
+
+    def generate(self, image):
+        return np.mean(image)
+
+class TestFrameCallback(unittest.TestCase):
+    @patch('model.features.pycvutils.read_frame')
+    @patch('model.features.pycvutils.seek_video')
+    def test_callback_gets_prepped_frames(self, seek_mock, read_mock):
+        seek_mock.side_effect = lambda mov, frameno, **kw: (True, frameno)
+        read_mock.return_value = (True, np.ones((720, 1280, 3), np.uint8))
+        mov = MagicMock()
+        mov.get.return_value = 10
+        generator = model.features.MovieMultipleFeatureGenerator(
+            [MeanGenerator()], max_height=360, frame_step=2)
+        callback = MagicMock()
+
+        features = generator.generate(mov, frame_callback=callback)
+
+        self.assertGreater(callback.call_count, 0)
+        self.assertEqual([x[0][0] for x in callback.call_args_list],
+                         sorted(features[MeanGenerator].keys()))
+        for args, kwargs in callback.call_args_list:
+            frameno, image, feats = args
+            self.assertEqual(image.shape, (360, 640, 3))
+            self.assertEqual(feats, {MeanGenerator: 1.0})
+
+if __name__ == '__main__':
+    unittest.main()
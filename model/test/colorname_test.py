@@ -12,6 +12,7 @@ import numpy as np
 import sys
 import random
 from model.colorname import JSD
+from model.colorname import batch_JSD
 from model.colorname import ColorName
 from model.video_searcher import VideoSearcher
 
@@ -34,6 +35,18 @@ class TestColorName(unittest.TestCase):
         some_difference = JSD([0.5, 0.5, 0], [0, 0.5, 0.5])
         self.assertGreater(significant_difference, some_difference)
 
+    def test_batch_JSD(self):
+        hists = np.array([[0, 0, 0],
+                          [0.1, 0.2, 0.7],
+                          [1, 0, 0],
+                          [0.5, 0.5, 0],
+                          [0, 0.5, 0.5]])
+        for Q in ([0.1, 0.2, 0.7], [0, 1, 0], [0, 0, 0]):
+            np.testing.assert_allclose(batch_JSD(hists, Q),
+                                       [JSD(P, Q) for P in hists],
+                                       atol=1e-12)
+        self.assertEquals(len(batch_JSD(np.zeros((0, 3)), [1, 0, 0])), 0)
+
     def test_image_to_colorname_color(self):
     	image = np.array([[
     						[0, 0, 0],
@@ -55,6 +68,21 @@ class TestColorName(unittest.TestCase):
     	cn_hist = colorname_image.get_colorname_histogram()
     	self.assertItemsEqual(cn_hist, np.ones(11) * 1.0 / 11.0)
 
+    def test_histogram_matches_numpy(self):
+        # Only some of the colornames are in the image, so the bins do
+        # not line up with the colornames
+        image = np.array([[[0, 0, 0],
+                           [0, 0, 0],
+                           [63, 102, 127],
+                           [127, 127, 127],
+                           [0, 255, 0],
+                           [0, 255, 0]]], dtype=np.uint8)
+        colorname_image = ColorName(image)
+        expected = np.histogram(colorname_image._image_to_colorname(),
+                                bins=11)[0]
+        np.testing.assert_allclose(colorname_image.get_colorname_histogram(),
+                                   expected.astype(float) / sum(expected))
+
     def test_get_distance(self):
     	image_1 = np.array([[
     						[0, 0, 0],
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import os.path
+import sys
+__base_path__ = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             '..', '..'))
+if sys.path[0] != __base_path__:
+    sys.path.insert(0, __base_path__)
+
+import logging
+from model.metropolisHastingsSearch import MCMH, ArrayMCMH
+import numpy as np
+import unittest
+
+_log = logging.getLogger(__name__)
+
+def score_curve(n_frames):
+    '''A fixed score for each frame with a peak in the middle.'''
+    x = np.arange(n_frames, dtype=float) / n_frames
+    return np.exp(-(x - 0.5)**2 / 0.02)
+
+def run_sampler(sampler, scores, batch_size=1):
+    '''Samples and scores every search frame.
+
+    Returns the list of sampled frames and the list of searches.
+    '''
+    samples = []
+    searches = []
+    while True:
+        if batch_size == 1:
+            frameno = sampler.get_sample()
+            framenos = [] if frameno is None else [frameno]
+        else:
+            framenos = sampler.get_samples(batch_size)
+        if len(framenos) == 0:
+            break
+        samples.extend(framenos)
+        if batch_size == 1:
+            sampler.update(framenos[0], scores[framenos[0]])
+        else:
+            sampler.update_many(framenos, [scores[x] for x in framenos])
+    while True:
+        search = sampler.get_search()
+        if search is None:
+            break
+        searches.append(search)
+    return samples, searches
+
+class TestArrayMCMH(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1984)
+        self.scores = score_curve(1000)
+        self.sampler = ArrayMCMH(1000, 10, 0.1)
+        self.search_frames = range(100, 900, 10)
+
+    def _check_masks(self):
+        scored = self.sampler._scored
+        self.assertEqual(np.sum(scored), self.sampler.n_samples)
+        # Frames are only scored after they have been handed out
+        self.assertFalse(np.any(scored & self.sampler._available))
+        np.testing.assert_array_equal(
+            self.sampler._srt_scores,
+            np.sort(self.sampler._scores[scored]))
+
+    def test_every_frame_sampled_once(self):
+        samples, searches = run_sampler(self.sampler, self.scores)
+
+        self.assertItemsEqual(samples, self.search_frames)
+        self.assertEqual(self.sampler.n_samples, len(self.search_frames))
+        self.assertIsNone(self.sampler.get_sample())
+
+    def test_every_frame_sampled_once_in_batches(self):
+        samples, searches = run_sampler(self.sampler, self.scores,
+                                        batch_size=7)
+
+        self.assertItemsEqual(samples, self.search_frames)
+        self.assertEqual(self.sampler.get_samples(3), [])
+
+    def test_update_keeps_masks_consistent(self):
+        framenos = self.sampler.get_samples(10)
+        for frameno in framenos[:4]:
+            self.sampler.update(frameno, self.scores[frameno])
+            self._check_masks()
+        self.sampler.update_many(framenos[4:],
+                                 [self.scores[x] for x in framenos[4:]])
+        self._check_masks()
+        self.assertEqual(self.sampler.n_samples, 10)
+
+        # Scoring a frame twice, or a frame that is not a search frame,
+        # changes nothing.
+        self.sampler.update(framenos[0], 100.)
+        self.sampler.update_many([framenos[1], 101, framenos[1]],
+                                 [100., 100., 100.])
+        self._check_masks()
+        self.assertEqual(self.sampler.n_samples, 10)
+        self.assertNotIn(100., self.sampler._srt_scores)
+
+    def test_search_is_complete_interval(self):
+        self.sampler.update_many([200, 210, 220],
+                                 [self.scores[200], 0.0, self.scores[220]])
+
+        first = self.sampler.get_search()
+        second = self.sampler.get_search()
+        self.assertIsNone(self.sampler.get_search())
+
+        # The interval with the higher estimate comes first
+        self.assertEqual(first, (210, 0.0, 220, self.scores[220]))
+        self.assertEqual(second, (200, self.scores[200], 210, 0.0))
+
+    def test_searches_cover_all_intervals(self):
+        samples, searches = run_sampler(self.sampler, self.scores)
+
+        self.assertItemsEqual(
+            [(x[0], x[2]) for x in searches],
+            zip(self.search_frames[:-1], self.search_frames[1:]))
+        for f1, s1, f2, s2 in searches:
+            self.assertEqual(f2 - f1, 10)
+            self.assertEqual(s1, self.scores[f1])
+            self.assertEqual(s2, self.scores[f2])
+
+    def test_matches_mcmh(self):
+        mcmh = MCMH(1000, 10, 0.1)
+        self.assertEqual(self.sampler.max_samps, mcmh.max_samps)
+
+        mcmh_samples, mcmh_searches = run_sampler(mcmh, self.scores)
+        samples, searches = run_sampler(self.sampler, self.scores)
+
+        self.assertItemsEqual(samples, mcmh_samples)
+        self.assertItemsEqual(searches, mcmh_searches)
+        self.assertEqual(self.sampler.n_samples, mcmh.n_samples)
+        self.assertAlmostEqual(self.sampler._mean, mcmh._mean)
+
+    def test_search_order_matches_mcmh(self):
+        mcmh = MCMH(1000, 10, 0.1)
+        for frameno in self.search_frames:
+            mcmh.update(frameno, self.scores[frameno])
+        self.sampler.update_many(self.search_frames,
+                                 [self.scores[x] for x in self.search_frames])
+
+        for i in range(len(self.search_frames)):
+            self.assertEqual(self.sampler.get_search(), mcmh.get_search())
+
+    def test_interpolated_scores_match_mcmh(self):
+        mcmh = MCMH(1000, 10, 0.1)
+        for frameno in [150, 300, 550]:
+            mcmh.update(frameno, self.scores[frameno])
+            self.sampler.update(frameno, self.scores[frameno])
+
+        sfs = np.arange(self.sampler.max_samps)
+        np.testing.assert_allclose(
+            self.sampler._interp_scores(sfs),
+            [mcmh._interp_score(x) for x in sfs])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -242,6 +242,28 @@ class TestDeepnetPredictorGoodConnection(test_utils.neontest.AsyncTestCase):
                 yield self.predictor.predict(self.image, base_time=0.0,
                                              async=True)
         
+    @tornado.testing.gen_test
+    def test_predict_many(self):
+        responses = []
+        for score in [0.1, 0.2, 0.3]:
+            response = AquilaResponse()
+            response.valence.append(score)
+            responses.append(response)
+        self.mock_regress_call.side_effect = responses
+
+        results = yield self.predictor.predict_many(
+            [self.image, self.image, self.image], async=True)
+
+        self.assertEquals(len(results), 3)
+        for result, score in zip(results, [0.1, 0.2, 0.3]):
+            self.assertAlmostEquals(result[0], score)
+            self.assertEquals(result[2], 'aqv1.1.250')
+        self.assertEquals(self.mock_regress_call.call_count, 3)
+        self.assertEquals(self.predictor.active, 0)
+
+        results = yield self.predictor.predict_many([], async=True)
+        self.assertEquals(results, [])
+
     # TODO(Nick): Add more tests
 
 if __name__ == '__main__':
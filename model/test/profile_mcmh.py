@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''Microbenchmark of the MCMH samplers used by the LocalSearcher.
+
+Runs MCMH and ArrayMCMH over a synthetic score curve and reports how
+long it takes to draw all the samples, along with the average score
+of the first samples drawn, which should be similar for both.
+
+Copyright: 2016 Neon Labs
+'''
+import os.path
+import sys
+__base_path__ = os.path.abspath(os.path.join(os.path.dirname(__file__), '..',
+                                             '..'))
+if sys.path[0] != __base_path__:
+    sys.path.insert(0, __base_path__)
+
+import logging
+from model.metropolisHastingsSearch import MCMH, ArrayMCMH
+import numpy as np
+from optparse import OptionParser
+import time
+
+_log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+def score_curve(n_frames, seed=1984):
+    '''A smooth, multimodal synthetic score for each frame.'''
+    rng = np.random.RandomState(seed)
+    x = np.arange(n_frames, dtype=float) / n_frames
+    curve = np.zeros(n_frames)
+    for i in range(8):
+        curve += (rng.rand() *
+                  np.exp(-(x - rng.rand())**2 / (2 * (0.02 + 0.05*rng.rand())**2)))
+    return curve + 0.05 * rng.randn(n_frames)
+
+def run_sampler(sampler_class, scores, search_interval, batch_size, seed):
+    '''Draws every sample and returns (seconds, mean of early scores).'''
+    np.random.seed(seed)
+    sampler = sampler_class(len(scores), search_interval, 0.1)
+    n_early = sampler.max_samps / 10
+    sampled = []
+    start_time = time.time()
+    while True:
+        if batch_size > 1 and hasattr(sampler, 'get_samples'):
+            framenos = sampler.get_samples(batch_size)
+            if len(framenos) == 0:
+                break
+            sampler.update_many(framenos, scores[framenos])
+        else:
+            frameno = sampler.get_sample()
+            if frameno is None:
+                break
+            framenos = [frameno]
+            sampler.update(frameno, scores[frameno])
+        sampled.extend(framenos)
+        sampler.get_search()
+    elapsed = time.time() - start_time
+    return elapsed, np.mean(scores[sampled[:n_early]])
+
+if __name__ == '__main__':
+    parser = OptionParser()
+
+    parser.add_option('--n_frames', default=200000, type='int',
+                      help='Number of frames in the synthetic video')
+    parser.add_option('--search_interval', default=32, type='int',
+                      help='Frames between search frames')
+    parser.add_option('--batch_size', default=8, type='int',
+                      help='Batch size for the batched ArrayMCMH run')
+    parser.add_option('--seed', default=1984, type='int')
+
+    options, args = parser.parse_args()
+
+    scores = score_curve(options.n_frames, options.seed)
+    _log.info('Uniform sampling mean score: %.4f' %
+              np.mean(scores[::options.search_interval]))
+    for name, sampler_class, batch_size in [
+            ('MCMH', MCMH, 1),
+            ('ArrayMCMH', ArrayMCMH, 1),
+            ('ArrayMCMH batched', ArrayMCMH, options.batch_size)]:
+        elapsed, early_mean = run_sampler(sampler_class, scores,
+                                          options.search_interval,
+                                          batch_size, options.seed)
+        _log.info('%s: %.3fs, mean score of the first 10%% of samples: %.4f'
+                  % (name, elapsed, early_mean))
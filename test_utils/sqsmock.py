@@ -61,7 +61,14 @@ class SQSQueueMock(object):
                 return False
         return False
        
-    def get_messages(self, num_messages=1, visibility_timeout=None, attributes=None):
+    def delete_message_batch(self, messages):
+        for message in messages:
+            self.delete_message(message)
+        return True
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     attributes=None, wait_time_seconds=None,
+                     message_attributes=None):
         messages = []
 
         i = 0
@@ -93,6 +100,11 @@ class SQSQueueMock(object):
             else:
                 return None
     
+    def change_message_visibility_batch(self, messages):
+        for message, timeout in messages:
+            float(timeout)
+        return True
+
     def write(self, message):
         try:
             with self.lock:
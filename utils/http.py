@@ -9,6 +9,7 @@ sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..')))
 
 import concurrent.futures
+from collections import deque
 import logging
 import multiprocessing
 import random
@@ -23,12 +24,38 @@ import tornado.locks
 import urlparse
 import utils.logs
 from utils import statemon
+from utils.options import define, options
 import utils.sync
 
 _log = logging.getLogger(__name__)
 
+define('circuit_breaker_failures', default=0, type=int,
+       help=('Number of consecutive failures talking to a host before '
+             'requests to it fail immediately. 0 disables the breakers.'))
+define('circuit_breaker_reset_time', default=30.0, type=float,
+       help=('Seconds that requests to a failing host are rejected before '
+             'a single trial request is let through'))
+define('max_requests_per_host', default=0, type=int,
+       help=('Maximum number of concurrent requests to a single host from '
+             'this process. 0 is unlimited.'))
+define('use_curl_client', default=0, type=int,
+       help=('1 if the curl http client, which keeps connections alive '
+             'between requests, should be used. Requires pycurl.'))
+define('max_http_clients', default=10, type=int,
+       help='Maximum number of simultaneous requests in the http client')
+
 statemon.state.define('waiting_in_pools', int)
 _waiting_in_pools_ref = statemon.state.get_ref('waiting_in_pools')
+statemon.state.define('waiting_for_host', int)
+_waiting_for_host_ref = statemon.state.get_ref('waiting_for_host')
+statemon.state.define('open_circuit_breakers', int)
+_open_circuit_breakers_ref = statemon.state.get_ref('open_circuit_breakers')
+statemon.state.define('circuit_breakers_opened', int)
+_circuit_breakers_opened_ref = statemon.state.get_ref(
+    'circuit_breakers_opened')
+statemon.state.define('circuit_breaker_rejections', int)
+_circuit_breaker_rejections_ref = statemon.state.get_ref(
+    'circuit_breaker_rejections')
 
 
 class ResponseCode(object):
@@ -53,6 +80,158 @@ class HTTPVerbs(object):
     PATCH = 'PATCH'
 
 
+def configure_http_client(defaults=None):
+    '''Configures the AsyncHTTPClient shared by everything in the process.
+
+    Inputs:
+    defaults - Dictionary of default HTTPRequest arguments
+    '''
+    impl = None
+    if options.use_curl_client:
+        try:
+            import pycurl
+            impl = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+        except ImportError:
+            _log.warning('pycurl is not available. Connections will not be '
+                         'reused')
+    kwargs = {'max_clients' : options.max_http_clients}
+    if defaults is not None:
+        kwargs['defaults'] = defaults
+    tornado.httpclient.AsyncHTTPClient.configure(impl, **kwargs)
+
+class CircuitBreaker(object):
+    '''Tracks the health of a host so that we stop hammering it when it's down.
+
+    The breaker starts closed. After circuit_breaker_failures
+    consecutive failures, it opens and all requests are rejected for
+    circuit_breaker_reset_time seconds. It then goes half open and
+    lets a single trial request through. If that request succeeds, the
+    breaker closes, otherwise it opens again.
+
+    This object is thread safe.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, host):
+        self.host = host
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_time = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        '''Returns True if a request to the host can be sent now.'''
+        if options.circuit_breaker_failures <= 0:
+            return True
+
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if (self.state == CircuitBreaker.OPEN and
+                (time.time() - self.opened_time) >=
+                options.circuit_breaker_reset_time):
+                self.state = CircuitBreaker.HALF_OPEN
+                self._trial_running = False
+            if (self.state == CircuitBreaker.HALF_OPEN and
+                not self._trial_running):
+                self._trial_running = True
+                return True
+            return False
+
+    def cancel_trial(self):
+        '''Lets another trial request through after one that ended
+        without telling us anything about the host.
+        '''
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CircuitBreaker.CLOSED:
+                _log.info('Circuit breaker for %s is closed' % self.host)
+                statemon.state.decrement(ref=_open_circuit_breakers_ref)
+                self.state = CircuitBreaker.CLOSED
+
+    def record_failure(self):
+        if options.circuit_breaker_failures <= 0:
+            return
+
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or (
+                    self.state == CircuitBreaker.CLOSED and
+                    self.failures >= options.circuit_breaker_failures):
+                if self.state == CircuitBreaker.CLOSED:
+                    _log.warn('Circuit breaker for %s is open after %i '
+                              'failures' % (self.host, self.failures))
+                    statemon.state.increment(ref=_open_circuit_breakers_ref)
+                    statemon.state.increment(
+                        ref=_circuit_breakers_opened_ref)
+                self.state = CircuitBreaker.OPEN
+                self.opened_time = time.time()
+                self._trial_running = False
+
+class HostLimiter(object):
+    '''Limits the number of concurrent requests to a host.
+
+    Unlike the tornado semaphores, this can be shared by requests
+    running on different threads and io loops.
+    '''
+    def __init__(self):
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Returns a future that is done when a request can be sent.'''
+        future = concurrent.futures.Future()
+        with self._lock:
+            if (options.max_requests_per_host <= 0 or
+                self.active < options.max_requests_per_host):
+                self.active += 1
+                future.set_result(True)
+            else:
+                statemon.state.increment(ref=_waiting_for_host_ref)
+                self._waiters.append((tornado.ioloop.IOLoop.current(),
+                                      future))
+        return future
+
+    def release(self):
+        with self._lock:
+            if len(self._waiters) > 0:
+                # Hand our slot directly to the next request in line
+                io_loop, future = self._waiters.popleft()
+                statemon.state.decrement(ref=_waiting_for_host_ref)
+                io_loop.add_callback(future.set_result, True)
+            else:
+                self.active -= 1
+
+_host_lock = threading.Lock()
+_circuit_breakers = {}
+_host_limiters = {}
+
+def get_circuit_breaker(host):
+    with _host_lock:
+        try:
+            return _circuit_breakers[host]
+        except KeyError:
+            breaker = CircuitBreaker(host)
+            _circuit_breakers[host] = breaker
+            return breaker
+
+def get_host_limiter(host):
+    with _host_lock:
+        try:
+            return _host_limiters[host]
+        except KeyError:
+            limiter = HostLimiter()
+            _host_limiters[host] = limiter
+            return limiter
+
 # TODO(mdesnoyer): Handle the stack on async requests so that the
 # callback will have a stack that looks like the original request
 # being called.
@@ -75,6 +254,10 @@ def send_request(request, ntries=5, do_logging=True, base_delay=0.2,
     no_retry_codes - List of http codes that cause the request not to retry
     retry_forever_codes - List of http status code that cause request to retry
         forever until success (e.g., 429) with backoff
+
+    If the circuit breaker for the host is open, no more tries are
+    made and the last response, or a 503 if there wasn't one, is
+    returned.
     '''
     # Verify the request url
     parsed = urlparse.urlsplit(unicode(request.url))
@@ -88,12 +271,28 @@ def send_request(request, ntries=5, do_logging=True, base_delay=0.2,
 
     no_retry_codes = no_retry_codes or []
     retry_forever_codes = retry_forever_codes or []
+    breaker = get_circuit_breaker(parsed.netloc)
+    limiter = get_host_limiter(parsed.netloc)
 
     cur_try = 0
     response = None
     while cur_try < ntries or (response and response.error and
                                response.error.code in retry_forever_codes):
         cur_try += 1
+        if not breaker.allow_request():
+            statemon.state.increment(ref=_circuit_breaker_rejections_ref,
+                                     safe=False)
+            if do_logging:
+                _log.warn_n('Circuit breaker is open for %s' %
+                            parsed.netloc, 5)
+            if response is None:
+                msg = 'Circuit breaker is open for %s' % parsed.netloc
+                response = tornado.httpclient.HTTPResponse(
+                    request, 503,
+                    error=tornado.httpclient.HTTPError(503, msg))
+            raise tornado.gen.Return(response)
+
+        yield limiter.acquire()
         try:
             http_client = tornado.httpclient.AsyncHTTPClient()
             response = yield http_client.fetch(request)
@@ -113,6 +312,18 @@ def send_request(request, ntries=5, do_logging=True, base_delay=0.2,
             response = tornado.httpclient.HTTPResponse(request,
                                                        502,
                                                        error=error)
+        except Exception:
+            # We don't know if the host is ok, so don't leave the
+            # breaker waiting for this request forever.
+            breaker.cancel_trial()
+            raise
+        finally:
+            limiter.release()
+
+        if response.error and response.error.code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
         if not response.error:
             try:
                 data = tornado.escape.json_decode(response.body)
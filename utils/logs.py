@@ -23,6 +23,7 @@ if sys.path[0] != __base_path__:
     sys.path.insert(0, __base_path__)
 
 import atexit
+from collections import deque
 import copy
 from cloghandler import ConcurrentRotatingFileHandler
 import datetime
@@ -35,6 +36,7 @@ import sys
 import threading
 import tornado.gen
 import tornado.httpclient
+import tornado.ioloop
 import urllib
 import urllib2
 from utils import statemon
@@ -73,10 +75,22 @@ _log = logging.getLogger(__name__)
 define('loggly_base_url',
        default='https://logs-01.loggly.com/inputs/520b9697-b7f3-4970-a059-710c28a8188a',
        help='Base url for the loggly endpoint')
+define('http_log_batch_size', default=200, type=int,
+       help='Maximum number of records to send in one http log request')
+define('http_log_flush_interval', default=1.0, type=float,
+       help='Seconds between sending batches of http logs')
+define('http_log_max_queue', default=10000, type=int,
+       help=('Maximum number of records waiting to be sent to an http log '
+             'endpoint. The oldest records are dropped after this.'))
+define('http_log_flush_timeout', default=10.0, type=float,
+       help=('Maximum seconds to wait for the queued http logs to be sent '
+             'when the handler is flushed or closed'))
 
 # State variables
 statemon.define('http_log_errors', int)
 _http_log_error_ref = statemon.state.get_ref('http_log_errors')
+statemon.define('http_log_dropped', int)
+_http_log_dropped_ref = statemon.state.get_ref('http_log_dropped')
 
 # grabbed from logging.py
 #
@@ -221,7 +235,16 @@ def FlumeLogger(name, host='localhost', port=6366):
 
 class TornadoHTTPHandler(logging.Handler):
     '''
-    A class that sends a tornado based http request
+    A class that sends log records in batches using tornado http requests
+
+    Records are queued by emit() and sent from a separate thread every
+    http_log_flush_interval seconds, or as soon as there are
+    http_log_batch_size of them. At most http_log_max_queue records
+    wait to be sent. After that, the oldest ones are dropped, so that
+    logging cannot use up memory when the endpoint is slow.
+
+    flush() and close() block until the queued records are sent, or
+    http_log_flush_timeout passes.
     '''
     def __init__(self, url, emit_error_sampling_period=60):
         super(TornadoHTTPHandler, self).__init__()
@@ -229,6 +252,10 @@ class TornadoHTTPHandler(logging.Handler):
         self.emit_error_sampling_period = emit_error_sampling_period
         self.last_emit_error = None
 
+        self._queue = deque()
+        self._queue_lock = threading.Lock()
+        self._flushing = False
+
         # import utils.http here, so that the NeonLogger is set as
         # the default logger before utils.http loads its logger. If
         # imported earlier, then the log_n function is not available
@@ -241,6 +268,7 @@ class TornadoHTTPHandler(logging.Handler):
             name='logs{%s}' % self.__class__)
         self.logging_thread.daemon = True
         self.logging_thread.start()
+        self.logging_thread.io_loop.add_callback(self._start_flush_timer)
 
     def __del__(self):
         self.logging_thread.stop()
@@ -264,34 +292,114 @@ class TornadoHTTPHandler(logging.Handler):
                      'Content-length' : len(data) },
             body=data)
 
-    @tornado.gen.coroutine
-    def _emit_in_thread(self, record):
-        '''Emits a log event in the logging_thread.'''
-        response = yield self.request_pool.send_request(
-            self.generate_request(record),
-            do_logging=False,
-            ntries=1,
-            async=True)
-        if response.error:
+    def generate_batch_requests(self, records):
+        '''Create a list of tornado.httpclient.HTTPRequest for records.
+
+        By default, there is one request per record. Overwrite this in
+        subclasses whose endpoint can accept many records at once.
+        '''
+        return [self.generate_request(record) for record in records]
+
+    def _start_flush_timer(self):
+        tornado.ioloop.PeriodicCallback(
+            self._flush,
+            options.http_log_flush_interval * 1000.,
+            io_loop=self.logging_thread.io_loop).start()
+
+    def prepare(self, record):
+        '''Returns a copy of the record that is safe to queue.
+
+        The message is formatted now, because the args could change
+        before the record is sent, and the traceback is turned into
+        text so that the frames aren't kept alive in the queue.
+        '''
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                formatter = self.formatter or logging._defaultFormatter
+                record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def flush(self):
+        '''Sends all the queued records before returning.'''
+        if (threading.current_thread() is self.logging_thread or
+            not self.logging_thread.is_alive()):
+            return
+        done = threading.Event()
+        @tornado.gen.coroutine
+        def _drain():
             try:
-                raise response.error
-            except:
-                curtime = datetime.datetime.utcnow()
-                statemon.state.increment(ref=_http_log_error_ref,
-                                         safe=False)
-                if (self.last_emit_error is None or 
-                    (curtime - self.last_emit_error).total_seconds() >
-                    self.emit_error_sampling_period):
-                    self.last_emit_error = curtime
-                    self.handleError(record)
-        else:
-            raise tornado.gen.Return(response)
+                # Wait for a flush in progress so that its records are
+                # sent too.
+                while self._flushing:
+                    yield tornado.gen.sleep(0.01)
+                yield self._flush()
+            finally:
+                done.set()
+        self.logging_thread.io_loop.add_callback(_drain)
+        done.wait(options.http_log_flush_timeout)
+
+    def close(self):
+        self.flush()
+        super(TornadoHTTPHandler, self).close()
+
+    def _take_batch(self):
+        with self._queue_lock:
+            n_records = min(len(self._queue), options.http_log_batch_size)
+            return [self._queue.popleft() for i in range(n_records)]
+
+    @tornado.gen.coroutine
+    def _flush(self):
+        '''Sends all the queued records. Runs in the logging_thread.'''
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while True:
+                records = self._take_batch()
+                if len(records) == 0:
+                    break
+                yield self._send_batch(records)
+        finally:
+            self._flushing = False
+
+    @tornado.gen.coroutine
+    def _send_batch(self, records):
+        try:
+            responses = yield [
+                self.request_pool.send_request(request,
+                                               do_logging=False,
+                                               ntries=1,
+                                               async=True)
+                for request in self.generate_batch_requests(records)]
+            for response in responses:
+                if response.error:
+                    raise response.error
+        except:
+            curtime = datetime.datetime.utcnow()
+            statemon.state.increment(ref=_http_log_error_ref,
+                                     safe=False)
+            if (self.last_emit_error is None or 
+                (curtime - self.last_emit_error).total_seconds() >
+                self.emit_error_sampling_period):
+                self.last_emit_error = curtime
+                self.handleError(records[0])
 
     def emit(self, record):
         try:
-            # Send it off to the logging thread so that we don't block here
-            self.logging_thread.io_loop.add_callback(self._emit_in_thread,
-                                                     record)
+            # Queue it for the logging thread so that we don't block here
+            record = self.prepare(record)
+            with self._queue_lock:
+                if len(self._queue) >= options.http_log_max_queue:
+                    self._queue.popleft()
+                    statemon.state.increment(ref=_http_log_dropped_ref)
+                self._queue.append(record)
+                batch_full = len(self._queue) == options.http_log_batch_size
+            if batch_full:
+                self.logging_thread.io_loop.add_callback(self._flush)
         except:
             curtime = datetime.datetime.utcnow()
             if (self.last_emit_error is None or 
@@ -303,16 +411,21 @@ class TornadoHTTPHandler(logging.Handler):
 class LogglyHandler(TornadoHTTPHandler):
     '''
     Class that can send the records to loggly.
+
+    Records are sent to the bulk endpoint as newline separated JSON.
     '''
     def __init__(self, tag):
         super(LogglyHandler, self).__init__(
-            '%s/tag/%s' % (options.loggly_base_url, tag))
+            '%s/tag/%s/' % (
+                options.loggly_base_url.replace('/inputs/', '/bulk/'),
+                tag))
 
-    def generate_request(self, record):
+    def get_loggly_event(self, record):
         vdict = self.get_verbose_dict(record)
 
-        data = {
-            'timestamp': datetime.datetime.utcnow().isoformat(),
+        return {
+            'timestamp': datetime.datetime.utcfromtimestamp(
+                record.created).isoformat(),
             'host': platform.node(),
             'message': vdict['message'],
             'levelname': vdict['levelname'],
@@ -320,35 +433,47 @@ class LogglyHandler(TornadoHTTPHandler):
             'filename': vdict['filename'],
             'lineno': vdict['lineno']
             }
-            
-        log_data = ("PLAINTEXT=" + 
-                    urllib2.quote(json.dumps(data)))
-        return tornado.httpclient.HTTPRequest(
+
+    def generate_request(self, record):
+        return self.generate_batch_requests([record])[0]
+
+    def generate_batch_requests(self, records):
+        log_data = '\n'.join([json.dumps(self.get_loggly_event(record))
+                              for record in records])
+        return [tornado.httpclient.HTTPRequest(
             self.url, method='POST', 
-            headers={'Content-type' : 'application/x-www-form-urlencoded',
+            headers={'Content-type' : 'text/plain',
                      'Content-length' : len(log_data) },
-            body=log_data)
+            body=log_data)]
 
 class FlumeHandler(TornadoHTTPHandler):
     '''
     Class that can send the records to flume.
+
+    The flume JSON HTTP source accepts a list of events in one request.
     '''
     def __init__(self, url):
         super(FlumeHandler, self).__init__(url)
 
-    def generate_request(self, record):
-        flume_event = {
+    def get_flume_event(self, record):
+        return {
             'headers' : {
                 'timestamp' : long(record.created * 1000),
                 'level' : record.levelname
             },
             'body' : self.format(record)
         }
-        data = json.dumps([flume_event])
-        return tornado.httpclient.HTTPRequest(
+
+    def generate_request(self, record):
+        return self.generate_batch_requests([record])[0]
+
+    def generate_batch_requests(self, records):
+        data = json.dumps([self.get_flume_event(record)
+                           for record in records])
+        return [tornado.httpclient.HTTPRequest(
             self.url, method='POST', 
             headers={'Content-type' : 'application/json' },
-            body=data)
+            body=data)]
 
 class NeonLogger(logging.Logger):
     '''A python logger with some extra functionality.'''
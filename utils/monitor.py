@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import cPickle as pickle
+from collections import deque
+import logging
 import platform
 import socket
+import struct
 import threading
 import time
 import statemon
@@ -9,47 +13,180 @@ from options import options, define
 
 define("carbon_server", default="127.0.0.1", help="Montioring server", type=str)
 define("carbon_port", default=8090, help="Monitoring port", type=int)
+define("carbon_pickle_port", default=None, type=int,
+       help=("If set, metrics are sent to this port using the carbon pickle "
+             "protocol instead of as lines to carbon_port"))
+define("carbon_buffered_intervals", default=10, type=int,
+       help=("Number of batches of metrics to keep while the carbon server "
+             "is unreachable"))
+define("carbon_max_backoff", default=300.0, type=float,
+       help="Maximum seconds to wait before reconnecting to carbon")
 define("service_name", default=None, help="Two+ services running at once step on statemon, this solves it", type=str)
 define("sleep_interval", default=60, help="time between stats", type=int)
 
+_log = logging.getLogger(__name__)
+
+# Maximum number of metrics in one pickle frame
+PICKLE_BATCH_SIZE = 500
+
+def metric_path(name):
+    '''Returns the full carbon path of a metric.'''
+    node = platform.node().replace('.', '-')
+    if options.service_name:
+        return 'system.%s.%s.%s' % (node, options.service_name, name)
+    return 'system.%s.%s' % (node, name)
+
+class CarbonSender(object):
+    '''Sends batches of metrics to carbon over a long lived connection.
+
+    If carbon is unreachable, the last carbon_buffered_intervals
+    batches are kept and the connection is retried with exponential
+    backoff. Sending is best effort, so errors are never raised.
+    '''
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sock = None
+        self._address = None
+        self._backoff = 0.0
+        self._next_connect = 0.0
+        # Batches of encoded data that have not been sent
+        self._pending = deque()
+
+    def send(self, metrics):
+        '''Sends a batch of metrics.
+
+        Inputs:
+        metrics - List of (name, value, timestamp)
+
+        Returns True if everything that was pending was sent.
+        '''
+        with self._lock:
+            if len(metrics) > 0:
+                self._pending.append(self._encode(metrics))
+            while len(self._pending) > options.carbon_buffered_intervals:
+                self._pending.popleft()
+            return self.flush()
+
+    def flush(self):
+        '''Sends the pending batches. Returns True if they were all sent.'''
+        with self._lock:
+            while len(self._pending) > 0:
+                if not self._connect():
+                    return False
+                try:
+                    self._sock.sendall(self._pending[0])
+                except Exception as e:
+                    _log.debug('Error sending to carbon: %s' % e)
+                    self._disconnect()
+                    self._schedule_reconnect()
+                    return False
+                self._pending.popleft()
+            return True
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _get_address(self):
+        if options.carbon_pickle_port is not None:
+            return (options.carbon_server, options.carbon_pickle_port)
+        return (options.carbon_server, options.carbon_port)
+
+    def _encode(self, metrics):
+        if options.carbon_pickle_port is None:
+            return ''.join(['%s %s %d\n' % (name, value, timestamp)
+                            for name, value, timestamp in metrics])
+
+        frames = []
+        for i in range(0, len(metrics), PICKLE_BATCH_SIZE):
+            payload = pickle.dumps(
+                [(name, (timestamp, value)) for name, value, timestamp in
+                 metrics[i:(i+PICKLE_BATCH_SIZE)]],
+                protocol=2)
+            frames.append(struct.pack('!L', len(payload)))
+            frames.append(payload)
+        return ''.join(frames)
+
+    def _connect(self):
+        '''Makes sure there is a connection. Returns True if connected.'''
+        address = self._get_address()
+        if self._sock is not None and self._address == address:
+            return True
+        self._disconnect()
+        if time.time() < self._next_connect:
+            return False
+        try:
+            self._sock = socket.create_connection(address, 20)
+            self._address = address
+            self._backoff = 0.0
+            return True
+        except Exception as e:
+            _log.debug('Could not connect to carbon at %s:%s: %s' %
+                       (address[0], address[1], e))
+            self._disconnect()
+            self._schedule_reconnect()
+            return False
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+        self._sock = None
+        self._address = None
+
+    def _schedule_reconnect(self):
+        self._backoff = min(max(1.0, self._backoff * 2),
+                            options.carbon_max_backoff)
+        self._next_connect = time.time() + self._backoff
+
+sender = CarbonSender()
+
 def send_data(name, value):
     '''
     Format metric name/val pair and send the data to the carbon server
 
     This is a best effort send
     '''
-        
-    node = platform.node().replace('.', '-')
-    timestamp = int(time.time())
-    if options.service_name: 
-        data = 'system.%s.%s.%s %s %d\n' % (node, 
-                                            options.service_name, 
-                                            name, 
-                                            value, 
-                                            timestamp)
-    else: 
-        data = 'system.%s.%s %s %d\n' % (node, 
-                                         name, 
-                                         value, 
-                                         timestamp)
-    sock = socket.socket()
-    sock.settimeout(20)
-    try:
-        sock.connect((options.carbon_server, options.carbon_port))
-        sock.sendall(data)
-        sock.close()
-    except Exception, e:
-        pass
-        #print "excp", e
+    sender.send([(metric_path(name), value, int(time.time()))])
+
+# The histogram counts when they were last sent, so that the
+# percentiles can be calculated for each interval.
+_last_hist_counts = {}
+
+def get_histogram_metrics():
+    '''Returns a list of (name, value) for the statemon histograms.
+
+    Each histogram is exported as <name>.count, and, if there were
+    values since the last call, <name>.p50, <name>.p95 and <name>.p99.
+    '''
+    rv = []
+    for name, hist in statemon.state.get_all_histograms().iteritems():
+        counts = hist.get_counts()
+        last_counts = _last_hist_counts.get(name, [0] * len(counts))
+        _last_hist_counts[name] = counts
+        interval_counts = [x - y for x, y in zip(counts, last_counts)]
+        rv.append(('%s.count' % name, sum(interval_counts)))
+        percentiles = statemon.Histogram.percentiles(interval_counts,
+                                                     (50, 95, 99))
+        if percentiles is not None:
+            rv.extend([('%s.p%i' % (name, percent), value) for
+                       percent, value in zip((50, 95, 99), percentiles)])
+    return rv
 
 def send_statemon_data():
     m_vars = statemon.state.get_all_variables()
+    metrics = [(variable, m_value.value) for variable, m_value in
+               m_vars.iteritems()]
+    metrics.extend(get_histogram_metrics())
     #Nothing to monitor
-    if len(m_vars) <= 0:
+    if len(metrics) <= 0:
         return
 
-    for variable, m_value in m_vars.iteritems():
-        send_data(variable, m_value.value)
+    timestamp = int(time.time())
+    sender.send([(metric_path(name), value, timestamp)
+                 for name, value in metrics])
 
 class MonitoringAgent(threading.Thread):
     '''
@@ -72,5 +209,3 @@ agent = MonitoringAgent()
 def start_agent():
     if not agent.is_alive():
         agent.start()
-    
-
@@ -14,7 +14,6 @@ import os
 import rpdb2
 import signal
 import socket
-import tornado.httpclient
 import threading
 
 from . import logs
@@ -31,9 +30,13 @@ def InitNeon(usage='%prog [options]'):
     EnableRunningDebugging()
 
     socket.setdefaulttimeout(30)
+    defaults = None
     if os.path.exists('/etc/ssl/certs/ca-certificates.crt'):
-        tornado.httpclient.AsyncHTTPClient.configure(None, defaults=dict(
-            ca_certs="/etc/ssl/certs/ca-certificates.crt"))
+        defaults = dict(ca_certs="/etc/ssl/certs/ca-certificates.crt")
+    # Imported here so that the logger is configured before utils.http
+    # grabs it
+    from . import http
+    http.configure_http_client(defaults)
 
     magent = monitor.MonitoringAgent()
     magent.start()
@@ -58,7 +58,23 @@ def from_pil(im):
     '''Converts an PIL image to an OpenCV BGR format.'''
     return imageutils.PILImageUtils.to_cv(im)
 
-def seek_video(video, frame_no, do_log=True, cur_frame=None):
+class DecodeStats(object):
+    '''Counts the decoding work done while walking through a video.
+
+    grabs - Number of frames decoded with grab() and then skipped
+    retrieves - Number of frames that were converted and returned
+    seeks - Number of times the video was jumped with set()
+    '''
+    def __init__(self):
+        self.grabs = 0
+        self.retrieves = 0
+        self.seeks = 0
+
+    def __str__(self):
+        return ('%i frames retrieved, %i frames skipped with grab(), '
+                '%i seeks' % (self.retrieves, self.grabs, self.seeks))
+
+def seek_video(video, frame_no, do_log=True, cur_frame=None, stats=None):
     '''Seeks an OpenCV video to a given frame number.
 
     After calling this function, the next read() will give you that frame.
@@ -74,10 +90,13 @@ def seek_video(video, frame_no, do_log=True, cur_frame=None):
     do_log - True if logging should happen on errors
     cur_frame - If you know the frame number that the video should be at,
                 put it here. It helps to identify error cases.
+    stats - Optional DecodeStats object to record the work in
 
     Outputs:
     Returns (sucess, cur_frame)
     '''
+    if stats is None:
+        stats = DecodeStats()
 
     grab_sucess = True
     if (cur_frame is not None and cur_frame > 0 and 
@@ -88,6 +107,7 @@ def seek_video(video, frame_no, do_log=True, cur_frame=None):
 
         while grab_sucess and cur_frame < frame_no:
             grab_sucess = video.grab()
+            stats.grabs += 1
             cur_frame += 1
 
     else:
@@ -95,10 +115,12 @@ def seek_video(video, frame_no, do_log=True, cur_frame=None):
                 (frame_no - cur_frame) < 4 and (frame_no - cur_frame) >= 0) ):
             # Seeking to a place in the video that's a ways away, so JUMP
             video.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+            stats.seeks += 1
             
         cur_frame = video.get(cv2.CAP_PROP_POS_FRAMES)
         while grab_sucess and cur_frame < frame_no:
             grab_sucess = video.grab()
+            stats.grabs += 1
             cur_frame = video.get(cv2.CAP_PROP_POS_FRAMES)
             if cur_frame == 0:
                 _log.error('Cannot read the current frame location. '
@@ -109,25 +131,48 @@ def seek_video(video, frame_no, do_log=True, cur_frame=None):
 
     return grab_sucess, cur_frame
 
-def iterate_video(video, start=0, end=None, step=1):
+def read_frame(video, stats=None):
+    '''Reads the next frame of the video.
+
+    Equivalent to video.read(), but records the work in a DecodeStats
+    object.
+
+    Returns (sucess, image)
+    '''
+    if not video.grab():
+        return False, None
+    if stats is not None:
+        stats.retrieves += 1
+    return video.retrieve()
+
+def iterate_video(video, start=0, end=None, step=1, stats=None):
     '''Returns an iterator of the frames in a video.
 
+    Frames that are stepped over are only decoded with grab(), so
+    they are never converted to images.
+
     Inputs:
     video - An opencv VideoCapture object
     start - The first frame number to grab
     end - The frame number of the end of the sequnce.
           This frame is not extracted (None means go to the end)
     step - Number of frames to step for each frame
+    stats - Optional DecodeStats object to record the work in
     '''
     num_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    if end is None:
+        end = num_frames
     end = min(end, num_frames)
     if start is None:
         start = 0
+    cur_frame = None
     for frameno in range(start, end, step):
         seek_sucess, cur_frame = seek_video(
             video,
             frameno,
-            do_log=False)
+            do_log=False,
+            cur_frame=cur_frame,
+            stats=stats)
         if not seek_sucess:
             if cur_frame is None:
                 raise model.errors.VideoReadError(
@@ -136,9 +181,10 @@ def iterate_video(video, start=0, end=None, step=1):
             break
 
         # Read the frame
-        read_sucess, image = video.read()
+        read_sucess, image = read_frame(video, stats)
         if not read_sucess:
             break
+        cur_frame = frameno + 1
 
         yield image
 
@@ -204,7 +250,8 @@ class ImagePrep(object):
                  crop_image_size=None, image_area=None,
                  crop_frac=None, convert_to_gray=False,
                  return_same=False, return_pil=False,
-                 convert_to_color=True):
+                 convert_to_color=True, fuse_steps=False,
+                 reuse_output=False):
         '''
         If any of the inputs are None or False, then that input does not
         trigger any preprocessing.
@@ -237,6 +284,17 @@ class ImagePrep(object):
                         left.
             - if return_same, convert the image back to its original format.
             - if return_pil, return the image as a PIL-style image.
+
+        If fuse_steps is True, the resize and crop steps above are
+        planned for the input size and applied as a single crop of the
+        input followed by at most one resize. The output size is the
+        same, but the pixel values can be slightly different when
+        there is more than one resize or crop step.
+
+        If reuse_output is True, the resized image is written to the
+        same buffer on every call, so the result is only valid until
+        the next call and the object cannot be shared between threads.
+        Only applies when fuse_steps is True and a single image is passed.
         '''
         # CAST INPUTS
         max_height = None if (max_height == None) else int(max_height)
@@ -304,12 +362,31 @@ class ImagePrep(object):
         self.convert_to_color = convert_to_color
         self.return_pil = return_pil
         self.return_same = return_same
+        self.fuse_steps = fuse_steps
+        self.reuse_output = reuse_output
+
+        # Cache of the last plan built by _plan_steps
+        self._plan_shape = None
+        self._plan = None
+        self._out_buf = None
 
     def __call__(self, image):
         if type(image) is list:
-            return [self(x) for x in image]
+            return [self._prep(x, reuse_output=False) for x in image]
+        return self._prep(image, self.reuse_output)
+
+    def _prep(self, image, reuse_output=False):
         not_cv = _not_CV(image)
         image = _ensure_CV(image)
+        if self.fuse_steps:
+            image = self._apply_plan(image, reuse_output)
+            if self.convert_to_color:
+                image = _convert_to_color(image)
+            if self.convert_to_gray:
+                image = _convert_to_gray(image)
+            if (not_cv and self.return_same) or self.return_pil:
+                image = to_pil(image)
+            return image
         if self.convert_to_color:
             image = _convert_to_color(image)
         if self.convert_to_gray:
@@ -339,6 +416,98 @@ class ImagePrep(object):
             image = to_pil(image)
         return image
 
+    def _apply_plan(self, image, reuse_output=False):
+        '''Applies the resize and crop steps as one crop and one resize.'''
+        if self._plan_shape != image.shape[:2]:
+            self._plan = self._plan_steps(*image.shape[:2])
+            self._plan_shape = image.shape[:2]
+        (y0, y1, x0, x1), (h, w), interpolation = self._plan
+
+        image = image[y0:y1, x0:x1]
+        if image.shape[:2] == (h, w):
+            return image
+
+        if reuse_output:
+            out_shape = (h, w) + image.shape[2:]
+            if (self._out_buf is None or self._out_buf.shape != out_shape
+                or self._out_buf.dtype != image.dtype):
+                self._out_buf = np.empty(out_shape, image.dtype)
+            return cv2.resize(image, (w, h), dst=self._out_buf,
+                              interpolation=interpolation)
+        return cv2.resize(image, (w, h), interpolation=interpolation)
+
+    def _plan_steps(self, h, w):
+        '''Plans the resize and crop steps for an image of size h x w.
+
+        The sizes are calculated exactly like the individual steps
+        do, while keeping track of which region of the input image
+        the result covers.
+
+        Returns ((y0, y1, x0, x1), (out_h, out_w), interpolation) where
+        the input should be cropped to [y0:y1, x0:x1] and then resized
+        to (out_h, out_w).
+        '''
+        # Region of the input covered by the current image
+        region = [0., float(h), 0., float(w)]
+        interpolation = cv2.INTER_LINEAR
+
+        def crop(top, bottom, left, right):
+            # Crop the current image by a number of pixels on each side
+            yscale = (region[1] - region[0]) / h
+            xscale = (region[3] - region[2]) / w
+            region[:] = [region[0] + top * yscale,
+                         region[1] - bottom * yscale,
+                         region[2] + left * xscale,
+                         region[3] - right * xscale]
+
+        def scaled(size, scaleF):
+            return int(size[0]*scaleF), int(size[1]*scaleF)
+
+        for dim, max_size in [(0, self.max_height), (1, self.max_width)]:
+            if max_size is not None and (h, w)[dim] > max_size:
+                h, w = scaled((h, w), max_size * 1./(h, w)[dim])
+        if self.max_side is not None and max(h, w) > self.max_side:
+            h, w = scaled((h, w), self.max_side * 1./max(h, w))
+        if self.scale_height is not None:
+            h, w = scaled((h, w), self.scale_height * 1./h)
+        if self.scale_width is not None:
+            h, w = scaled((h, w), self.scale_width * 1./w)
+        if self.image_size is not None:
+            h, w = self.image_size
+        if self.crop_image_size is not None:
+            # Same as resize_and_crop()
+            crop_h, crop_w = self.crop_image_size
+            scaling = max(float(crop_h) / h, float(crop_w) / w)
+            h, w = [int(x) for x in np.round(np.array([h, w])*scaling)]
+            sr = int(np.floor((h - crop_h)/2))
+            sc = int(np.floor((w - crop_w)/2))
+            new_h = min(crop_h, h - sr)
+            new_w = min(crop_w, w - sc)
+            crop(sr, h - sr - new_h, sc, w - sc - new_w)
+            h, w = new_h, new_w
+            interpolation = cv2.INTER_AREA
+        if self.image_area is not None:
+            sfactor = np.sqrt(self.image_area * 1./(h * w))
+            h, w = int(h * sfactor), int(w * sfactor)
+        if self.crop_frac is not None:
+            # Same as _center_crop()
+            crop_frac = self.crop_frac
+            if type(crop_frac) == float:
+                crop_frac = [crop_frac, crop_frac]
+            if len(crop_frac) == 2:
+                top = bottom = int(h * (1. - crop_frac[0])/2)
+                left = right = int(w * (1. - crop_frac[1])/2)
+            else:
+                top = int(h * crop_frac[0])
+                right = int(w * crop_frac[1])
+                bottom = int(h * crop_frac[2])
+                left = int(w * crop_frac[3])
+            crop(top, bottom, left, right)
+            h, w = h - top - bottom, w - left - right
+
+        y0, y1, x0, x1 = [int(round(x)) for x in region]
+        return (y0, y1, x0, x1), (h, w), interpolation
+
     def _center_crop(self, image):
         '''
         Takes the center self.crop_frac of an image
@@ -14,14 +14,18 @@ import boto.sqs
 from boto.sqs.message import Message
 from boto.sqs.jsonmessage import JSONMessage
 import boto.exception
-import copy
+from collections import OrderedDict
+import concurrent.futures
 import json
 import logging
 import random
 import statemon
 import threading
+from tornado.concurrent import run_on_executor
 import tornado.gen
 import tornado.httpclient
+import tornado.locks
+import urlparse
 import utils.http
 import utils.sync
 import time
@@ -30,6 +34,18 @@ from utils.options import define, options
 define('region', type=str, default="us-east-1", help='region to connect to')
 define('customer_callback_sqs', type=str, default="neon-customer-callback",
        help='SQS queue name')
+define('max_concurrent_callbacks', type=int, default=20,
+       help='Maximum number of callbacks being sent at once')
+define('max_callbacks_per_host', type=int, default=4,
+       help='Maximum number of callbacks being sent at once to a single host')
+define('callback_retry_delay', type=float, default=60.0,
+       help=('Seconds to wait before retrying a failed callback. Doubles '
+             'with each failure.'))
+define('sqs_receive_concurrency', type=int, default=4,
+       help='Number of SQS receive calls to make at once')
+
+# Maximum number of messages in an SQS batch call
+SQS_BATCH_SIZE = 10
 
 statemon.define('callbacks_in_flight', int)
 statemon.define('callback_errors', int)
@@ -88,44 +104,89 @@ class SQSManager(object):
         # queue if it does not exist or will return the existing queue
         # if it does.
         self.sq = conn.create_queue(sqs_name, visibility_timeout)
-        self.messages = [] 
+        # message id -> Message, in the order they were received
+        self._messages = OrderedDict()
         self.lock = threading.RLock()
 
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            options.sqs_receive_concurrency + 1)
+
+    def __del__(self):
+        self.executor.shutdown(False)
+
+    @property
+    def messages(self):
+        '''List of the received messages that haven't been removed.'''
+        with self.lock:
+            return self._messages.values()
+
+    @staticmethod
+    def _message_id(msg):
+        return msg.id or msg.receipt_handle
+
+    @run_on_executor
+    def _sqs_count(self):
+        return self.sq.count()
+
+    @run_on_executor
+    def _sqs_receive(self):
+        return self.sq.get_messages(
+            SQS_BATCH_SIZE,
+            visibility_timeout=self.visibility_timeout,
+            attributes='ApproximateReceiveCount')
+
+    @run_on_executor
+    def _sqs_delete_batch(self, msgs):
+        # Note: the lock isnt' required for deletes, but since sqsmock
+        # uses file i/o we require a lock to serialize the deletions
+        with self.lock:
+            return self.sq.delete_message_batch(msgs)
+
     @tornado.gen.coroutine
     def get_all_messages(self):
         '''
         Get all the message currently in the Q
         '''
-        # TODO: Make the calls to sqs asynchronous
-        count = self.sq.count()
-        # NOTE: Page size must be <= 10 else SQS errors
+        count = yield self._sqs_count()
         try:
             while count > 0:
-                rs = self.sq.get_messages(
-                    10,
-                    visibility_timeout=self.visibility_timeout,
-                    attributes='ApproximateReceiveCount')
+                # Receive a few pages at once
+                n_calls = min(options.sqs_receive_concurrency,
+                              (count + SQS_BATCH_SIZE - 1) / SQS_BATCH_SIZE)
+                pages = yield [self._sqs_receive() for i in range(n_calls)]
+                n_received = sum([len(rs) for rs in pages])
+                if n_received == 0:
+                    break
                 with self.lock:
-                    self.messages.extend(rs)
-                count -= len(rs)
+                    for rs in pages:
+                        self._add_messages(rs)
+                count -= n_received
         except boto.exception.SQSDecodeError as e:
             _log.error('Unable to decode sqs message. Should never get here')
             tornado.gen.Return(self.messages)
         raise tornado.gen.Return(self.messages)
 
+    def _add_messages(self, msgs):
+        '''Adds received messages to self.messages, skipping duplicates.'''
+        for msg in msgs:
+            # A duplicate keeps its place, but with the newest receipt
+            # handle
+            self._messages[self._message_id(msg)] = msg
+
     @tornado.gen.coroutine
     def remove_message(self, msg):
         ''' Delete the message from SQS Queue
         '''
-        # Note: the lock isnt' required for delete_message, but since 
-        # sqsmock uses file i/o we require a lock to serialize the deletions 
-        # TODO: Make this call asynchronous
+        yield self.remove_messages([msg])
+
+    @tornado.gen.coroutine
+    def remove_messages(self, msgs):
+        '''Delete a list of messages from the SQS Queue in batches.'''
+        yield [self._sqs_delete_batch(msgs[i:(i+SQS_BATCH_SIZE)])
+               for i in range(0, len(msgs), SQS_BATCH_SIZE)]
         with self.lock:
-            self.sq.delete_message(msg)
-            try:
-                self.messages.remove(msg)
-            except ValueError:
-                pass
+            for msg in msgs:
+                self._messages.pop(self._message_id(msg), None)
 
 class CustomerCallbackManager(SQSManager):
     '''
@@ -141,6 +202,11 @@ class CustomerCallbackManager(SQSManager):
         self.callback_messages = {} # platform video_id => CustomerCallbackMessage obj 
         self.max_callback_tries = max_callback_tries
         self.key_failures = {} # key => error_count
+        self.retry_times = {} # key => earliest time to retry the callback
+
+        self._callback_semaphore = tornado.locks.Semaphore(
+            options.max_concurrent_callbacks)
+        self._host_semaphores = {} # host => tornado.locks.Semaphore
 
     @utils.sync.optional_sync
     @tornado.gen.coroutine
@@ -171,6 +237,10 @@ class CustomerCallbackManager(SQSManager):
         
         @keys : list of keys that we should send callbacks for if 
                 there is one that hasn't been sent in the past.
+
+        The callbacks are sent concurrently, with at most
+        max_callbacks_per_host to any one customer host, and the
+        messages of the successful ones are deleted in batches.
         '''
         
         # Populate all the callbacks from SQS
@@ -181,15 +251,31 @@ class CustomerCallbackManager(SQSManager):
         # directive for that video id. If yes, then schedule to send
         # the callback response to the customer
         keys = set(keys)
+        now = time.time()
 
         futures = []
         with self.lock:
             for key in self.callback_messages.keys():
                 if key in keys:
+                    if self.retry_times.get(key, 0) > now:
+                        continue
                     if self.callback_messages[key].dispatch_time is None:
-                        futures.append(self.send_callback_response(key))
+                        futures.append(self.send_callback_response(
+                            key, remove=False))
                         _log.info("Scheduling the callback for key %s" % key)
-        yield futures
+        # Wait for each one separately so that an error on one
+        # callback doesn't stop us from removing the ones that are
+        # done. Otherwise, they would be sent again.
+        finished = []
+        for future in futures:
+            try:
+                key = yield future
+            except Exception as e:
+                _log.exception('Unexpected error sending a callback: %s' % e)
+                continue
+            if key:
+                finished.append(key)
+        yield self.remove_callbacks(finished)
 
     @tornado.gen.coroutine
     def get_callback_messages(self):
@@ -214,71 +300,119 @@ class CustomerCallbackManager(SQSManager):
     def remove_callback(self, key):
         '''Remove the callback from the SQS queue.
         '''
-        messages = copy.copy(self.messages)
-        for msg in messages:
+        yield self.remove_callbacks([key])
+
+    @tornado.gen.coroutine
+    def remove_callbacks(self, keys):
+        '''Remove the callbacks for a list of keys from the SQS queue.
+        '''
+        keys = set(keys)
+        if len(keys) == 0:
+            return
+        to_remove = []
+        for msg in self.messages:
             ccm = CustomerCallbackMessage.to_obj(msg.get_body(),
                                                  msg.attributes)
-            if ccm.video_id == key:
-                #remove from SQS Queue 
-                yield self.remove_message(msg)
+            if ccm.video_id in keys:
+                to_remove.append(msg)
+        yield self.remove_messages(to_remove)
 
-                # remove from messages list stored locally
-                try:
-                    self.messages.remove(msg)
-                except ValueError:
-                    pass
-                
+    def _get_host_semaphore(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            try:
+                return self._host_semaphores[host]
+            except KeyError:
+                sem = tornado.locks.Semaphore(options.max_callbacks_per_host)
+                self._host_semaphores[host] = sem
+                return sem
+
+    @tornado.gen.coroutine
+    def _post_callback(self, url, body):
+        '''Sends the callback body to the customer's url.
+
+        Returns the HTTPResponse
+        '''
+        # Wait for the customer's host first so that a slow host
+        # doesn't hold the slots for the others.
+        host_semaphore = self._get_host_semaphore(url)
+        yield host_semaphore.acquire()
+        try:
+            yield self._callback_semaphore.acquire()
+            statemon.state.increment('callbacks_in_flight')
+            try:
+                headers = {"Content-Type": "application/json"}
+                request = tornado.httpclient.HTTPRequest(
+                    url=url,
+                    method="POST",
+                    body=body, 
+                    headers=headers,
+                    request_timeout=20.0, 
+                    connect_timeout=10.0)
+                response = yield tornado.gen.Task(utils.http.send_request,
+                                                  request)
+            finally:
+                statemon.state.decrement('callbacks_in_flight')
+                self._callback_semaphore.release()
+        finally:
+            host_semaphore.release()
+        raise tornado.gen.Return(response)
 
     @tornado.gen.coroutine
-    def send_callback_response(self, key):
+    def send_callback_response(self, key, remove=True):
         '''
         Send callback to the customer for a message with a given key
+
+        @remove : If True, the message is removed from SQS when the
+                  callback is done. Otherwise, the caller must call
+                  remove_callbacks() with the returned key.
+
+        Returns the key if the callback is done with, otherwise None
         '''
-        statemon.state.increment('callbacks_in_flight')
+        with self.lock:
+            try:
+                ccm = self.callback_messages[key]
+            except KeyError as e:
+                _log.warn('No knowlege of callback for key %s ignoring' %
+                          key)
+                return
+            ccm.dispatch_time = time.time()
         try:
+            response = yield self._post_callback(ccm.callback_url,
+                                                 ccm.response)
+        finally:
+            # If there was an unexpected error, the callback can be
+            # sent again next time.
             with self.lock:
-                try:
-                    ccm = self.callback_messages[key]
-                except KeyError as e:
-                    _log.warn('No knowlege of callback for key %s ignoring' %
-                              key)
-                    return
-            url = ccm.callback_url
-            body = ccm.response
-
-            headers = {"Content-Type": "application/json"}
-            request = tornado.httpclient.HTTPRequest(
-                url=url,
-                method="POST",
-                body=body, 
-                headers=headers,
-                request_timeout=20.0, 
-                connect_timeout=10.0)
-            response = yield tornado.gen.Task(utils.http.send_request,
-                                              request)
+                ccm.dispatch_time = None
+
+        with self.lock:
             if response.error is not None:
                 prev_failures = self.key_failures.get(key, 0)
                 if prev_failures >= self.max_callback_tries:
                     statemon.state.increment('callback_errors')
                     _log.error('Too many errors sending callback for key %s %s'
                                % (key, response.error))
-                    del self.key_failures[key]
+                    self.key_failures.pop(key, None)
+                    self.retry_times.pop(key, None)
                     self.callback_messages.pop(key)
-                    yield self.remove_callback(key)
-                else:    
+                else:
                     _log.warn('Error sending callback for key %s to %s' % 
-                              (key, url))
+                              (key, ccm.callback_url))
                     self.key_failures[key] = prev_failures + 1
+                    # Back off so that we don't keep waiting on a
+                    # broken endpoint
+                    self.retry_times[key] = (
+                        time.time() + options.callback_retry_delay *
+                        (1 << prev_failures))
+                    return
             else:
                 _log.info('Callback completed for key %s' % key)
                 statemon.state.increment('sucessful_callbacks')
-                yield self.remove_callback(key)
-                with self.lock:
-                    self.callback_messages.pop(key)
-                    try:
-                        del self.key_failures[key]
-                    except KeyError:
-                        pass
+                self.callback_messages.pop(key)
+                self.key_failures.pop(key, None)
+                self.retry_times.pop(key, None)
 
-        finally:
-            statemon.state.decrement('callbacks_in_flight')
+        if remove:
+            yield self.remove_callback(key)
+        raise tornado.gen.Return(key)
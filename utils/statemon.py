@@ -22,28 +22,369 @@ started using multiprocessing. To view the variable value, simply:
 
   statemon.state.get('mastermind.core.q_size')
 
+Variables defined after a process forks are only visible in that
+process, and every update takes a lock shared by all the processes. A
+server that forks workers can instead call
+statemon.state.enable_shared_memory() before forking. Then each
+process increments its own slot in a shared memory table without
+taking a cross-process lock and reading a counter from any process
+gives the sum over all the processes. Once a variable is assigned to,
+like statemon.state.q_size = 6, it is a gauge and its value is the
+last one written by any process. Variables defined in any process are
+listed by get_all_variables(), so only the parent needs to report.
+
 When incrementing or decrementing, you should use the increment() or
 decrement() functions instead of += because it is thread safe.
 
+To track the distribution of a value, like a latency, define a
+histogram instead:
+
+  statemon.define_histogram("db_latency")
+
+  statemon.state.record("db_latency", 0.0123)
+  with statemon.state.timer("db_latency"):
+    do_db_call()
+
 TODO(mdesnoyer): Have the variables be visible from an outside monitoring tool
 
 Author: Mark Desnoyer (desnoyer@neon-lab.com)
 Copyright 2013 Neon Labs
 
 '''
+from contextlib import contextmanager
+import ctypes
+import errno
 import inspect
+import math
+import mmap
 import multiprocessing
+import os
 import os.path
+import threading
+import time
 
 class Error(Exception):
     """Exception raised by errors in the statemon module."""
     pass
 
+class SharedCounters(object):
+    '''A table of variable values in shared memory with a row per process.
+
+    Each process increments only its own row, so updates do not need a
+    lock shared between processes, and the value of a counter is the
+    sum of its column. Rows of processes that have exited are taken
+    over by new processes, so their counts are kept.
+
+    Variables that are set instead of incremented are gauges. They
+    have a single slot shared by all the processes that holds the
+    last value written.
+
+    This must be created before the processes are forked.
+    '''
+    NAME_LEN = 256
+
+    # Flags for each variable
+    FLOAT = 0x1
+    GAUGE = 0x2
+
+    def __init__(self, max_processes=64, max_variables=2048):
+        self.max_processes = max_processes
+        self.max_variables = max_variables
+        n_values = max_processes * max_variables
+        value_size = ctypes.sizeof(ctypes.c_double) * n_values
+        pid_size = ctypes.sizeof(ctypes.c_int) * max_processes
+        name_size = self.NAME_LEN * max_variables
+        gauge_size = ctypes.sizeof(ctypes.c_double) * max_variables
+        flag_size = ctypes.sizeof(ctypes.c_int) * max_variables
+        self._mmap = mmap.mmap(-1, value_size + pid_size + name_size +
+                               gauge_size + flag_size + 8)
+        self._values = (ctypes.c_double * n_values).from_buffer(self._mmap)
+        self._pids = (ctypes.c_int * max_processes).from_buffer(
+            self._mmap, value_size)
+        self._names = (ctypes.c_char * name_size).from_buffer(
+            self._mmap, value_size + pid_size)
+        offset = value_size + pid_size + name_size
+        self._gauges = (ctypes.c_double * max_variables).from_buffer(
+            self._mmap, offset)
+        offset += gauge_size
+        self._flags = (ctypes.c_int * max_variables).from_buffer(
+            self._mmap, offset)
+        offset += flag_size
+        # Number of variables and process rows used
+        self._counts = (ctypes.c_int * 2).from_buffer(self._mmap, offset)
+
+        # Only used to register variables and processes
+        self._registry_lock = multiprocessing.Lock()
+        # Used to update the gauges
+        self._gauge_lock = multiprocessing.Lock()
+        self._indices = {}
+
+        self._pid = None
+        self._row = None
+        self._row_lock = None
+        self._claim_row()
+
+    def get_index(self, name, typ=int):
+        '''Returns the column of a variable, registering it if needed.'''
+        try:
+            return self._indices[name]
+        except KeyError:
+            pass
+        with self._registry_lock:
+            n_vars = self._counts[0]
+            for i in range(n_vars):
+                if self._get_name(i) == name:
+                    self._indices[name] = i
+                    return i
+            if n_vars >= self.max_variables:
+                raise Error('Too many shared statemon variables')
+            if len(name) >= self.NAME_LEN:
+                raise Error('Variable name too long: %s' % name)
+            start = n_vars * self.NAME_LEN
+            self._names[start:(start + len(name))] = name
+            self._flags[n_vars] = self.FLOAT if typ == float else 0
+            self._counts[0] = n_vars + 1
+            self._indices[name] = n_vars
+            return n_vars
+
+    def get_variables(self):
+        '''Returns a list of (name, typ) for all the registered variables.'''
+        return [(self._get_name(i),
+                 float if self._flags[i] & self.FLOAT else int)
+                for i in range(self._counts[0])]
+
+    def _get_name(self, idx):
+        start = idx * self.NAME_LEN
+        return self._names[start:(start + self.NAME_LEN)].rstrip('\x00')
+
+    def _claim_row(self):
+        '''Claims a row for this process.'''
+        pid = os.getpid()
+        with self._registry_lock:
+            row = None
+            n_rows = self._counts[1]
+            if n_rows < self.max_processes:
+                row = n_rows
+                self._counts[1] = n_rows + 1
+            else:
+                for i in range(n_rows):
+                    if not _pid_alive(self._pids[i]):
+                        row = i
+                        break
+                if row is None:
+                    raise Error('No shared statemon rows left for pid %i' %
+                                pid)
+            self._pids[row] = pid
+        self._row = row
+        self._row_lock = threading.Lock()
+        self._pid = pid
+
+    def _get_row(self):
+        if self._pid != os.getpid():
+            # We've been forked
+            self._claim_row()
+        return self._row
+
+    def get_lock(self):
+        '''Returns the lock for this process' row.'''
+        self._get_row()
+        return self._row_lock
+
+    def is_gauge(self, idx):
+        return bool(self._flags[idx] & self.GAUGE)
+
+    def add(self, idx, diff, safe=True):
+        if self.is_gauge(idx):
+            with self._gauge_lock:
+                self._gauges[idx] += diff
+            return
+        pos = self._get_row() * self.max_variables + idx
+        if safe:
+            with self._row_lock:
+                self._values[pos] += diff
+        else:
+            self._values[pos] += diff
+
+    def set(self, idx, value):
+        '''Sets the value of the variable, making it a gauge.'''
+        with self._gauge_lock:
+            self._gauges[idx] = value
+            self._flags[idx] |= self.GAUGE
+
+    def total(self, idx):
+        if self.is_gauge(idx):
+            return self._gauges[idx]
+        values = self._values
+        return sum([values[i * self.max_variables + idx]
+                    for i in range(self._counts[1])])
+
+    def reset(self, idx):
+        for i in range(self._counts[1]):
+            self._values[i * self.max_variables + idx] = 0
+        with self._gauge_lock:
+            self._gauges[idx] = 0
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class Variable(object):
+    '''A monitoring variable.
+
+    Acts like a multiprocessing.Value until it is moved to a
+    SharedCounters table.
+    '''
+    def __init__(self, typ):
+        if typ == int:
+            typech = 'i'
+        elif typ == float:
+            typech = 'f'
+        else:
+            raise Error('Invalid type: %s' % typ)
+        self._typ = typ
+        self._value = multiprocessing.Value(typech)
+        self._shared = None
+        self._idx = None
+        # True once the value has been set instead of incremented
+        self._is_gauge = False
+
+    @property
+    def value(self):
+        if self._shared is None:
+            return self._value.value
+        return self._typ(self._shared.total(self._idx))
+
+    @value.setter
+    def value(self, value):
+        if self._shared is None:
+            self._value.value = value
+            self._is_gauge = True
+        else:
+            self._shared.set(self._idx, self._typ(value))
+
+    def get_lock(self):
+        if self._shared is None:
+            return self._value.get_lock()
+        return self._shared.get_lock()
+
+    def add(self, diff, safe=True):
+        if self._shared is not None:
+            self._shared.add(self._idx, diff, safe=safe)
+        elif safe:
+            with self._value.get_lock():
+                self._value.value += diff
+        else:
+            self._value.value += diff
+
+    def reset(self):
+        if self._shared is None:
+            self._value.value = 0
+        else:
+            self._shared.reset(self._idx)
+
+    def move_to_shared(self, shared, name):
+        '''Moves the variable to a SharedCounters table.'''
+        if self._shared is not None:
+            return
+        idx = shared.get_index(name, self._typ)
+        if self._is_gauge:
+            shared.set(idx, self._value.value)
+        elif self._value.value != 0:
+            shared.add(idx, self._value.value)
+        self._shared = shared
+        self._idx = idx
+
+class Histogram(object):
+    '''A histogram of positive values with fixed log scale buckets.
+
+    There are BUCKETS_PER_DECADE buckets for every factor of 10 between
+    MIN_VALUE and MAX_VALUE. Values outside of that range are counted
+    in the first or last bucket. Like the other variables, the counts
+    are in shared memory so they are visible from other processes.
+    '''
+    MIN_VALUE = 1e-5
+    MAX_VALUE = 1e4
+    BUCKETS_PER_DECADE = 10
+    N_BUCKETS = int(round(math.log10(MAX_VALUE / MIN_VALUE) *
+                          BUCKETS_PER_DECADE)) + 2
+
+    def __init__(self):
+        self._counts = multiprocessing.Array('l', self.N_BUCKETS)
+        self._log_min = math.log10(self.MIN_VALUE)
+
+    def record(self, value):
+        '''Adds a value to the histogram.'''
+        if value < self.MIN_VALUE:
+            idx = 0
+        else:
+            idx = min(int((math.log10(value) - self._log_min) *
+                          self.BUCKETS_PER_DECADE) + 1,
+                      self.N_BUCKETS - 1)
+        with self._counts.get_lock():
+            self._counts[idx] += 1
+
+    @contextmanager
+    def time(self):
+        '''Context manager that records how long its block takes in s.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(time.time() - start)
+
+    def get_counts(self):
+        '''Returns a copy of the counts in each bucket.'''
+        with self._counts.get_lock():
+            return self._counts[:]
+
+    def reset(self):
+        with self._counts.get_lock():
+            for i in range(self.N_BUCKETS):
+                self._counts[i] = 0
+
+    @classmethod
+    def bucket_value(cls, idx):
+        '''Returns the representative value of a bucket.
+
+        This is the geometric middle of the bucket.
+        '''
+        if idx == 0:
+            return cls.MIN_VALUE
+        if idx == cls.N_BUCKETS - 1:
+            return cls.MAX_VALUE
+        return cls.MIN_VALUE * 10 ** ((idx - 0.5) / cls.BUCKETS_PER_DECADE)
+
+    @classmethod
+    def percentiles(cls, counts, percents=(50, 95, 99)):
+        '''Estimates percentiles from a list of bucket counts.
+
+        Returns a list of values, one for each percent, or None if the
+        counts are empty.
+        '''
+        total = sum(counts)
+        if total <= 0:
+            return None
+        rv = []
+        for percent in percents:
+            target = percent / 100.0 * total
+            cum = 0
+            for idx, count in enumerate(counts):
+                cum += count
+                if count > 0 and cum >= target:
+                    rv.append(cls.bucket_value(idx))
+                    break
+        return rv
+
 class State(object):
     '''A collection of state variables.'''
     def __init__(self):
         self._lock = multiprocessing.RLock()
         self._vars = {}
+        self._hists = {}
+        self._shared = None
 
         # Find the root directory of the source tree
         cur_dir = os.path.abspath(os.path.dirname(__file__))
@@ -124,17 +465,24 @@ class State(object):
             # It's redefined, so ignore
             return
 
-        typech = None
-        if typ == int:
-            typech = 'i'
-        elif typ == float:
-            typech = 'f'
-        else:
-            raise Error('Invalid type: %s' % typ)
-
-        self._vars[global_name] = multiprocessing.Value(typech)
+        var = Variable(typ)
         if default is not None:
-            self._vars[global_name].value = default
+            var.value = default
+        if self._shared is not None:
+            var.move_to_shared(self._shared, global_name)
+        self._vars[global_name] = var
+
+    def enable_shared_memory(self, max_processes=64, max_variables=2048):
+        '''Moves all the variables to a SharedCounters table.
+
+        Call this in the parent process before forking. Variables
+        defined later are also put in the table.
+        '''
+        with self._lock:
+            if self._shared is None:
+                self._shared = SharedCounters(max_processes, max_variables)
+            for name, var in self._vars.iteritems():
+                var.move_to_shared(self._shared, name)
 
     def increment(self, name=None, diff=1, ref=None, safe=True,
                   stack_depth=1):
@@ -155,11 +503,7 @@ class State(object):
         if ref is None:
             ref = self.get_ref(name, stack_depth+1)
 
-        if safe:
-            with ref.get_lock():
-                ref.value += diff
-        else:
-            ref.value += diff
+        ref.add(diff, safe=safe)
 
     def decrement(self, name=None, diff=1, ref=None, safe=True,
                   stack_depth=1):
@@ -186,10 +530,66 @@ class State(object):
         ref = self._vars[global_name]
         self.increment(ref=ref, diff=diff, safe=safe)
     
+    def define_histogram(self, name, stack_depth=2):
+        '''Define a new histogram variable.
+
+        Inputs:
+        name - Name of the variable
+        stack_depth - Stack depth to your module
+        '''
+        global_name = self._local2global(name, stack_depth=stack_depth)
+        with self._lock:
+            if global_name in self._hists or global_name in self._vars:
+                # It's redefined, so ignore
+                return
+            self._hists[global_name] = Histogram()
+
+    def record(self, name=None, value=0.0, ref=None, stack_depth=1):
+        '''Records a value in a histogram variable.
+
+        Inputs:
+        name - Name of the variable (Either this or ref must be set)
+        value - Value to record
+        ref - Reference to the histogram from get_histogram_ref()
+        stack_depth - Stack depth to your module
+        '''
+        if not ((name is None) ^ (ref is None)):
+            raise TypeError('Exactly one of name or ref must be given.')
+
+        if ref is None:
+            ref = self.get_histogram_ref(name, stack_depth+1)
+        ref.record(value)
+
+    def timer(self, name, stack_depth=1):
+        '''Returns a context manager that records the time of its
+        block, in seconds, in a histogram variable.
+        '''
+        return self.get_histogram_ref(name, stack_depth+1).time()
+
+    def get_histogram_ref(self, name, stack_depth=1):
+        '''Returns the Histogram object so that the lookup can be skipped.'''
+        global_name = self._local2global(name, stack_depth+1)
+        try:
+            return self._hists[global_name]
+        except KeyError:
+            raise AttributeError("Unrecognized histogram %r" % global_name)
+
     def get_all_variables(self):
         ''' return dict of all variables being monitored '''
+        if self._shared is not None:
+            # Pick up the variables that were defined in other processes
+            with self._lock:
+                for name, typ in self._shared.get_variables():
+                    if name not in self._vars:
+                        var = Variable(typ)
+                        var.move_to_shared(self._shared, name)
+                        self._vars[name] = var
         return self._vars
 
+    def get_all_histograms(self):
+        '''Returns dict of the global name -> Histogram.'''
+        return self._hists
+
     def get_ref(self, name, stack_depth=1):
         ''' Returns a reference of the variable.
 
@@ -211,16 +611,17 @@ class State(object):
         
         with self._lock:
             for value in self._vars.itervalues():
-                with value.get_lock():
-                    try:
-                        value.value = 0
-                    except TypeError:
-                        value.value = 0.0
+                value.reset()
+            for hist in self._hists.itervalues():
+                hist.reset()
 
 state = State()
 '''Global state variable object'''
 
 def define(name, typ, default=None):
     return state.define(name, typ, default=default, stack_depth=3)
+
+def define_histogram(name):
+    return state.define_histogram(name, stack_depth=3)
             
         
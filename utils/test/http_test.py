@@ -21,11 +21,13 @@ from StringIO import StringIO
 import test_utils.neontest
 import threading
 import time
+import tornado.concurrent
 import tornado.gen
 from tornado.httpclient import HTTPResponse, HTTPRequest, HTTPError
 import unittest
 import utils.http
 import utils.neon
+from utils.options import options
 
 _log = logging.getLogger(__name__)
 
@@ -263,6 +265,130 @@ class TestSendRequest(test_utils.neontest.AsyncTestCase):
         self.assertRegexpMatches(str(found_response.error),
                                  'Internal Server Error')
 
+class TestCircuitBreaker(test_utils.neontest.AsyncTestCase):
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.sync_patcher = \
+          patch('utils.http.tornado.httpclient.AsyncHTTPClient')
+
+        self.mock_client = self._future_wrap_mock(
+            self.sync_patcher.start()().fetch)
+        logging.getLogger('utils.http').reset_sample_counters()
+        utils.http._circuit_breakers.clear()
+        utils.http._host_limiters.clear()
+
+    def tearDown(self):
+        utils.http._circuit_breakers.clear()
+        utils.http._host_limiters.clear()
+        self.sync_patcher.stop()
+        super(TestCircuitBreaker, self).tearDown()
+
+    def test_opens_after_failures(self):
+        request, valid_response = create_valid_ack()
+        self.mock_client.side_effect = [HTTPError(500), HTTPError(599),
+                                        valid_response]
+        with options._set_bounded('utils.http.circuit_breaker_failures', 2):
+            response = utils.http.send_request(request, 5, base_delay=0.01)
+            self.assertEqual(response.code, 599)
+            self.assertEqual(self.mock_client.call_count, 2)
+
+            # Rejected without being sent
+            response = utils.http.send_request(request, 5, base_delay=0.01)
+            self.assertEqual(response.code, 503)
+            self.assertEqual(self.mock_client.call_count, 2)
+
+            # A different host isn't affected
+            self.mock_client.side_effect = [valid_response]
+            response = utils.http.send_request(
+                HTTPRequest('http://other.neon.com'))
+            self.assertIsNone(response.error)
+
+    def test_half_open(self):
+        request, valid_response = create_valid_ack()
+        self.mock_client.side_effect = [HTTPError(500), HTTPError(500),
+                                        valid_response, valid_response]
+        with options._set_bounded('utils.http.circuit_breaker_failures', 1):
+            with options._set_bounded(
+                    'utils.http.circuit_breaker_reset_time', 0.05):
+                breaker = utils.http.get_circuit_breaker('www.neon.com')
+                utils.http.send_request(request, 1)
+                self.assertEqual(breaker.state,
+                                 utils.http.CircuitBreaker.OPEN)
+
+                # Trial request fails so it opens again
+                time.sleep(0.06)
+                utils.http.send_request(request, 1)
+                self.assertEqual(breaker.state,
+                                 utils.http.CircuitBreaker.OPEN)
+                self.assertEqual(self.mock_client.call_count, 2)
+
+                # Only one trial request is let through at a time
+                time.sleep(0.06)
+                self.assertTrue(breaker.allow_request())
+                self.assertFalse(breaker.allow_request())
+                breaker.record_success()
+                self.assertEqual(breaker.state,
+                                 utils.http.CircuitBreaker.CLOSED)
+                response = utils.http.send_request(request, 1)
+                self.assertEqual(response, valid_response)
+
+    def test_trial_with_unexpected_error(self):
+        request, valid_response = create_valid_ack()
+        self.mock_client.side_effect = [HTTPError(500), ValueError('oops'),
+                                        valid_response]
+        with options._set_bounded('utils.http.circuit_breaker_failures', 1):
+            with options._set_bounded(
+                    'utils.http.circuit_breaker_reset_time', 0.05):
+                breaker = utils.http.get_circuit_breaker('www.neon.com')
+                utils.http.send_request(request, 1)
+
+                time.sleep(0.06)
+                with self.assertRaises(ValueError):
+                    utils.http.send_request(request, 1)
+
+                # Another trial is let through
+                response = utils.http.send_request(request, 1)
+                self.assertEqual(response, valid_response)
+                self.assertEqual(breaker.state,
+                                 utils.http.CircuitBreaker.CLOSED)
+
+    def test_client_errors_dont_open(self):
+        request, valid_response = create_valid_ack()
+        self.mock_client.side_effect = [HTTPError(404), HTTPError(404)]
+        with options._set_bounded('utils.http.circuit_breaker_failures', 1):
+            utils.http.send_request(request, 2, base_delay=0.01)
+        self.assertEqual(self.mock_client.call_count, 2)
+        self.assertEqual(utils.http.get_circuit_breaker('www.neon.com').state,
+                         utils.http.CircuitBreaker.CLOSED)
+
+    @tornado.testing.gen_test
+    def test_max_requests_per_host(self):
+        request, valid_response = create_valid_ack()
+        fetch_futures = []
+        def _fetch(*args, **kwargs):
+            future = tornado.concurrent.Future()
+            fetch_futures.append(future)
+            return future
+        self.sync_patcher.stop()
+        with patch('utils.http.tornado.httpclient.AsyncHTTPClient') as mock:
+            mock().fetch.side_effect = _fetch
+            with options._set_bounded('utils.http.max_requests_per_host', 2):
+                requests = [utils.http.send_request(request, async=True)
+                            for i in range(3)]
+                yield tornado.gen.moment
+                self.assertEqual(len(fetch_futures), 2)
+
+                fetch_futures[0].set_result(valid_response)
+                yield requests[0]
+                yield tornado.gen.moment
+                self.assertEqual(len(fetch_futures), 3)
+                fetch_futures[1].set_result(valid_response)
+                fetch_futures[2].set_result(valid_response)
+                yield requests[1:]
+        self.sync_patcher.start()
+        self.assertEqual(utils.http.get_host_limiter('www.neon.com').active,
+                         0)
+
 class TestRequestPool(test_utils.neontest.AsyncTestCase):
     def setUp(self):
         super(TestRequestPool, self).setUp()
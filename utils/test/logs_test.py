@@ -151,16 +151,76 @@ class TestLogglyHandler(test_utils.neontest.TestCase):
 
         self.assertWaitForEquals(lambda: self.url_mock.call_count, 1)
         request = self.url_mock.call_args[0][0]
-        self.assertRegexpMatches(request.url, 'https://.*/tag/mytag')
+        self.assertRegexpMatches(request.url, 'https://.*/bulk/.*/tag/mytag')
         self.assertDictContainsSubset(
-            {'Content-type' : 'application/x-www-form-urlencoded'},
+            {'Content-type' : 'text/plain'},
             request.headers)
-        raw_data = re.compile('PLAINTEXT=(.*)').match(request.body).group(1)
-        record = json.loads(urllib2.unquote(raw_data))
+        record = json.loads(request.body)
 
         self.assertEqual(record['message'], 'I got an INFO log')
         self.assertEqual(record['levelname'], 'INFO')
 
+    def test_batch(self):
+        with options._set_bounded('utils.logs.http_log_batch_size', 3):
+            with self.assertLogExists(logging.INFO, 'log 3'):
+                for i in range(4):
+                    _log.info('log %i', i)
+
+            self.assertWaitForEquals(lambda: self.url_mock.call_count, 2)
+        bodies = [x[0][0].body for x in self.url_mock.call_args_list]
+        self.assertEqual(
+            [[json.loads(line)['message'] for line in body.split('\n')]
+             for body in bodies],
+            [['log 0', 'log 1', 'log 2'], ['log 3']])
+
+    def test_drop_oldest(self):
+        # Block the logging thread so that the records queue up
+        self.handler._flushing = True
+        with options._set_bounded('utils.logs.http_log_max_queue', 2):
+            with self.assertLogExists(logging.INFO, 'log 2'):
+                for i in range(3):
+                    _log.info('log %i', i)
+
+        self.assertEqual([x.getMessage() for x in self.handler._queue],
+                         ['log 1', 'log 2'])
+        self.handler._flushing = False
+
+    def test_record_prepared_when_queued(self):
+        self.handler._flushing = True
+        args = ['before']
+        with self.assertLogExists(logging.ERROR, 'Value is .*before'):
+            try:
+                raise ValueError('oops')
+            except ValueError:
+                _log.exception('Value is %s', args)
+        args[0] = 'after'
+
+        record = self.handler._queue[0]
+        self.assertEqual(record.getMessage(), "Value is ['before']")
+        self.assertIsNone(record.args)
+        self.assertIsNone(record.exc_info)
+        self.assertRegexpMatches(record.exc_text, 'ValueError: oops')
+        self.handler._flushing = False
+
+    def test_flush_sends_queued_records(self):
+        with options._set_bounded('utils.logs.http_log_flush_interval',
+                                  600.0):
+            handler = utils.logs.LogglyHandler('mytag')
+        self.logger.addHandler(handler)
+        try:
+            with self.assertLogExists(logging.INFO, 'log 1'):
+                _log.info('log 0')
+                _log.info('log 1')
+            handler.flush()
+            self.assertEqual(self.url_mock.call_count, 1)
+            self.assertEqual(
+                [json.loads(line)['message'] for line in
+                 self.url_mock.call_args[0][0].body.split('\n')],
+                ['log 0', 'log 1'])
+            self.assertEqual(len(handler._queue), 0)
+        finally:
+            self.logger.removeHandler(handler)
+
     @patch('sys.stderr', new_callable=StringIO)
     def test_bad_connection(self, mock_stderr):
         self.url_mock.side_effect = \
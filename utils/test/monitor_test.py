@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+'''
+Tests for sending monitoring data to carbon
+
+Copyright 2016 Neon Labs
+'''
+import os.path
+import sys
+sys.path.insert(0,os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import cPickle as pickle
+from mock import patch
+import socket
+import struct
+import unittest
+from utils import monitor
+from utils import statemon
+from utils.options import options
+
+class TestCarbonSender(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.sender = monitor.CarbonSender()
+
+    def tearDown(self):
+        self.sender.close()
+        self.server.close()
+
+    def _read_exactly(self, conn, n):
+        data = ''
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            self.assertTrue(chunk)
+            data += chunk
+        return data
+
+    def _read_pickle_frame(self, conn):
+        size = struct.unpack('!L', self._read_exactly(conn, 4))[0]
+        return pickle.loads(self._read_exactly(conn, size))
+
+    def test_pickle_batches_on_one_connection(self):
+        with options._set_bounded('utils.monitor.carbon_pickle_port',
+                                  self.port):
+            self.assertTrue(self.sender.send([('a.b', 1, 100),
+                                              ('a.c', 2.5, 100)]))
+            self.assertTrue(self.sender.send([('a.b', 3, 160)]))
+            conn, _ = self.server.accept()
+            try:
+                self.assertEquals(self._read_pickle_frame(conn),
+                                  [('a.b', (100, 1)), ('a.c', (100, 2.5))])
+                self.assertEquals(self._read_pickle_frame(conn),
+                                  [('a.b', (160, 3))])
+            finally:
+                conn.close()
+
+    def test_plaintext(self):
+        with options._set_bounded('utils.monitor.carbon_port', self.port):
+            self.assertTrue(self.sender.send([('a.b', 1, 100),
+                                              ('a.c', 2, 101)]))
+            conn, _ = self.server.accept()
+            try:
+                expected = 'a.b 1 100\na.c 2 101\n'
+                self.assertEquals(self._read_exactly(conn, len(expected)),
+                                  expected)
+            finally:
+                conn.close()
+
+    def test_buffers_while_unreachable(self):
+        self.server.close()
+        with options._set_bounded('utils.monitor.carbon_pickle_port',
+                                  self.port):
+            with options._set_bounded(
+                    'utils.monitor.carbon_buffered_intervals', 2):
+                for i in range(3):
+                    self.assertFalse(self.sender.send([('a.b', i, i)]))
+
+                # Only the last intervals are kept and we back off
+                # instead of reconnecting on every send.
+                self.assertEquals(len(self.sender._pending), 2)
+                self.assertGreater(self.sender._next_connect, 0)
+                self.assertIsNone(self.sender._sock)
+
+class TestHistogramMetrics(unittest.TestCase):
+    def setUp(self):
+        self.state = statemon.State()
+        self.state.define_histogram('latency')
+        self.state_patcher = patch('utils.monitor.statemon.state', self.state)
+        self.state_patcher.start()
+        monitor._last_hist_counts.clear()
+
+    def tearDown(self):
+        self.state_patcher.stop()
+        monitor._last_hist_counts.clear()
+
+    def test_percentiles_per_interval(self):
+        for i in range(100):
+            self.state.record('latency', 0.1)
+        metrics = dict(monitor.get_histogram_metrics())
+        self.assertEquals(metrics['utils.test.monitor_test.latency.count'],
+                          100)
+        self.assertAlmostEqual(
+            metrics['utils.test.monitor_test.latency.p50'], 0.1, delta=0.02)
+        self.assertIn('utils.test.monitor_test.latency.p99', metrics)
+
+        # Nothing new was recorded
+        metrics = dict(monitor.get_histogram_metrics())
+        self.assertEquals(metrics,
+                          {'utils.test.monitor_test.latency.count' : 0})
+
+        self.state.record('latency', 2.0)
+        metrics = dict(monitor.get_histogram_metrics())
+        self.assertAlmostEqual(
+            metrics['utils.test.monitor_test.latency.p50'], 2.0, delta=0.3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -435,6 +435,42 @@ class TestImagePrep(unittest.TestCase):
             imageEns = ip(self.image_cv)
             self.assertTrue(np.array_equiv(imageSeq, imageEns))
 
+    def test_fused_steps(self):
+        np.random.seed(42)
+        for i in range(100):
+            config = produce_rand_config(self.image_cv)
+            ip = ImagePrep(**config)
+            fused_ip = ImagePrep(fuse_steps=True, **config)
+            self.assertEquals(fused_ip(self.image_cv).shape,
+                              ip(self.image_cv).shape)
+
+        # A single resize is exactly the same
+        config = {'max_height' : 180}
+        self.assertTrue(np.array_equal(
+            ImagePrep(fuse_steps=True, **config)(self.image_cv),
+            ImagePrep(**config)(self.image_cv)))
+
+        # Cropping before the resize is close to cropping after it
+        config = {'max_height' : 180, 'crop_frac' : 0.8}
+        fused = ImagePrep(fuse_steps=True, **config)(self.image_cv)
+        unfused = ImagePrep(**config)(self.image_cv)
+        self.assertEquals(fused.shape, unfused.shape)
+        self.assertLess(np.mean(np.abs(fused.astype(float) - unfused)), 5.0)
+
+    def test_reuse_output(self):
+        ip = ImagePrep(max_height=180, fuse_steps=True, reuse_output=True)
+        flipped = np.ascontiguousarray(self.image_cv[::-1])
+        first = ip(self.image_cv)
+        second = ip(flipped)
+        self.assertIs(first, second)
+        self.assertTrue(np.array_equal(second,
+                                       ImagePrep(max_height=180)(flipped)))
+
+        # Lists of images do not share the buffer
+        images = ip([self.image_cv, self.image_cv[::-1]])
+        self.assertIsNot(images[0], images[1])
+        self.assertIsNot(images[0], second)
+
     def test_gray_to_bgr(self):
         image_pil = Image.open(TEST_GRAY_IMAGE)
         ip = ImagePrep()
@@ -469,5 +505,61 @@ class TestResizeAndCrop(unittest.TestCase):
             pycvutils.resize_and_crop(self._image_cv, h=120).shape,
             (120,160,3))
 
+class FakeVideo(object):
+    '''A video whose frames are filled with their frame number.'''
+    def __init__(self, num_frames):
+        self.num_frames = num_frames
+        self.pos = 0
+        self.n_sets = 0
+        self.n_grabs = 0
+        self.n_retrieves = 0
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.num_frames
+        elif prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.pos
+
+    def set(self, prop, val):
+        self.n_sets += 1
+        self.pos = val
+        return True
+
+    def grab(self):
+        if self.pos >= self.num_frames:
+            return False
+        self.n_grabs += 1
+        self.pos += 1
+        return True
+
+    def retrieve(self):
+        self.n_retrieves += 1
+        return True, np.ones((2, 2, 3), np.uint8) * (self.pos - 1)
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+class TestIterateVideo(unittest.TestCase):
+    def test_step_with_grabs(self):
+        video = FakeVideo(20)
+        stats = pycvutils.DecodeStats()
+        frames = list(pycvutils.iterate_video(video, start=3, end=12, step=3,
+                                              stats=stats))
+
+        self.assertEquals([x[0, 0, 0] for x in frames], [3, 6, 9])
+        self.assertEquals(video.n_sets, 1)
+        self.assertEquals(video.n_retrieves, 3)
+        self.assertEquals(stats.seeks, 1)
+        self.assertEquals(stats.retrieves, 3)
+        self.assertEquals(stats.grabs, 4)
+
+    def test_to_end_of_video(self):
+        video = FakeVideo(5)
+        frames = list(pycvutils.iterate_video(video, step=2))
+
+        self.assertEquals([x[0, 0, 0] for x in frames], [0, 2, 4])
+
 if __name__=='__main__':
     unittest.main()
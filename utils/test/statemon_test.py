@@ -154,5 +154,150 @@ class TestStatemonObj(unittest.TestCase):
             proc.join()
         
 
+class TestSharedMemory(unittest.TestCase):
+    def setUp(self):
+        self.state = statemon.State()
+        self.state.define('an_int', int)
+        self.state.define('a_float', float)
+        self.state.an_int = 2
+        self.state.enable_shared_memory(max_processes=3, max_variables=16)
+
+    def test_single_process(self):
+        ref = self.state.get_ref('an_int')
+        self.assertEqual(self.state.an_int, 2)
+        self.state.increment('an_int', 3)
+        self.state.increment(ref=ref, safe=False)
+        self.assertEqual(self.state.an_int, 6)
+        self.assertIsInstance(self.state.an_int, int)
+
+        self.state.a_float = 1.5
+        self.state.increment('a_float', 0.25)
+        self.assertAlmostEqual(self.state.a_float, 1.75)
+
+        self.state.define('new_int', int, default=4)
+        self.assertEqual(self.state.new_int, 4)
+
+        self.state._reset_values()
+        self.assertEqual(self.state.an_int, 0)
+
+    def test_children_are_summed(self):
+        kill_proc = multiprocessing.Event()
+
+        def do_increments(done_increment):
+            for i in range(5):
+                self.state.increment('an_int')
+            # Defined after the fork
+            self.state.define_and_increment('child_int', 3)
+
+            done_increment.set()
+            kill_proc.wait()
+
+        done_events = [multiprocessing.Event() for i in range(2)]
+        procs = [multiprocessing.Process(target=do_increments, args=(x,))
+                 for x in done_events]
+        for proc in procs:
+            proc.start()
+        try:
+            for done_increment in done_events:
+                done_increment.wait()
+            self.assertEqual(self.state.an_int, 12)
+
+            self.state.define('child_int', int)
+            self.assertEqual(self.state.child_int, 6)
+        finally:
+            kill_proc.set()
+            for proc in procs:
+                proc.join()
+
+        # Rows of dead processes are reused but their counts are kept
+        proc = multiprocessing.Process(target=do_increments,
+                                       args=(multiprocessing.Event(),))
+        proc.start()
+        proc.join()
+        self.assertEqual(self.state.an_int, 17)
+        self.assertEqual(self.state.child_int, 9)
+
+    def test_gauge_set_in_children(self):
+        self.state.define('a_gauge', int)
+        kill_proc = multiprocessing.Event()
+
+        def set_gauge(value, done_set):
+            self.state.a_gauge = value
+            self.state.define('child_gauge', float)
+            self.state.child_gauge = 0.5
+            done_set.set()
+            kill_proc.wait()
+
+        procs = []
+        try:
+            for value in [1, 1]:
+                done_set = multiprocessing.Event()
+                proc = multiprocessing.Process(target=set_gauge,
+                                               args=(value, done_set))
+                proc.start()
+                procs.append(proc)
+                done_set.wait()
+
+            # The gauge is the last value set, not the sum
+            self.assertEqual(self.state.a_gauge, 1)
+            self.state.increment('a_gauge')
+            self.assertEqual(self.state.a_gauge, 2)
+
+            # Variables only defined in the children are reported
+            all_vars = self.state.get_all_variables()
+            child_gauge = all_vars['utils.test.statemon_test.child_gauge']
+            self.assertAlmostEqual(child_gauge.value, 0.5)
+        finally:
+            kill_proc.set()
+            for proc in procs:
+                proc.join()
+
+        self.state._reset_values()
+        self.assertEqual(self.state.a_gauge, 0)
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        self.state = statemon.State()
+
+    def test_record_and_percentiles(self):
+        self.state.define_histogram('latency')
+        for i in range(90):
+            self.state.record('latency', 0.01)
+        for i in range(10):
+            self.state.record('latency', 1.0)
+
+        counts = self.state.get_histogram_ref('latency').get_counts()
+        self.assertEqual(sum(counts), 100)
+        p50, p95, p99 = statemon.Histogram.percentiles(counts)
+        self.assertAlmostEqual(p50, 0.01, delta=0.003)
+        self.assertAlmostEqual(p95, 1.0, delta=0.3)
+        self.assertAlmostEqual(p99, 1.0, delta=0.3)
+
+        self.assertIsNone(statemon.Histogram.percentiles([0] * len(counts)))
+
+    def test_out_of_range(self):
+        hist = statemon.Histogram()
+        hist.record(0)
+        hist.record(1e9)
+        counts = hist.get_counts()
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[-1], 1)
+
+    def test_timer(self):
+        self.state.define_histogram('latency')
+        with self.state.timer('latency'):
+            pass
+        ref = self.state.get_histogram_ref('latency')
+        with ref.time():
+            pass
+        self.assertEqual(sum(ref.get_counts()), 2)
+
+        self.state._reset_values()
+        self.assertEqual(sum(ref.get_counts()), 0)
+
+    def test_unknown_histogram(self):
+        with self.assertRaises(AttributeError):
+            self.state.record('unknown', 1.0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -18,7 +18,9 @@ import tornado
 import tornado.testing
 import unittest
 import utils.sqsmanager
+from boto.sqs.message import Message
 from utils.sqsmanager import CustomerCallbackMessage
+from utils.options import options
 
 from mock import patch
 from mock import MagicMock
@@ -182,6 +184,32 @@ class TestSQSCallbackManager(test_utils.neontest.AsyncTestCase):
         msgs = yield self.manager.get_callback_messages()
         self.assertEqual(len(msgs), 0)
 
+    def _message(self, msg_id, receipt_handle):
+        msg = Message()
+        msg.id = msg_id
+        msg.receipt_handle = receipt_handle
+        return msg
+
+    @tornado.testing.gen_test
+    def test_duplicate_and_removed_messages(self):
+        msgs = [self._message('m%i' % i, 'r%i' % i) for i in range(3)]
+        self.manager._add_messages(msgs)
+        # m1 is received again with a new receipt handle
+        dup = self._message('m1', 'r1b')
+        self.manager._add_messages([dup, self._message('m3', 'r3')])
+
+        self.assertEqual([x.receipt_handle for x in self.manager.messages],
+                         ['r0', 'r1b', 'r2', 'r3'])
+
+        with patch.object(self.manager, '_sqs_delete_batch') as delete_mock:
+            delete_mock = self._future_wrap_mock(delete_mock)
+            yield self.manager.remove_messages([msgs[1], msgs[2]])
+            # Removing a message twice is fine
+            yield self.manager.remove_messages([msgs[2]])
+
+        self.assertEqual([x.receipt_handle for x in self.manager.messages],
+                         ['r0', 'r3'])
+
     def test_error_on_callback(self):
         self.manager.max_callback_tries = 1
         self.mock_http_response.side_effect = [
@@ -191,17 +219,104 @@ class TestSQSCallbackManager(test_utils.neontest.AsyncTestCase):
         self.manager.add_callback_response('v1', 'http://callback1',
                                            '{"vid": 1}') 
         
+        with options._set_bounded('utils.sqsmanager.callback_retry_delay',
+                                  0.0):
+            with self.assertLogExists(logging.WARNING,
+                                      'Error sending callback for key v1'):
+                self.manager.schedule_all_callbacks(['v1'])
+            self.assertEqual(self.manager.sq.count(), 1)
+
+            # Now have there be too many errors
+            with self.assertLogExists(logging.ERROR,
+                                      'Too many errors.* v1'):
+                self.manager.schedule_all_callbacks(['v1'])
+        self.assertEqual(self.manager.sq.count(), 0)
+        self.assertEquals(len(self.manager.callback_messages), 0)
+        self.assertEquals(len(self.manager.messages), 0)
+
+    def test_retry_is_delayed(self):
+        self.mock_http_response.side_effect = [
+            self.invalid_response,
+            self.valid_response,
+            self.valid_response
+            ]
+        self.manager.add_callback_response('v1', 'http://callback1',
+                                           '{"vid": 1}')
+        self.manager.add_callback_response('v2', 'http://callback2',
+                                           '{"vid": 2}')
+
         with self.assertLogExists(logging.WARNING,
                                   'Error sending callback for key v1'):
-            self.manager.schedule_all_callbacks(['v1'])
+            self.manager.schedule_all_callbacks(['v1', 'v2'])
         self.assertEqual(self.manager.sq.count(), 1)
 
-        # Now have there be too many errors
+        # It's too early to retry v1
+        self.manager.schedule_all_callbacks(['v1'])
+        self.assertEqual(self.mock_http.send_request.call_count, 2)
+
+        self.manager.retry_times['v1'] = time.time() - 1
+        self.manager.schedule_all_callbacks(['v1'])
+        self.assertEqual(self.mock_http.send_request.call_count, 3)
+        self.assertEqual(self.manager.sq.count(), 0)
+
+    def test_unexpected_error_on_callback(self):
+        self.mock_http_response.side_effect = [
+            ValueError('oops'),
+            self.valid_response,
+            self.valid_response
+            ]
+        self.manager.add_callback_response('v1', 'http://callback1',
+                                           '{"vid": 1}')
+        self.manager.add_callback_response('v2', 'http://callback2',
+                                           '{"vid": 2}')
+
         with self.assertLogExists(logging.ERROR,
-                                  'Too many errors.* v1'):
-            self.manager.schedule_all_callbacks(['v1'])
+                                  'Unexpected error sending a callback'):
+            self.manager.schedule_all_callbacks(['v1', 'v2'])
+
+        # The successful callback is still removed
+        self.assertEqual(self.manager.sq.count(), 1)
+        self.assertEqual(self.manager.callback_messages.keys(), ['v1'])
+        self.assertIsNone(self.manager.callback_messages['v1'].dispatch_time)
+
+        # And the failed one is tried again
+        self.manager.schedule_all_callbacks(['v1', 'v2'])
+        self.assertEqual(self.mock_http.send_request.call_count, 3)
+        self.assertEqual(self.manager.sq.count(), 0)
+
+    def test_limit_callbacks_per_host(self):
+        pending = []
+        in_flight = {}
+        max_in_flight = {}
+        def _send_request(request, callback):
+            host = request.url.split('/')[2]
+            in_flight[host] = in_flight.get(host, 0) + 1
+            max_in_flight[host] = max(max_in_flight.get(host, 0),
+                                      in_flight[host])
+            def _done():
+                in_flight[host] -= 1
+                callback(self.valid_response)
+            pending.append(_done)
+        self.mock_http.send_request.side_effect = _send_request
+
+        for i in range(6):
+            self.manager.add_callback_response('slow%i' % i,
+                                               'http://slow.com/%i' % i,
+                                               '{}')
+        self.manager.add_callback_response('fast', 'http://fast.com', '{}')
+
+        with options._set_bounded('utils.sqsmanager.max_callbacks_per_host',
+                                  2):
+            future = self.manager.schedule_all_callbacks(
+                ['fast'] + ['slow%i' % i for i in range(6)], async=True)
+            while not future.done():
+                self.io_loop.run_sync(lambda: tornado.gen.moment)
+                if pending:
+                    pending.pop(0)()
+            self.io_loop.run_sync(lambda: future)
+
+        self.assertEqual(max_in_flight, {'slow.com' : 2, 'fast.com' : 1})
         self.assertEqual(self.manager.sq.count(), 0)
-        self.assertEquals(len(self.manager.callback_messages), 0)
         self.assertEquals(len(self.manager.messages), 0)
 
     def _test_send_callback_response2(self):
@@ -1558,7 +1558,9 @@ class VideoClient(multiprocessing.Process):
         self.model = None
         self.cv_semaphore = cv_semaphore
         self.videos_processed = 0
-        self.job_queue = video_processing_queue.VideoProcessingQueue()
+        # Jobs are processed one at a time, so don't hide any extra
+        # ones from the other workers.
+        self.job_queue = video_processing_queue.VideoProcessingQueue(slots=1)
 
     @tornado.gen.coroutine
     def dequeue_job(self):
@@ -1700,6 +1702,12 @@ class VideoClient(multiprocessing.Process):
             self.do_work()
         if self.model is not None:
             del self.model
+
+        # Let other workers have any jobs we prefetched
+        try:
+            self.job_queue.release_buffered_messages()
+        except Exception as e:
+            _log.error('Error releasing prefetched jobs: %s' % e)
  
         _log.info("stopping worker [%s] " % (self.pid))
 
@@ -1789,6 +1797,10 @@ def shutdown_master_process():
 if __name__ == "__main__":
     utils.neon.InitNeon()
 
+    # The workers update their monitoring variables in shared memory
+    # and only this process reports them.
+    statemon.state.enable_shared_memory()
+
     _master_pid = os.getpid()
 
     # Register a function that will shutdown the workers
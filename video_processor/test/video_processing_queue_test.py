@@ -27,6 +27,7 @@ from tornado import ioloop
 from tornado.testing import AsyncTestCase
 import unittest
 import utils.neon
+from utils.options import options
 import video_processor.video_processing_queue
 
 _log = logging.getLogger(__name__)
@@ -128,6 +129,110 @@ class TestVideoProcessingQueue(test_utils.neontest.AsyncTestCase):
                 return
         self.fail('Never got a message from the Q')
 
+    @tornado.testing.gen_test
+    def test_prefetch_in_priority_order(self):
+        self.q = video_processor.video_processing_queue.VideoProcessingQueue(
+            slots=5)
+        for priority in [2, 0, 1]:
+            yield self.q.write_message(priority, str(priority))
+
+        with options._set_bounded(
+                'video_processor.video_processing_queue.prefetch_size', 5):
+            with patch.object(self.q, '_sqs_receive',
+                              wraps=self.q._sqs_receive) as receive_mock:
+                bodies = []
+                for i in range(3):
+                    mes = yield self.q.read_message()
+                    bodies.append(mes.get_body())
+                    yield self.q.delete_message(mes)
+
+                self.assertEquals(bodies, ['0', '1', '2'])
+                # One receive per queue to fill the buffer and then the
+                # higher priority queues are checked before handing out
+                # a buffered message.
+                self.assertEquals(receive_mock.call_count, 6)
+                self.assertEquals(receive_mock.call_args_list[2][0][1], 3)
+
+    @tornado.testing.gen_test
+    def test_prefetch_limited_by_slots(self):
+        for priority in [0, 0, 1]:
+            yield self.q.write_message(priority, str(priority))
+
+        with options._set_bounded(
+                'video_processor.video_processing_queue.prefetch_size', 5):
+            mes = yield self.q.read_message()
+            self.assertEquals(mes.get_body(), '0')
+            self.assertEquals(self.q._n_buffered(), 0)
+
+    @tornado.testing.gen_test
+    def test_new_higher_priority_job_first(self):
+        self.q = video_processor.video_processing_queue.VideoProcessingQueue(
+            slots=3)
+        for priority in [2, 2]:
+            yield self.q.write_message(priority, 'low')
+
+        with options._set_bounded(
+                'video_processor.video_processing_queue.prefetch_size', 3):
+            mes = yield self.q.read_message()
+            self.assertEquals(mes.get_body(), 'low')
+            self.assertEquals(self.q._n_buffered(), 1)
+
+            yield self.q.write_message(1, 'high')
+            mes = yield self.q.read_message()
+            self.assertEquals(mes.get_body(), 'high')
+            self.assertEquals(self.q._n_buffered(), 1)
+
+    def test_release_when_busy(self):
+        self.q = video_processor.video_processing_queue.VideoProcessingQueue(
+            slots=3)
+        for priority in [0, 0]:
+            self.q.write_message(priority, '0', callback=self.stop)
+            self.wait()
+
+        with options._set_bounded(
+                'video_processor.video_processing_queue.prefetch_size', 3):
+            with options._set_bounded(
+                    'video_processor.video_processing_queue.'
+                    'prefetch_refresh_interval', 0.01):
+                queue = self.q.queue_list[0]
+                with patch.object(queue, 'change_message_visibility_batch') \
+                  as release_mock:
+                    self.q.read_message(callback=self.stop)
+                    self.wait()
+                    self.assertEquals(self.q._n_buffered(), 1)
+
+                    # The reader is busy, so the buffered message is let go
+                    self.q._refresher.join(5.0)
+                    self.assertFalse(self.q._refresher.is_alive())
+                    self.assertEquals(self.q._n_buffered(), 0)
+                    self.assertEquals(release_mock.call_count, 1)
+                    self.assertEquals(release_mock.call_args[0][0][0][1], 0)
+
+    @tornado.testing.gen_test
+    def test_release_prefetched_messages(self):
+        self.q = video_processor.video_processing_queue.VideoProcessingQueue(
+            slots=5)
+        for priority in [0, 0, 1]:
+            yield self.q.write_message(priority, str(priority))
+        queues = self.q.queue_list
+
+        with options._set_bounded(
+                'video_processor.video_processing_queue.prefetch_size', 5):
+            with patch.object(queues[0], 'change_message_visibility_batch') \
+              as release0, \
+              patch.object(queues[1], 'change_message_visibility_batch') \
+              as release1:
+                mes = yield self.q.read_message()
+                self.assertEquals(mes.get_body(), '0')
+
+                yield self.q.release_buffered_messages(async=True)
+
+                self.assertEquals(release0.call_count, 1)
+                self.assertEquals(len(release0.call_args[0][0]), 1)
+                self.assertEquals(release0.call_args[0][0][0][1], 0)
+                self.assertEquals(release1.call_count, 1)
+                self.assertEquals(self.q._n_buffered(), 0)
+
 if __name__ == '__main__':
     utils.neon.InitNeon()
     unittest.main()
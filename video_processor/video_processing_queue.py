@@ -12,6 +12,7 @@ import os
 import Queue
 import random
 import re
+import threading
 import time
 import tornado
 from tornado import ioloop
@@ -19,6 +20,7 @@ from tornado.concurrent import run_on_executor
 import utils.botoutils
 import utils.http
 import utils.ps
+import utils.sync
 from utils import statemon
 
 import logging
@@ -30,27 +32,57 @@ define('queue_prefix', default="testvideojobs_priority_", type=str,
        help="The prefix of the name of each queue")
 define('default_timeout', default=300, help='Default timeout for a message')
 define('region', default='us-east-1', help='region where the queue resides')
+define('prefetch_size', default=0, type=int,
+       help=('Maximum number of messages to buffer locally. It is also '
+             'capped by the number of jobs the reader can start at once. '
+             '0 reads one message at a time'))
+define('prefetch_wait_time', default=10, type=int,
+       help=('Seconds to long poll the queues for when they are empty and '
+             'we are prefetching'))
+define('prefetch_refresh_interval', default=60.0, type=float,
+       help=('Seconds between extending the visibility of the buffered '
+             'messages'))
 
 statemon.define('write_failure', int)
 statemon.define('read_failure', int)
 statemon.define('delete_failure', int)
+statemon.define('prefetched_messages', int)
+statemon.define('released_messages', int)
+statemon.define('visibility_refresh_failure', int)
+
+# Maximum number of messages SQS returns or modifies in one call
+SQS_BATCH_SIZE = 10
 
 class VideoProcessingQueue(object):
     '''Replaces the current server code with an AWS SQS instance'''
-    def __init__(self):
+    def __init__(self, slots=1):
         '''Set up the basic variables 
 
         Inputs:
-        None
+        slots - Number of jobs the reader can start at once. At most
+                this many messages are prefetched, so that jobs are not
+                hidden from idle workers.
 
         Returns:
         None
         '''
+        # Prefetched messages. One deque per priority of
+        # [message, last time its visibility was extended]
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        self._refresher = None
+        self._stop_refresh = threading.Event()
+        self.slots = slots
+        # Last time that read_message was called
+        self._last_read = time.time()
+
         self._reset()
 
         self.executor = concurrent.futures.ThreadPoolExecutor(10)
 
     def _reset(self):
+        with self._buffer_lock:
+            self._buffer = []
         self.queue_list = []
         self.max_priority = 0.0
         self.cumulative_priorities = []
@@ -60,6 +92,7 @@ class VideoProcessingQueue(object):
         self.conn = None
 
     def __del__(self):
+        self._stop_refresh.set()
         self.executor.shutdown(False)
         
     @tornado.gen.coroutine
@@ -92,6 +125,8 @@ class VideoProcessingQueue(object):
                     queue_name,
                     timeout)
                 self.queue_list.append(new_queue)
+                with self._buffer_lock:
+                    self._buffer.append(deque())
                 
                 # The next two lines define how the queues are picked.
                 # Each new queue is half as likely to be selected as
@@ -219,6 +254,22 @@ class VideoProcessingQueue(object):
     def _sqs_read(self, queue):
         return queue.read(message_attributes=['All'])
 
+    @run_on_executor
+    def _sqs_receive(self, queue, num_messages, wait_time):
+        return queue.get_messages(num_messages=num_messages,
+                                  wait_time_seconds=wait_time,
+                                  message_attributes=['All'])
+
+    @run_on_executor
+    def _sqs_change_visibility_batch(self, queue, messages, timeout):
+        return self._change_visibility_batch(queue, messages, timeout)
+
+    def _change_visibility_batch(self, queue, messages, timeout):
+        for i in range(0, len(messages), SQS_BATCH_SIZE):
+            queue.change_message_visibility_batch(
+                [(x, int(timeout)) for x in
+                 messages[i:(i+SQS_BATCH_SIZE)]])
+
     @run_on_executor
     def _sqs_delete(self, queue, message):
         return queue.delete_message(message)
@@ -286,6 +337,22 @@ class VideoProcessingQueue(object):
            A boto.sqs.Message if successful, None otherwise
         '''
         yield self._connect_to_server()
+        if options.prefetch_size > 0:
+            self._last_read = time.time()
+            priority, entry = self._pop_buffered()
+            if entry is None:
+                yield self._fill_buffer()
+                priority, entry = self._pop_buffered()
+            elif priority > 0:
+                # Jobs that arrived in higher priority queues since the
+                # buffer was filled go first.
+                message = yield self._receive_first(priority)
+                if message is not None:
+                    with self._buffer_lock:
+                        self._buffer[priority].appendleft(entry)
+                    raise tornado.gen.Return(message)
+            raise tornado.gen.Return(None if entry is None else entry[0])
+
         priority = self._get_priority_qindex()
         message = None
         while priority < options.num_queues and message is None:
@@ -294,6 +361,170 @@ class VideoProcessingQueue(object):
             priority += 1
         raise tornado.gen.Return(message)
 
+    def _pop_buffered(self):
+        '''Removes the highest priority buffered message.
+
+        Messages that could have become visible to other workers
+        are dropped.
+
+        Returns (priority, [message, refresh time]) or (None, None)
+        '''
+        with self._buffer_lock:
+            for priority, buf in enumerate(self._buffer):
+                while len(buf) > 0:
+                    entry = buf.popleft()
+                    if (time.time() - entry[1] <
+                        options.default_timeout * 0.9):
+                        return priority, entry
+                    _log.warn('Prefetched message %s expired' %
+                              entry[0].id)
+        return None, None
+
+    @tornado.gen.coroutine
+    def _receive_first(self, max_priority):
+        '''Returns a message from the queues with a priority less than
+        max_priority, or None if they are empty.
+        '''
+        for priority in range(max_priority):
+            messages = yield self._sqs_receive(self._get_queue(priority), 1,
+                                               0)
+            if len(messages) > 0:
+                raise tornado.gen.Return(messages[0])
+        raise tornado.gen.Return(None)
+
+    def _n_buffered(self):
+        with self._buffer_lock:
+            return sum([len(x) for x in self._buffer])
+
+    @tornado.gen.coroutine
+    def _fill_buffer(self):
+        '''Receives messages into the local buffer.
+
+        The queues are polled in priority order, getting up to 10
+        messages at a time, until the buffer is full. If they are all
+        empty, all the queues are long polled at once and the highest
+        priority messages are kept.
+        '''
+        space = min(options.prefetch_size, self.slots) - self._n_buffered()
+        received = []  # List of (priority, message)
+        for priority, queue in enumerate(self.queue_list):
+            if space <= 0:
+                break
+            messages = yield self._sqs_receive(
+                queue, min(SQS_BATCH_SIZE, space), 0)
+            received.extend([(priority, x) for x in messages])
+            space -= len(messages)
+
+        if (len(received) == 0 and space > 0 and
+            options.prefetch_wait_time > 0):
+            results = yield [
+                self._sqs_receive(queue, min(SQS_BATCH_SIZE, space),
+                                  options.prefetch_wait_time)
+                for queue in self.queue_list]
+            extra = []
+            for priority, messages in enumerate(results):
+                for message in messages:
+                    if space > 0:
+                        received.append((priority, message))
+                        space -= 1
+                    else:
+                        extra.append(message)
+                if len(extra) > 0:
+                    yield self._release(priority, extra)
+                    extra = []
+
+        now = time.time()
+        with self._buffer_lock:
+            for priority, message in received:
+                self._buffer[priority].append([message, now])
+        statemon.state.increment('prefetched_messages', len(received))
+        if len(received) > 0:
+            self._start_refresher()
+
+    @tornado.gen.coroutine
+    def _release(self, priority, messages):
+        '''Makes messages visible to other workers again.'''
+        try:
+            yield self._sqs_change_visibility_batch(
+                self._get_queue(priority), messages, 0)
+            statemon.state.increment('released_messages', len(messages))
+        except Exception as e:
+            _log.warn('Error releasing %i messages: %s' % (len(messages), e))
+
+    def _start_refresher(self):
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._stop_refresh.clear()
+        self._refresher = threading.Thread(target=self._refresh_visibility,
+                                           name='sqs_visibility_refresher')
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def _refresh_visibility(self):
+        '''Extends the visibility of the buffered messages until stopped.
+
+        Runs in its own thread so that the messages stay hidden while
+        the ioloop is busy or not running. If the reader has not asked
+        for a message in the last interval, it is busy with its jobs,
+        so the messages are released for other workers instead.
+        '''
+        while not self._stop_refresh.wait(options.prefetch_refresh_interval):
+            if (time.time() - self._last_read >
+                options.prefetch_refresh_interval):
+                for priority, messages in self._take_buffered():
+                    try:
+                        self._change_visibility_batch(
+                            self._get_queue(priority), messages, 0)
+                        statemon.state.increment('released_messages',
+                                                 len(messages))
+                    except Exception as e:
+                        _log.warn('Error releasing %i messages: %s' %
+                                  (len(messages), e))
+                return
+
+            with self._buffer_lock:
+                to_refresh = [(priority, list(buf)) for priority, buf in
+                              enumerate(self._buffer) if len(buf) > 0]
+            for priority, entries in to_refresh:
+                try:
+                    self._change_visibility_batch(
+                        self._get_queue(priority),
+                        [x[0] for x in entries],
+                        options.default_timeout)
+                except Exception as e:
+                    _log.warn('Error extending the visibility of buffered '
+                              'messages: %s' % e)
+                    statemon.state.increment('visibility_refresh_failure')
+                    continue
+                now = time.time()
+                with self._buffer_lock:
+                    for entry in entries:
+                        entry[1] = now
+
+    @utils.sync.optional_sync
+    @tornado.gen.coroutine
+    def release_buffered_messages(self):
+        '''Releases all the prefetched messages that were not read.
+
+        Call this on shutdown so that other workers can get the messages
+        right away.
+        '''
+        self._stop_refresh.set()
+        yield [self._release(priority, messages) for priority, messages
+               in self._take_buffered()]
+
+    def _take_buffered(self):
+        '''Empties the buffer.
+
+        Returns a list of (priority, [messages])
+        '''
+        with self._buffer_lock:
+            rv = [(priority, [x[0] for x in buf]) for priority, buf
+                  in enumerate(self._buffer) if len(buf) > 0]
+            for buf in self._buffer:
+                buf.clear()
+        return rv
+
     @tornado.gen.coroutine
     def delete_message(self, message):
         '''Deletes the specified message